@@ -11,14 +11,33 @@ ErosionFlow
  ***************************************************************************/
 """
 
+import numpy as np
+
 from qgis.core import QgsProcessing
 from qgis.core import QgsProcessingAlgorithm
-from qgis.core import QgsProcessingMultiStepFeedback
+from qgis.core import QgsProcessingException
 from qgis.core import QgsProcessingParameterMapLayer
+from qgis.core import QgsProcessingParameterFeatureSource
 from qgis.core import QgsProcessingParameterNumber
 from qgis.core import QgsProcessingParameterRasterDestination
+from qgis.core import QgsProcessingParameterFolderDestination
 from qgis.core import QgsProcessingLayerPostProcessorInterface
-import processing
+from qgis.core import QgsProcessingParameterEnum
+from qgis.core import QgsProcessingParameterBoolean
+from qgis.core import QgsProcessingUtils
+from osgeo import gdal
+
+from .erosion_flow_layers import layer_source, region_geometries
+from .erosion_flow_engine import Canceled, ls_factor, ls_factors, LS_FORMULATIONS
+from .erosion_flow_raster import block_calc, remove_rasters, raster_info, clip_raster, memory_path
+from .erosion_flow_routing import ROUTING_METHODS, MFD
+from .erosion_flow_stages import flow_accumulation, slope_raster, aspect_raster, upstream_region
+from .erosion_flow_scheduler import StageGraph
+from .erosion_flow_cache import run_cached
+from .erosion_flow_settings import result_cache, max_workers, memory_budget
+from .erosion_flow_memory import plan_memory
+from .erosion_flow_zarr import store_outputs
+from .erosion_flow_style import apply_default_style
 
 
 class LSarea(QgsProcessingAlgorithm):
@@ -27,88 +46,143 @@ class LSarea(QgsProcessingAlgorithm):
         self.addParameter(QgsProcessingParameterMapLayer('filleddem', 'Filled DEM no nulls or sinks', defaultValue=None, types=[QgsProcessing.TypeRaster]))
         self.addParameter(QgsProcessingParameterNumber('lssheeterosionfactor', 'LS sheet erosion factor', optional=True, type=QgsProcessingParameterNumber.Double, minValue=0.4, maxValue=0.6, defaultValue=0.5))
         self.addParameter(QgsProcessingParameterNumber('lsrillerosionfactor', 'LS rill erosion factor', optional=True, type=QgsProcessingParameterNumber.Double, minValue=1, maxValue=1.3, defaultValue=1.1))
+        self.addParameter(QgsProcessingParameterEnum('routingmethod', 'Flow routing method', options=ROUTING_METHODS, defaultValue=MFD))
+        self.addParameter(QgsProcessingParameterNumber('convergence', 'MFD convergence factor', optional=True, type=QgsProcessingParameterNumber.Double, minValue=0, defaultValue=1.1))
+        self.addParameter(QgsProcessingParameterBoolean('reuseflowgraph', 'Save and reuse the flow direction graph next to the DEM', defaultValue=False))
+        self.addParameter(QgsProcessingParameterFeatureSource('region', 'Outlet points or region of interest (limits the run to its upstream area)', optional=True, types=[QgsProcessing.TypeVectorAnyGeometry]))
+        self.addParameter(QgsProcessingParameterMapLayer('flowaccumulation', 'Precomputed flow accumulation on the DEM grid (skips flow routing)', optional=True, defaultValue=None, types=[QgsProcessing.TypeRaster]))
         self.addParameter(QgsProcessingParameterRasterDestination('Ls', 'LS', createByDefault=True, defaultValue=None))
         self.addParameter(QgsProcessingParameterRasterDestination('Slope', 'Slope', createByDefault=True, defaultValue=None))
         self.addParameter(QgsProcessingParameterRasterDestination('FlowAccumulation', 'Flow Accumulation', createByDefault=True, defaultValue=None))
+        self.addParameter(QgsProcessingParameterFolderDestination('ChunkedStore', 'Chunked store (Zarr) to write outputs into', optional=True, createByDefault=False, defaultValue=None))
+        self.addParameter(QgsProcessingParameterRasterDestination('LsFormulations', 'LS formulations (one band each: ' + ', '.join(LS_FORMULATIONS) + ')', optional=True, createByDefault=False, defaultValue=None))
 
     def processAlgorithm(self, parameters, context, model_feedback):
-        # Use a multi-step feedback, so that individual child algorithm progress reports are adjusted for the
-        # overall progress through the model
-        feedback = QgsProcessingMultiStepFeedback(2, model_feedback)
-        results = {}
-        outputs = {}
-
-        # Slope
-        alg_params = {
-            'INPUT': parameters['filleddem'],
-            'Z_FACTOR': 1,
-            'OUTPUT': parameters['Slope']
-        }
-        outputs['Slope'] = processing.run('native:slope', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        results['Slope'] = outputs['Slope']['OUTPUT']
-
-        feedback.setCurrentStep(1)
-        if feedback.isCanceled():
+        # rasters written by this run, removed again if it is canceled
+        self.rasters = []
+        # intermediate rasters, removed when the run ends if not already by the stage graph
+        self.intermediates = []
+        try:
+            return self.runStages(parameters, context, model_feedback)
+        except (Canceled, QgsProcessingException):
+            # child algorithms report a cancel as an exception
+            remove_rasters(self.rasters)
+            if not model_feedback.isCanceled():
+                raise
+            model_feedback.pushInfo('Canceled, removed intermediate rasters')
             return {}
+        finally:
+            remove_rasters(self.intermediates)
 
-        # Flow Accumulation (Top-Down)
-        alg_params = {
-            'ACCU_MATERIAL': None,
-            'ACCU_TARGET': parameters['filleddem'],
-            'CONVERGENCE': 1.1,
-            'ELEVATION': parameters['filleddem'],
-            'FLOW_UNIT': 1,  # [1] cell area
-            'LINEAR_DIR': None,
-            'LINEAR_DO': False,
-            'LINEAR_MIN': 500,
-            'LINEAR_VAL': None,
-            'METHOD': 4,  # [4] Multiple Flow Direction
-            'NO_NEGATIVES': True,
-            'SINKROUTE': None,
-            'STEP': 1,
-            'VAL_INPUT': None,
-            'WEIGHTS': None,
-            'ACCU_LEFT': QgsProcessing.TEMPORARY_OUTPUT,
-            'ACCU_RIGHT': QgsProcessing.TEMPORARY_OUTPUT,
-            'ACCU_TOTAL': QgsProcessing.TEMPORARY_OUTPUT,
-            'FLOW': parameters['FlowAccumulation'],
-            'FLOW_LENGTH': QgsProcessing.TEMPORARY_OUTPUT,
-            'VAL_MEAN': QgsProcessing.TEMPORARY_OUTPUT,
-            'WEIGHT_LOSS': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['FlowAccumulationTopdown'] = processing.run('saga:flowaccumulationtopdown', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        results['FlowAccumulation'] = outputs['FlowAccumulationTopdown']['FLOW']
-
-        feedback.setCurrentStep(2)
-        if feedback.isCanceled():
-            return {}
+    def runStages(self, parameters, context, feedback):
+        results = {}
 
-        m = str(parameters['lssheeterosionfactor'])
-        n = str(parameters['lsrillerosionfactor'])
-
-        # Raster calculator
-        alg_params = {
-            'BAND_A': 1,
-            'BAND_B': 1,
-            'BAND_C': None,
-            'BAND_D': None,
-            'BAND_E': None,
-            'BAND_F': None,
-            'EXTRA': '',
-            'FORMULA': '(' + m + '1) * power((A/22.1), ' + m + ') * power((sin(B* 3.14159 / 180)/0.09), ' + n + ')',
-            'INPUT_A': outputs['FlowAccumulationTopdown']['FLOW'],
-            'INPUT_B': outputs['Slope']['OUTPUT'],
-            'INPUT_C': None,
-            'INPUT_D': None,
-            'INPUT_E': None,
-            'INPUT_F': None,
-            'NO_DATA': None,
-            'OPTIONS': '',
-            'RTYPE': 5,  # Float32
-            'OUTPUT': parameters['Ls']
-        }
-        outputs['RasterCalculator'] = processing.run('gdal:rastercalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        results['Ls'] = outputs['RasterCalculator']['OUTPUT']
+        cache = result_cache()
+        demLayer = self.parameterAsRasterLayer(parameters, 'filleddem', context)
+        demSource = layer_source(demLayer)
+        demInfo = raster_info(demSource)
+
+        routingMethod = self.parameterAsEnum(parameters, 'routingmethod', context)
+        convergence = self.parameterAsDouble(parameters, 'convergence', context)
+        reuseGraph = self.parameterAsBool(parameters, 'reuseflowgraph', context)
+        feedback.pushConsoleInfo('Flow routing: ' + ROUTING_METHODS[routingMethod])
+
+        # e.g. from Tiled flow accumulation over a DEM too large for one pass
+        flowLayer = self.parameterAsRasterLayer(parameters, 'flowaccumulation', context)
+        flowSource = layer_source(flowLayer) if flowLayer is not None else None
+        if flowSource is not None:
+            flowInfo = raster_info(flowSource)
+            if flowInfo.shape != demInfo.shape or not np.allclose(flowInfo.geotransform, demInfo.geotransform):
+                raise QgsProcessingException('Precomputed flow accumulation must be on the grid of the DEM')
+
+        # limit the run to the area draining into the outlets or region of interest
+        regionMask = None
+        geometries = region_geometries(self.parameterAsSource(parameters, 'region', context), demLayer.crs(), context)
+        if geometries is not None:
+            try:
+                regionDem, regionOutput = QgsProcessingUtils.generateTempFilename('RegionDem.tif'), QgsProcessingUtils.generateTempFilename('Region.tif')
+                self.intermediates.extend([regionDem, regionOutput])
+                demSource, regionMask = upstream_region(demSource, geometries, regionDem, regionOutput,
+                                                        routingMethod, convergence, reuseGraph, feedback)
+            except ValueError as e:
+                raise QgsProcessingException(str(e))
+            # the clipped DEM is a temporary file, no point keeping its graph
+            reuseGraph = False
+
+        m = self.parameterAsDouble(parameters, 'lssheeterosionfactor', context)
+        n = self.parameterAsDouble(parameters, 'lsrillerosionfactor', context)
+
+        slopeOutput = self.parameterAsOutputLayer(parameters, 'Slope', context) or QgsProcessingUtils.generateTempFilename('Slope.tif')
+        flowOutput = self.parameterAsOutputLayer(parameters, 'FlowAccumulation', context) or QgsProcessingUtils.generateTempFilename('FlowAccumulation.tif')
+        lsOutput = self.parameterAsOutputLayer(parameters, 'Ls', context)
+        formulationsOutput = self.parameterAsOutputLayer(parameters, 'LsFormulations', context)
+        self.rasters.extend([slopeOutput, flowOutput, lsOutput])
+
+        # block size and concurrency within the memory budget
+        plan = plan_memory(demInfo.shape, memory_budget(), routingMethod, 1 if formulationsOutput else 0, max_workers())
+        feedback.pushInfo(plan.describe())
+        rows = plan.block_rows
+
+        # slope and flow accumulation run concurrently
+        stages = StageGraph(feedback, plan.workers)
+
+        # Slope
+        def demSlope(feedback):
+            compute = lambda output: slope_raster(demSource, output, feedback=feedback, block_rows=rows)
+            return run_cached(cache, 'slope', [demSource], {'z_factor': 1}, slopeOutput, compute, feedback)
+
+        # Flow Accumulation (in-process, routing method selectable)
+        def flowAccumulation(feedback):
+            if flowSource is not None:
+                # copied to the output, clipped to the region DEM when limited to one
+                return clip_raster(flowSource, raster_info(demSource), flowOutput)
+            compute = lambda output: flow_accumulation(demSource, output, routingMethod, convergence, reuseGraph, feedback=feedback)
+            return run_cached(cache, 'flowaccumulation', [demSource], {'method': routingMethod, 'convergence': convergence}, flowOutput, compute, feedback)
+
+        stages.add('Slope', demSlope)
+        stages.add('FlowAccumulation', flowAccumulation)
+
+        # LS = (m + 1) * (A / 22.1)^m * (sin(B) / 0.09)^n, computed block by block
+        # and masked to the upstream area (R is nodata outside it) when limited to one
+        region = [regionMask] if regionMask else []
+        stages.add('Ls', lambda flow, slope, feedback: block_calc(lsOutput, [flow, slope] + region, lambda A, B, R=1: ls_factor(A, B, m, n) * R, feedback, gdal.GDT_Float32, rows, statistics=True), 'FlowAccumulation', 'Slope')
+
+        # every LS formulation from the same flow accumulation and slope in one pass, one band each
+        if formulationsOutput:
+            self.rasters.append(formulationsOutput)
+            # cell widths per block, in metres per row for a geographic DEM
+            cellSizes = raster_info(demSource).cell_sizes
+            aspectOutput = memory_path('Aspect') if plan.in_memory else QgsProcessingUtils.generateTempFilename('Aspect.tif')
+            self.rasters.append(aspectOutput)
+            self.intermediates.append(aspectOutput)
+
+            def demAspect(feedback):
+                compute = lambda output: aspect_raster(demSource, output, feedback=feedback, block_rows=rows)
+                return run_cached(cache, 'aspect', [demSource], {'z_factor': 1}, aspectOutput, compute, feedback)
+
+            stages.add('Aspect', demAspect)
+            stages.add('LsFormulations', lambda flow, slope, aspect, feedback: block_calc(formulationsOutput, [flow, slope, aspect, cellSizes] + region, lambda A, B, C, size, R=1: ls_factors(A, B, C, size[0], m, n) * R, feedback, gdal.GDT_Float32, rows, band_names=LS_FORMULATIONS), 'FlowAccumulation', 'Slope', 'Aspect')
+
+        # intermediates are removed as soon as the last stage reading them is done: aspect, and slope
+        # and flow accumulation when not asked for (flow accumulation still goes into a chunked store)
+        storePath = self.parameterAsString(parameters, 'ChunkedStore', context)
+        stages.temporary('Aspect')
+        if not self.parameterAsOutputLayer(parameters, 'Slope', context):
+            stages.temporary('Slope')
+        if not (self.parameterAsOutputLayer(parameters, 'FlowAccumulation', context) or storePath):
+            stages.temporary('FlowAccumulation')
+        stages.track(*self.intermediates)
+
+        results.update(stages.run())
+        results.pop('Aspect', None)
+        feedback.pushInfo(stages.usage())
+
+        # LS and flow accumulation into the chunked store, at their place in its grid (the DEM's when created)
+        if storePath:
+            try:
+                results['ChunkedStore'] = store_outputs(storePath, demInfo, {'ls': results['Ls'], 'flowaccumulation': results['FlowAccumulation']}, feedback)
+            except ValueError as e:
+                raise QgsProcessingException(str(e))
 
         global outputRenamer
         outputRenamer = OutputRenamer('LSarea')
@@ -138,3 +212,4 @@ class OutputRenamer (QgsProcessingLayerPostProcessorInterface):
         
     def postProcessLayer(self, layer, context, feedback):
         layer.setName(self.name)
+        apply_default_style(layer)
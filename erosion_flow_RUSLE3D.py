@@ -13,13 +13,34 @@ ErosionFlow
 
 from qgis.core import QgsProcessing
 from qgis.core import QgsProcessingAlgorithm
+from qgis.core import QgsProcessingException
 from qgis.core import QgsProcessingMultiStepFeedback
 from qgis.core import QgsProcessingParameterMapLayer
+from qgis.core import QgsProcessingParameterMultipleLayers
+from qgis.core import QgsProcessingParameterString
+from qgis.core import QgsProcessingParameterFeatureSource
 from qgis.core import QgsProcessingParameterNumber
 from qgis.core import QgsProcessingParameterRasterDestination
+from qgis.core import QgsProcessingParameterFolderDestination
 from qgis.core import QgsProcessingLayerPostProcessorInterface
+from qgis.core import QgsProcessingParameterEnum
+from qgis.core import QgsProcessingParameterBoolean
+from qgis.core import QgsProcessingUtils
 import processing
 
+from .erosion_flow_encoding import ENCODINGS, FLOAT, output_encoding
+from .erosion_flow_layers import layer_source
+from .erosion_flow_engine import Canceled, check_canceled, rusle
+from .erosion_flow_expression import compile_expression, input_names
+from .erosion_flow_raster import block_calc, remove_rasters, raster_info, clip_raster
+from .erosion_flow_files import raster_bytes
+from .erosion_flow_scheduler import usage_message
+from .erosion_flow_memory import plan_memory
+from .erosion_flow_zarr import store_outputs
+from .erosion_flow_style import apply_default_style
+from .erosion_flow_settings import max_workers, memory_budget
+from .erosion_flow_routing import ROUTING_METHODS, MFD
+
 
 class RUSLE(QgsProcessingAlgorithm):
 
@@ -33,74 +54,130 @@ class RUSLE(QgsProcessingAlgorithm):
         self.addParameter(QgsProcessingParameterNumber('rfactorsinglevalue', 'R factor single value', optional=True, type=QgsProcessingParameterNumber.Double, defaultValue=750))
         self.addParameter(QgsProcessingParameterNumber('lssheetfactor', 'LS sheet factor', optional=True, type=QgsProcessingParameterNumber.Double, minValue=0.4, maxValue=0.6, defaultValue=0.5))
         self.addParameter(QgsProcessingParameterNumber('lsrillfactor', 'LS rill factor', optional=True, type=QgsProcessingParameterNumber.Double, minValue=1, maxValue=1.3, defaultValue=1.1))
+        self.addParameter(QgsProcessingParameterEnum('routingmethod', 'Flow routing method', options=ROUTING_METHODS, defaultValue=MFD))
+        self.addParameter(QgsProcessingParameterNumber('convergence', 'MFD convergence factor', optional=True, type=QgsProcessingParameterNumber.Double, minValue=0, defaultValue=1.1))
+        self.addParameter(QgsProcessingParameterBoolean('reuseflowgraph', 'Save and reuse the flow direction graph next to the DEM', defaultValue=False))
+        self.addParameter(QgsProcessingParameterFeatureSource('region', 'Outlet points or region of interest (limits the run to its upstream area)', optional=True, types=[QgsProcessing.TypeVectorAnyGeometry]))
+        self.addParameter(QgsProcessingParameterMapLayer('flowaccumulation', 'Precomputed flow accumulation on the DEM grid (skips flow routing)', optional=True, defaultValue=None, types=[QgsProcessing.TypeRaster]))
+        self.addParameter(QgsProcessingParameterString('formula', 'Custom RUSLE formula of LS, K, C, R and the formula rasters A, B, ... (default LS * K * C * R)', optional=True, defaultValue=None))
+        self.addParameter(QgsProcessingParameterMultipleLayers('formulalayers', 'Formula rasters (A, B, ... in order), e.g. a P factor', layerType=QgsProcessing.TypeRaster, optional=True, defaultValue=None))
         self.addParameter(QgsProcessingParameterRasterDestination('LSArea', 'LS Area'))
         self.addParameter(QgsProcessingParameterRasterDestination('Rusle', 'RUSLE'))
+        self.addParameter(QgsProcessingParameterEnum('outputencoding', 'Output encoding (16 bit integers read back as floats, a quarter of Float64)', options=ENCODINGS, defaultValue=FLOAT))
+        self.addParameter(QgsProcessingParameterNumber('encodingscale', 'Encoding scale, value per integer step (0 fits it to the first rows of the output)', optional=True, type=QgsProcessingParameterNumber.Double, minValue=0, defaultValue=0))
+        self.addParameter(QgsProcessingParameterNumber('encodingoffset', 'Encoding offset, value of integer 0 (with a given scale)', optional=True, type=QgsProcessingParameterNumber.Double, defaultValue=0))
+        self.addParameter(QgsProcessingParameterFolderDestination('ChunkedStore', 'Chunked store (Zarr) to write outputs into', optional=True, createByDefault=False, defaultValue=None))
 
     def processAlgorithm(self, parameters, context, model_feedback):
+        # rasters written by this run, removed again if it is canceled
+        self.rasters = []
+        try:
+            return self.runStages(parameters, context, model_feedback)
+        except (Canceled, QgsProcessingException):
+            # child algorithms report a cancel as an exception
+            remove_rasters(self.rasters)
+            if not model_feedback.isCanceled():
+                raise
+            model_feedback.pushInfo('Canceled, removed intermediate rasters')
+            return {}
+
+    def runStages(self, parameters, context, model_feedback):
         # Use a multi-step feedback, so that individual child algorithm progress reports are adjusted for the
         # overall progress through the model
         feedback = QgsProcessingMultiStepFeedback(2, model_feedback)
         results = {}
         outputs = {}
 
-        # LS Mitasova
+        # a custom formula is checked and compiled before anything is computed
+        formulaLayers = self.parameterAsLayerList(parameters, 'formulalayers', context) if parameters.get('formulalayers') else []
+        formula = None
+        if self.parameterAsString(parameters, 'formula', context).strip():
+            try:
+                formula = compile_expression(self.parameterAsString(parameters, 'formula', context), ['LS', 'K', 'C', 'R'] + input_names(len(formulaLayers)))
+            except ValueError as e:
+                raise QgsProcessingException(str(e))
+        elif formulaLayers:
+            raise QgsProcessingException('Formula rasters are given but no formula uses them')
+
+        # LS Area
+        lsOutput = self.parameterAsOutputLayer(parameters, 'LSArea', context)
+        self.rasters.append(lsOutput)
         alg_params = {
             'filleddem': parameters['filledsinksdem'],
             'lsrillerosionfactor': parameters['lsrillfactor'],
             'lssheeterosionfactor': parameters['lssheetfactor'],
+            'routingmethod': parameters['routingmethod'],
+            'convergence': parameters['convergence'],
+            'reuseflowgraph': parameters['reuseflowgraph'],
+            'region': parameters.get('region'),
+            'flowaccumulation': parameters.get('flowaccumulation'),
             'FlowAccumulation': QgsProcessing.TEMPORARY_OUTPUT,
-            'Ls': QgsProcessing.TEMPORARY_OUTPUT,
-            'Slope': parameters['LSArea']
+            'Ls': lsOutput,
+            'Slope': QgsProcessing.TEMPORARY_OUTPUT
         }
-        outputs['LsMitasova'] = processing.run('script:LS Mitasova', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        results['LSArea'] = outputs['LsMitasova']['Ls']
+        outputs['LsMitasova'] = processing.run('ErosionFlow:LSArea', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
 
         feedback.setCurrentStep(1)
-        if feedback.isCanceled():
-            return {}
+        check_canceled(feedback)
+        results['LSArea'] = outputs['LsMitasova']['Ls']
 
-        feedback.pushConsoleInfo('\n~~~~~~~~~~~~~~~~ RUSLE FORMULA ~~~~~~~~~~~~~~~~\n')
+        # the child's slope and flow accumulation were only needed for LS
+        childIntermediates = [outputs['LsMitasova'][name] for name in ('FlowAccumulation', 'Slope') if outputs['LsMitasova'].get(name)]
+        peakBytes = sum(raster_bytes(r) for r in childIntermediates)
+        remove_rasters(childIntermediates)
 
-        # build raster calculation using single factors or rasters
-        RUSLEformula = 'A*'
-        if parameters['kfactor'] is not None: 
-            RUSLEformula += 'B*'
-        else: 
-            RUSLEformula += str(parameters['kfactorsinglevalue'])+'*'
-        if parameters['cfactor'] is not None: 
-            RUSLEformula += 'C*'
-        else: 
-            RUSLEformula += str(parameters['cfactorsinglevalue'])+'*'
-        if parameters['rfactor'] is not None: 
-            RUSLEformula += 'D'
-        else: 
-            RUSLEformula += str(parameters['rfactorsinglevalue'])
+        feedback.pushConsoleInfo('\n~~~~~~~~~~~~~~~~ RUSLE FORMULA ~~~~~~~~~~~~~~~~\n')
 
+        # use factor rasters where given, single values otherwise
+        factors = []
+        RUSLEformula = 'LS'
+        for factor in ('kfactor', 'cfactor', 'rfactor'):
+            layer = self.parameterAsRasterLayer(parameters, factor, context)
+            if layer is not None:
+                factors.append(layer_source(layer))
+                RUSLEformula += ' * ' + layer.name()
+            else:
+                factors.append(self.parameterAsDouble(parameters, factor + 'singlevalue', context))
+                RUSLEformula += ' * ' + str(factors[-1])
+
+        if formula is not None:
+            factors += [layer_source(layer) for layer in formulaLayers]
+            RUSLEformula = '{}, with {}'.format(formula.text, RUSLEformula.replace(' * ', ', '))
+            for name, layer in zip(formula.names[4:], formulaLayers):
+                RUSLEformula += ', {} = {}'.format(name, layer.name())
         feedback.pushConsoleInfo(RUSLEformula+'\n')
 
-        # Raster calculator
-        alg_params = {
-            'BAND_A': 1,
-            'BAND_B': 1,
-            'BAND_C': 1,
-            'BAND_D': 1,
-            'BAND_E': None,
-            'BAND_F': None,
-            'EXTRA': '',
-            'FORMULA': RUSLEformula,
-            'INPUT_A': outputs['LsMitasova']['Ls'],
-            'INPUT_B': parameters['kfactor'],
-            'INPUT_C': parameters['cfactor'],
-            'INPUT_D': parameters['rfactor'],
-            'INPUT_E': None,
-            'INPUT_F': None,
-            'NO_DATA': None,
-            'OPTIONS': '',
-            'RTYPE': 6,  # Float64
-            'OUTPUT': parameters['Rusle']
-        }
-        outputs['RasterCalculator'] = processing.run('gdal:rastercalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        results['Rusle'] = outputs['RasterCalculator']['OUTPUT']
+        # limited to an upstream area, LS covers only its window: clip the factor rasters to it
+        lsInfo = raster_info(results['LSArea'])
+        clipped = []
+        if parameters.get('region'):
+            factors = [clip_raster(f, lsInfo, QgsProcessingUtils.generateTempFilename('Factor.tif')) if not isinstance(f, float) else f for f in factors]
+            clipped = [f for f in factors if isinstance(f, str)]
+            self.rasters.extend(clipped)
+        for f in factors:
+            if not isinstance(f, float) and raster_info(f).shape != lsInfo.shape:
+                raise QgsProcessingException('Factor raster {} is not on the DEM grid'.format(f))
+
+        # RUSLE = LS * K * C * R, or the custom formula, computed block by block,
+        # stored as floats or as scaled 16 bit integers
+        encoding = output_encoding(self.parameterAsEnum(parameters, 'outputencoding', context), self.parameterAsDouble(parameters, 'encodingscale', context),
+                                   self.parameterAsDouble(parameters, 'encodingoffset', context))
+        rusleOutput = self.parameterAsOutputLayer(parameters, 'Rusle', context)
+        self.rasters.append(rusleOutput)
+        plan = plan_memory(lsInfo.shape, memory_budget(), self.parameterAsEnum(parameters, 'routingmethod', context), 0, max_workers())
+        results['Rusle'] = block_calc(rusleOutput, [results['LSArea']] + factors, formula.evaluate if formula is not None else rusle, feedback, block_rows=plan.block_rows, statistics=True, encoding=encoding)
+        peakBytes = max(peakBytes, sum(raster_bytes(r) for r in clipped))
+        remove_rasters(clipped)
+        feedback.pushInfo(usage_message(peakBytes))
+
+        # LS and RUSLE into the chunked store, at their place in its grid (the DEM's when created)
+        storePath = self.parameterAsString(parameters, 'ChunkedStore', context)
+        if storePath:
+            demInfo = raster_info(layer_source(self.parameterAsRasterLayer(parameters, 'filledsinksdem', context)))
+            try:
+                results['ChunkedStore'] = store_outputs(storePath, demInfo, {'ls': results['LSArea'], 'rusle': results['Rusle']}, feedback)
+            except ValueError as e:
+                raise QgsProcessingException(str(e))
 
         global renamer
         renamer = Renamer('RUSLE')
@@ -130,3 +207,4 @@ class Renamer (QgsProcessingLayerPostProcessorInterface):
         
     def postProcessLayer(self, layer, context, feedback):
         layer.setName(self.name)
+        apply_default_style(layer)
@@ -11,15 +11,41 @@ ErosionFlow
  ***************************************************************************/
 """
 
+import os
+
+import numpy as np
+
 from qgis.core import QgsProcessing
 from qgis.core import QgsProcessingAlgorithm
-from qgis.core import QgsProcessingMultiStepFeedback
+from qgis.core import QgsProcessingException
 from qgis.core import QgsProcessingParameterMapLayer
+from qgis.core import QgsProcessingParameterFeatureSource
 from qgis.core import QgsProcessingParameterNumber
 from qgis.core import QgsProcessingParameterRasterDestination
+from qgis.core import QgsProcessingParameterFolderDestination
 from qgis.core import QgsProcessingLayerPostProcessorInterface
 from qgis.core import QgsProcessingParameterBoolean
-import processing
+from qgis.core import QgsProcessingParameterEnum
+from qgis.core import QgsProcessingParameterFile
+from qgis.core import QgsProcessingUtils
+
+from .erosion_flow_encoding import ENCODINGS, FLOAT, output_encoding
+from .erosion_flow_layers import layer_source, region_geometries
+from .erosion_flow_engine import Canceled
+from .erosion_flow_raster import remove_rasters, raster_info, clip_raster, memory_path, copy_raster
+from .erosion_flow_routing import ROUTING_METHODS, MFD
+from .erosion_flow_stages import upstream_region, add_terrain_stages, add_usped_stages, ErosionRegime
+from .erosion_flow_stages import REGIMES, REGIME_GLOBAL, REGIME_RASTER
+from .erosion_flow_scheduler import StageGraph
+from .erosion_flow_checkpoint import Checkpoint, run_key
+from .erosion_flow_settings import result_cache, max_workers, memory_budget
+from .erosion_flow_memory import plan_memory
+from .erosion_flow_zarr import store_outputs
+from .erosion_flow_style import apply_default_style
+
+
+# temporary rasters of a run: slope, aspect, sflowtopo, qsx, qsy, their slopes and aspects, qsx_dx and qsy_dy
+USPED_INTERMEDIATES = 11
 
 
 class USPED(QgsProcessingAlgorithm):
@@ -35,292 +61,207 @@ class USPED(QgsProcessingAlgorithm):
         self.addParameter(QgsProcessingParameterNumber('lssheetfactor', 'LS sheet factor', optional=True, type=QgsProcessingParameterNumber.Double, minValue=0.4, maxValue=0.6, defaultValue=0.5))
         self.addParameter(QgsProcessingParameterNumber('lsrillfactor', 'LS rill factor', optional=True, type=QgsProcessingParameterNumber.Double, minValue=1, maxValue=1.3, defaultValue=1.1))
         self.addParameter(QgsProcessingParameterBoolean('prevailingrill', 'Prevailing rill erosion (unchecked for sheet)', defaultValue=True))
+        self.addParameter(QgsProcessingParameterEnum('erosionregime', 'Rill / sheet erosion regime', options=REGIMES, defaultValue=REGIME_GLOBAL))
+        self.addParameter(QgsProcessingParameterNumber('rillminarea', 'Rill erosion from contributing area (map units², thresholds regime)', optional=True, type=QgsProcessingParameterNumber.Double, minValue=0, defaultValue=0))
+        self.addParameter(QgsProcessingParameterNumber('rillminslope', 'Rill erosion from slope (degrees, thresholds regime)', optional=True, type=QgsProcessingParameterNumber.Double, minValue=0, maxValue=90, defaultValue=0))
+        self.addParameter(QgsProcessingParameterMapLayer('regimeraster', 'Regime raster (1 rill, 0 sheet, nodata as the prevailing setting)', optional=True, defaultValue=None, types=[QgsProcessing.TypeRaster]))
+        self.addParameter(QgsProcessingParameterEnum('routingmethod', 'Flow routing method', options=ROUTING_METHODS, defaultValue=MFD))
+        self.addParameter(QgsProcessingParameterNumber('convergence', 'MFD convergence factor', optional=True, type=QgsProcessingParameterNumber.Double, minValue=0, defaultValue=1.1))
+        self.addParameter(QgsProcessingParameterBoolean('reuseflowgraph', 'Save and reuse the flow direction graph next to the DEM', defaultValue=False))
+        self.addParameter(QgsProcessingParameterMapLayer('flowaccumulation', 'Precomputed flow accumulation on the DEM grid (skips flow routing)', optional=True, defaultValue=None, types=[QgsProcessing.TypeRaster]))
+        self.addParameter(QgsProcessingParameterFeatureSource('region', 'Outlet points or region of interest (limits the run to its upstream area)', optional=True, types=[QgsProcessing.TypeVectorAnyGeometry]))
         self.addParameter(QgsProcessingParameterRasterDestination('FlowAccumulation', 'Flow Accumulation', createByDefault=True, defaultValue=None))
+        self.addParameter(QgsProcessingParameterNumber('deliveryratio', 'Sediment delivery ratio per cell (sediment flux)', optional=True, type=QgsProcessingParameterNumber.Double, minValue=0, maxValue=1, defaultValue=1))
+        self.addParameter(QgsProcessingParameterBoolean('transportcap', 'Cap sediment flux at the transport capacity', defaultValue=False))
         self.addParameter(QgsProcessingParameterRasterDestination('Usped', 'USPED'))
+        self.addParameter(QgsProcessingParameterEnum('outputencoding', 'Output encoding (16 bit integers read back as floats, a quarter of Float64)', options=ENCODINGS, defaultValue=FLOAT))
+        self.addParameter(QgsProcessingParameterNumber('encodingscale', 'Encoding scale, value per integer step (0 fits it to the first rows of the output)', optional=True, type=QgsProcessingParameterNumber.Double, minValue=0, defaultValue=0))
+        self.addParameter(QgsProcessingParameterNumber('encodingoffset', 'Encoding offset, value of integer 0 (with a given scale)', optional=True, type=QgsProcessingParameterNumber.Double, defaultValue=0))
+        self.addParameter(QgsProcessingParameterFolderDestination('ChunkedStore', 'Chunked store (Zarr) to write outputs into', optional=True, createByDefault=False, defaultValue=None))
+        self.addParameter(QgsProcessingParameterRasterDestination('SedimentFlux', 'Sediment flux', optional=True, createByDefault=False, defaultValue=None))
+        self.addParameter(QgsProcessingParameterFile('checkpointfolder', 'Checkpoint folder (an interrupted run with the same inputs resumes from it)', behavior=QgsProcessingParameterFile.Folder, optional=True, defaultValue=None))
 
     def processAlgorithm(self, parameters, context, model_feedback):
-        # Use a multi-step feedback, so that individual child algorithm progress reports are adjusted for the
-        # overall progress through the model
-        feedback = QgsProcessingMultiStepFeedback(6, model_feedback)
+        # rasters written by this run, removed again if it is canceled
+        self.rasters = []
+        # intermediate rasters, removed when the run ends if not already by the stage graph
+        self.intermediates = []
+        self.checkpoint = None
+        try:
+            results = self.runStages(parameters, context, model_feedback)
+        except (Canceled, QgsProcessingException):
+            # child algorithms report a cancel as an exception
+            # with a checkpoint, what was written is kept for the run resuming from it
+            if self.checkpoint is None:
+                remove_rasters(self.rasters)
+            if not model_feedback.isCanceled():
+                raise
+            if self.checkpoint is None:
+                model_feedback.pushInfo('Canceled, removed intermediate rasters')
+            else:
+                model_feedback.pushInfo('Canceled, completed stages kept in ' + self.checkpoint.folder)
+            return {}
+        finally:
+            if self.checkpoint is None:
+                remove_rasters(self.intermediates)
+        if self.checkpoint is not None:
+            self.checkpoint.clear()
+        return results
+
+    def tempRaster(self, name):
+        if self.checkpoint is not None:
+            path = self.checkpoint.path(name)
+        elif self.plan.in_memory:
+            path = memory_path(name)
+        else:
+            path = QgsProcessingUtils.generateTempFilename(name + '.tif')
+        self.rasters.append(path)
+        self.intermediates.append(path)
+        return path
+
+    def runStages(self, parameters, context, feedback):
         results = {}
-        outputs = {}
 
         # convert to bool
         prevailingRill = self.parameterAsBool(parameters, 'prevailingrill', context)
         feedback.pushConsoleInfo('Prevailing rill? ' + str(prevailingRill))
 
-        # STEP 1: following from http://fatra.cnr.ncsu.edu/~hmitaso/gmslab/denix/usped.html
-        # Slope
-        alg_params = {
-            'INPUT': parameters['filleddem'],
-            'Z_FACTOR': 1,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['Slope'] = processing.run('native:slope', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        # Aspect
-        alg_params = {
-            'INPUT': parameters['filleddem'],
-            'Z_FACTOR': 1,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['Aspect'] = processing.run('native:aspect', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(1)
-        if feedback.isCanceled():
-            return {}
-        feedback.pushConsoleInfo('\n~~~ Step 1: Flow accumulation (area) ~~~\n')
-
-        # Flow Accumulation (Top-Down)
-        alg_params = {
-            'ACCU_MATERIAL': None,
-            'ACCU_TARGET': parameters['filleddem'],
-            'CONVERGENCE': 1.1,
-            'ELEVATION': parameters['filleddem'],
-            'FLOW_UNIT': 1,  # [1] cell area
-            'LINEAR_DIR': None,
-            'LINEAR_DO': False,
-            'LINEAR_MIN': 500,
-            'LINEAR_VAL': None,
-            'METHOD': 4,  # [4] Multiple Flow Direction
-            'NO_NEGATIVES': True,
-            'SINKROUTE': None,
-            'STEP': 1,
-            'VAL_INPUT': None,
-            'WEIGHTS': None,
-            'ACCU_LEFT': QgsProcessing.TEMPORARY_OUTPUT,
-            'ACCU_RIGHT': QgsProcessing.TEMPORARY_OUTPUT,
-            'ACCU_TOTAL': QgsProcessing.TEMPORARY_OUTPUT,
-            'FLOW': parameters['FlowAccumulation'],
-            'FLOW_LENGTH': QgsProcessing.TEMPORARY_OUTPUT,
-            'VAL_MEAN': QgsProcessing.TEMPORARY_OUTPUT,
-            'WEIGHT_LOSS': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['FlowAccumulationTopdown'] = processing.run('saga:flowaccumulationtopdown', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        results['FlowAccumulation'] = outputs['FlowAccumulationTopdown']['FLOW']
-
+        cache = result_cache()
+        demLayer = self.parameterAsRasterLayer(parameters, 'filleddem', context)
+        demSource = layer_source(demLayer)
+        demInfo = raster_info(demSource)
+
+        routingMethod = self.parameterAsEnum(parameters, 'routingmethod', context)
+        convergence = self.parameterAsDouble(parameters, 'convergence', context)
+        reuseGraph = self.parameterAsBool(parameters, 'reuseflowgraph', context)
+        feedback.pushConsoleInfo('Flow routing: ' + ROUTING_METHODS[routingMethod])
+
+        # e.g. from Tiled flow accumulation over a DEM too large for one pass
+        flowLayer = self.parameterAsRasterLayer(parameters, 'flowaccumulation', context)
+        flowSource = layer_source(flowLayer) if flowLayer is not None else None
+        if flowSource is not None:
+            flowInfo = raster_info(flowSource)
+            if flowInfo.shape != demInfo.shape or not np.allclose(flowInfo.geotransform, demInfo.geotransform):
+                raise QgsProcessingException('Precomputed flow accumulation must be on the grid of the DEM')
+
+        # block size, concurrency and where the intermediates live within the memory budget
+        self.plan = plan_memory(demInfo.shape, memory_budget(), routingMethod, USPED_INTERMEDIATES, max_workers())
+        feedback.pushInfo(self.plan.describe())
+        rows = self.plan.block_rows
+
+        # limit the run to the area draining into the outlets or region of interest
+        regionMask = None
+        geometries = region_geometries(self.parameterAsSource(parameters, 'region', context), demLayer.crs(), context)
+
+        # with a checkpoint folder the intermediates are kept there, under the run's inputs and
+        # parameters, so a run stopped part way resumes from its completed stages and row bands
+        checkpointFolder = self.parameterAsFile(parameters, 'checkpointfolder', context)
+        if checkpointFolder:
+            self.checkpoint = self.runCheckpoint(parameters, context, checkpointFolder, geometries)
+            if self.checkpoint is None:
+                feedback.pushWarning('Not checkpointed: a run is keyed by the contents of its input rasters, so all of them must be local files')
+            else:
+                feedback.pushInfo(('Resuming from checkpoint ' if self.checkpoint.resumed else 'Checkpoint ') + self.checkpoint.folder)
+
+        if geometries is not None:
+            regionDem, regionOutput = self.tempRaster('RegionDem'), self.tempRaster('Region')
+            # traced once per checkpoint, like the stages
+            recorded = self.checkpoint.stage('Region') if self.checkpoint is not None else None
+            if recorded and all(os.path.exists(path) for path in recorded):
+                demSource, regionMask = recorded
+                feedback.pushInfo('Upstream area resumed from the checkpoint')
+            else:
+                try:
+                    demSource, regionMask = upstream_region(demSource, geometries, regionDem, regionOutput,
+                                                            routingMethod, convergence, reuseGraph, feedback)
+                except ValueError as e:
+                    raise QgsProcessingException(str(e))
+                if self.checkpoint is not None:
+                    self.checkpoint.complete('Region', [demSource, regionMask])
+            # the clipped DEM is a temporary file, no point keeping its graph
+            reuseGraph = False
+        flowOutput = self.parameterAsOutputLayer(parameters, 'FlowAccumulation', context) or QgsProcessingUtils.generateTempFilename('FlowAccumulation.tif')
+        # with a checkpoint flow accumulation is written in its folder, where a resumed run finds it
+        # again whatever path the output gets this time, and copied to the output at the end
+        flowTarget = self.tempRaster('FlowAccumulation') if self.checkpoint is not None else flowOutput
+        uspedOutput = self.parameterAsOutputLayer(parameters, 'Usped', context)
+        sedimentOutput = self.parameterAsOutputLayer(parameters, 'SedimentFlux', context)
+        self.rasters.extend([flowOutput, uspedOutput])
+
+        # using factor rasters or single values?
+        factors = []
+        factorsFormula = ''
+        for factor in ('kfactor', 'cfactor', 'rfactor'):
+            layer = self.parameterAsRasterLayer(parameters, factor, context)
+            if layer is not None:
+                factors.append(layer_source(layer))
+                factorsFormula += ' * ' + layer.name()
+            else:
+                factors.append(self.parameterAsDouble(parameters, factor + 'singlevalue', context))
+                factorsFormula += ' * ' + str(factors[-1])
+
+        # rill or sheet erosion per cell: everywhere as prevailingrill says, rill where both the
+        # contributing area and slope reach their thresholds, or as a regime raster says
+        regimeMode = self.parameterAsEnum(parameters, 'erosionregime', context)
+        regimeSource = None
+        if regimeMode == REGIME_RASTER:
+            regimeLayer = self.parameterAsRasterLayer(parameters, 'regimeraster', context)
+            if regimeLayer is None:
+                raise QgsProcessingException('The regime raster erosion regime needs a regime raster')
+            regimeSource = layer_source(regimeLayer)
+        feedback.pushConsoleInfo('Erosion regime: ' + REGIMES[regimeMode])
+
+        if regionMask:
+            regionInfo = raster_info(demSource)
+            factors = [clip_raster(f, regionInfo, self.tempRaster('Factor')) if not isinstance(f, float) else f for f in factors]
+            if regimeSource:
+                regimeSource = clip_raster(regimeSource, regionInfo, self.tempRaster('Regime'))
+        regime = ErosionRegime(regimeMode, prevailingRill, self.parameterAsDouble(parameters, 'rillminarea', context),
+                               self.parameterAsDouble(parameters, 'rillminslope', context), regimeSource)
+        feedback.pushConsoleInfo('\nqsx formula: sflowtopo' + factorsFormula + ' * cos(((aspect * -1) + 450) * 0.01745)\n')
+        feedback.pushConsoleInfo('\nqsy formula: sflowtopo' + factorsFormula + ' * sin(((aspect * -1) + 450) * 0.01745)\n')
+
+        # USPED stored as floats, or as scaled 16 bit integers
+        encoding = output_encoding(self.parameterAsEnum(parameters, 'outputencoding', context), self.parameterAsDouble(parameters, 'encodingscale', context),
+                                   self.parameterAsDouble(parameters, 'encodingoffset', context))
+
+        # independent stages run concurrently, each as soon as its inputs are ready, and every
+        # intermediate is removed as soon as the last stage reading it is done
+        stages = StageGraph(feedback, self.plan.workers, self.checkpoint)
+        stages.track(*self.intermediates)
+
+        # following http://fatra.cnr.ncsu.edu/~hmitaso/gmslab/denix/usped.html, see erosion_flow_stages:
+        # STEP 1 slope, aspect and flow accumulation (area) of the DEM, the sediment flux routing over
+        # the same flow graph; STEP 2 sflowtopo; STEP 3 qsx and qsy; STEP 4 and 5 their slopes and
+        # aspects; STEP 6 qsx_dx and qsy_dy; USPED their sum, scaled for sheet erosion
+        if sedimentOutput:
+            self.rasters.append(sedimentOutput)
+        add_terrain_stages(stages, demSource, self.tempRaster, flow_output=flowTarget, aspect=True, graph=bool(sedimentOutput),
+                           flow_source=flowSource, method=routingMethod, convergence=convergence, reuse_graph=reuseGraph,
+                           block_rows=rows, cache=cache, checkpoint=self.checkpoint)
+        add_usped_stages(stages, self.tempRaster, factors, uspedOutput, regime, regionMask, encoding, sedimentOutput,
+                         self.parameterAsDouble(parameters, 'deliveryratio', context), self.parameterAsBool(parameters, 'transportcap', context),
+                         rows, self.checkpoint)
 
         feedback.pushConsoleInfo('\n~~~~~~~~~~~~~~~~ USPED START ~~~~~~~~~~~~~~~~\n')
-
-        # STEP 2: following from http://fatra.cnr.ncsu.edu/~hmitaso/gmslab/denix/usped.html
-        feedback.setCurrentStep(2)
-        if feedback.isCanceled():
-            return {}
-        feedback.pushConsoleInfo('\n~~~ Step 2: sflowtopo ~~~\n')
-        # sflowtopo = Pow([flowacc] * resolution , 0.6) * Pow(Sin([slope] * 0.01745) , 1.3))
-        # Note: flow accumulation already calculates area so no need for resolution
-        if prevailingRill: formula = 'pow(A, 0.6) * pow(sin(B * 0.01745), 1.3)'
-        else: formula = 'A * sin(B * 0.01745)'
-        alg_params = {
-            'BAND_A': 1,
-            'BAND_B': 1,
-            'BAND_C': 1,
-            'BAND_D': 1,
-            'BAND_E': None,
-            'BAND_F': None,
-            'EXTRA': '',
-            'FORMULA': formula,
-            'INPUT_A': outputs['FlowAccumulationTopdown']['FLOW'],
-            'INPUT_B': outputs['Slope']['OUTPUT'],
-            'INPUT_C': None,
-            'INPUT_D': None,
-            'INPUT_E': None,
-            'INPUT_F': None,
-            'NO_DATA': None,
-            'OPTIONS': '',
-            'RTYPE': 6,  # Float64
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['sflowtopo'] = processing.run('gdal:rastercalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        # STEP 3: following from http://fatra.cnr.ncsu.edu/~hmitaso/gmslab/denix/usped.html
-        feedback.setCurrentStep(3)
-        if feedback.isCanceled():
-            return {}
-          
-        # using consts or parameters?
-        if parameters['kfactor'] is not None: Kfactor = 'B*'
-        else: Kfactor = str(parameters['kfactorsinglevalue'])+'*'
-        if parameters['cfactor'] is not None: Cfactor = 'C*'
-        else: Cfactor = str(parameters['cfactorsinglevalue'])+'*'
-        if parameters['rfactor'] is not None: Rfactor = 'D'
-        else: Rfactor = str(parameters['rfactorsinglevalue'])
-        factorsFormula = Kfactor + Cfactor + Rfactor
-        
-        # qsx = [sflowtopo] * [kfac] * [cfac] * R * Cos((([aspect] *  (-1)) + 450) * .01745)
-        formula = 'E *' + factorsFormula + ' * cos(((F * -1) + 450) * 0.01745)'
-        feedback.pushConsoleInfo('\nqsx formula: ' + formula + '\n')
-        alg_params = {
-            'BAND_A': 1,
-            'BAND_B': 1,
-            'BAND_C': 1,
-            'BAND_D': 1,
-            'BAND_E': None,
-            'BAND_F': None,
-            'EXTRA': '',
-            'FORMULA': formula,
-            'INPUT_A': parameters['filleddem'],
-            'INPUT_B': parameters['kfactor'],
-            'INPUT_C': parameters['cfactor'],
-            'INPUT_D': parameters['rfactor'],
-            'INPUT_E': outputs['sflowtopo']['OUTPUT'],
-            'INPUT_F': outputs['Aspect']['OUTPUT'],
-            'NO_DATA': None,
-            'OPTIONS': '',
-            'RTYPE': 6,  # Float64
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['qsx'] = processing.run('gdal:rastercalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-
-        # qsy = [sflowtopo] * [kfac] * [cfac] * 280 * Sin((([aspect] *  (-1)) + 450) * .01745)
-        formula = 'E *' + factorsFormula + ' * sin(((F * -1) + 450) * 0.01745)'
-        feedback.pushConsoleInfo('\nqsy formula: ' + formula + '\n')
-        alg_params = {
-            'BAND_A': 1,
-            'BAND_B': 1,
-            'BAND_C': 1,
-            'BAND_D': 1,
-            'BAND_E': None,
-            'BAND_F': None,
-            'EXTRA': '',
-            'FORMULA': formula,
-            'INPUT_A': parameters['filleddem'],
-            'INPUT_B': parameters['kfactor'],
-            'INPUT_C': parameters['cfactor'],
-            'INPUT_D': parameters['rfactor'],
-            'INPUT_E': outputs['sflowtopo']['OUTPUT'],
-            'INPUT_F': outputs['Aspect']['OUTPUT'],
-            'NO_DATA': None,
-            'OPTIONS': '',
-            'RTYPE': 6,  # Float64
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['qsy'] = processing.run('gdal:rastercalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        results['Usped'] = outputs['qsy']['OUTPUT']
-        
-
-        # STEP 4: following from http://fatra.cnr.ncsu.edu/~hmitaso/gmslab/denix/usped.html
-        feedback.setCurrentStep(4)
-        if feedback.isCanceled():
-            return {}
-        feedback.pushConsoleInfo('\n~~~ Step 4: Slope and aspect of qsx and qy ~~~\n')
-        # Slope qsx
-        alg_params = {
-            'INPUT': outputs['qsx']['OUTPUT'],
-            'Z_FACTOR': 1,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['qsxSlope'] = processing.run('native:slope', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        # Aspect qsx
-        alg_params = {
-            'INPUT': outputs['qsx']['OUTPUT'],
-            'Z_FACTOR': 1,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['qsxAspect'] = processing.run('native:aspect', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        # STEP 5: following from http://fatra.cnr.ncsu.edu/~hmitaso/gmslab/denix/usped.html
-        feedback.setCurrentStep(5)
-        if feedback.isCanceled():
-            return {}
-        # Slope qsy
-        alg_params = {
-            'INPUT': outputs['qsy']['OUTPUT'],
-            'Z_FACTOR': 1,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['qsySlope'] = processing.run('native:slope', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        # Aspect qsy
-        alg_params = {
-            'INPUT': outputs['qsy']['OUTPUT'],
-            'Z_FACTOR': 1,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['qsyAspect'] = processing.run('native:aspect', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        # STEP 6: following from http://fatra.cnr.ncsu.edu/~hmitaso/gmslab/denix/usped.html
-        feedback.setCurrentStep(6)
-        if feedback.isCanceled():
-            return {}
-        feedback.pushConsoleInfo('\n~~~ Step 6: Calculated and add qsx_dx and qsy_dy ~~~\n')
-        # qsx_dx = Cos((([qsx_aspect] * (-1)) + 450) * .01745) * Tan([qsx_slope] * .01745)
-        alg_params = {
-            'BAND_A': 1,
-            'BAND_B': 1,
-            'BAND_C': 1,
-            'BAND_D': 1,
-            'BAND_E': None,
-            'BAND_F': None,
-            'EXTRA': '',
-            'FORMULA': 'cos(((A * -1) + 450) * .01745) * tan(B * .01745)',
-            'INPUT_A': outputs['qsxAspect']['OUTPUT'],
-            'INPUT_B': outputs['qsxSlope']['OUTPUT'],
-            'INPUT_C': None,
-            'INPUT_D': None,
-            'INPUT_E': None,
-            'INPUT_F': None,
-            'NO_DATA': None,
-            'OPTIONS': '',
-            'RTYPE': 6,  # Float64
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['qsx_dx'] = processing.run('gdal:rastercalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-
-        # qsy_dy =  Sin((([qsy_aspect] * (-1)) + 450) * .01745) * Tan([qsy_slope] * .01745)
-        alg_params = {
-            'BAND_A': 1,
-            'BAND_B': 1,
-            'BAND_C': 1,
-            'BAND_D': 1,
-            'BAND_E': None,
-            'BAND_F': None,
-            'EXTRA': '',
-            'FORMULA': 'sin(((A * -1) + 450) * .01745) * tan(B * .01745)',
-            'INPUT_A': outputs['qsyAspect']['OUTPUT'],
-            'INPUT_B': outputs['qsySlope']['OUTPUT'],
-            'INPUT_C': None,
-            'INPUT_D': None,
-            'INPUT_E': None,
-            'INPUT_F': None,
-            'NO_DATA': None,
-            'OPTIONS': '',
-            'RTYPE': 6,  # Float32
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['qsy_dy'] = processing.run('gdal:rastercalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.pushConsoleInfo('\n~~~ Final USPED Addition ~~~\n')
-
-        # USPED = [qsx_dx] + [qsy_dy]  -> for prevailing rill erosion
-        # USPED = ([qsx_dx] + [qsy_dy]) * 10.  -> for prevailing sheet erosion
-        if prevailingRill: formula = 'A + B'
-        else: formula = '(A + B) * 10'
-        alg_params = {
-            'BAND_A': 1,
-            'BAND_B': 1,
-            'BAND_C': 1,
-            'BAND_D': 1,
-            'BAND_E': None,
-            'BAND_F': None,
-            'EXTRA': '',
-            'FORMULA': formula,
-            'INPUT_A': outputs['qsx_dx']['OUTPUT'],
-            'INPUT_B': outputs['qsy_dy']['OUTPUT'],
-            'INPUT_C': None,
-            'INPUT_D': None,
-            'INPUT_E': None,
-            'INPUT_F': None,
-            'NO_DATA': None,
-            'OPTIONS': '',
-            'RTYPE': 6,  # Float64
-            'OUTPUT': parameters['Usped'],
-        }
-        outputs['Usped'] = processing.run('gdal:rastercalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        results['Usped'] = outputs['Usped']['OUTPUT']
+        outputs = stages.run()
+        feedback.pushInfo(stages.usage())
+        results['FlowAccumulation'] = outputs['FlowAccumulation']
+        results['Usped'] = outputs['Usped']
+        if sedimentOutput:
+            results['SedimentFlux'] = outputs['SedimentFlux']
+        # outputs completed by an earlier attempt are copied to where this run writes them
+        for name, output in (('FlowAccumulation', flowOutput), ('Usped', uspedOutput), ('SedimentFlux', sedimentOutput)):
+            if name in results and results[name] != output:
+                results[name] = copy_raster(results[name], output)
+
+        # USPED and flow accumulation into the chunked store, at their place in its grid (the DEM's when created)
+        storePath = self.parameterAsString(parameters, 'ChunkedStore', context)
+        if storePath:
+            try:
+                results['ChunkedStore'] = store_outputs(storePath, demInfo, {'usped': results['Usped'], 'flowaccumulation': results['FlowAccumulation']}, feedback)
+            except ValueError as e:
+                raise QgsProcessingException(str(e))
 
         feedback.pushConsoleInfo('\n~~~ Output USPED ~~~\n')
 
@@ -330,6 +271,28 @@ class USPED(QgsProcessingAlgorithm):
 
         return results
 
+    def runCheckpoint(self, parameters, context, folder, geometries):
+        """
+        The checkpoint of this run in folder, keyed by its input rasters and
+        parameters, None if an input raster is not a local file.
+        """
+        sources = []
+        for name in ('filleddem', 'kfactor', 'cfactor', 'rfactor', 'regimeraster', 'flowaccumulation'):
+            layer = self.parameterAsRasterLayer(parameters, name, context)
+            source = layer_source(layer) if layer is not None else None
+            if source is not None and not (isinstance(source, str) and os.path.isfile(source)):
+                return None
+            sources.append(source)
+        params = {'geometries': geometries}
+        for name in ('kfactorsinglevalue', 'cfactorsinglevalue', 'rfactorsinglevalue', 'rillminarea', 'rillminslope', 'convergence', 'deliveryratio', 'encodingscale', 'encodingoffset'):
+            params[name] = self.parameterAsDouble(parameters, name, context)
+        for name in ('erosionregime', 'routingmethod', 'outputencoding'):
+            params[name] = self.parameterAsEnum(parameters, name, context)
+        for name in ('prevailingrill', 'transportcap'):
+            params[name] = self.parameterAsBool(parameters, name, context)
+        params['sedimentflux'] = bool(self.parameterAsOutputLayer(parameters, 'SedimentFlux', context))
+        return Checkpoint(folder, run_key(self.name(), sources, params, folder))
+
     def name(self):
         return 'USPED'
 
@@ -352,3 +315,4 @@ class OutputRenamer (QgsProcessingLayerPostProcessorInterface):
         
     def postProcessLayer(self, layer, context, feedback):
         layer.setName(self.name)
+        apply_default_style(layer, diverging=True)
@@ -0,0 +1,169 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+
+ Library API: flow accumulation, slope, aspect, LS, RUSLE and USPED of a
+ DEM held as a NumPy array, with its GDAL style geotransform. Needs only
+ NumPy, so it imports without QGIS or GDAL, e.g. in web backends or Dask
+ workers:
+
+     from erosion_flow.erosion_flow_api import rusle
+     soil_loss = rusle(dem, geotransform, k=0.05, c=0.5, r=750)
+
+ Arrays are float with NaN for nodata; factors are arrays of the DEM's
+ shape or numbers. For a DEM in a geographic CRS (degrees) give ellipsoid,
+ e.g. WGS84, and cell sizes and areas are computed in metres per row. Functions computing from flow accumulation take it as
+ flow when the caller already has it, or all DEM terms at once as topo (a
+ Topography) for repeated runs on one DEM with other factors. feedback is
+ optional, any object with isCanceled() and setProgress() such as a QGIS
+ processing feedback.
+ The processing algorithms run the same functions, the raster ones block
+ by block.
+"""
+
+import numpy as np
+
+from .erosion_flow_engine import SubFeedback
+from .erosion_flow_engine import ls_factor, rusle as rusle_formula, usped as usped_formula
+from .erosion_flow_engine import sediment_flow, sediment_flux_x, sediment_flux_y, flux_change_x, flux_change_y
+from .erosion_flow_terrain import slope as padded_slope, aspect as padded_aspect
+from .erosion_flow_routing import D8, DINF, MFD, build_flow_graph, accumulate
+from .erosion_flow_geodesy import WGS84, row_cell_sizes, row_cell_areas
+
+__all__ = ['D8', 'DINF', 'MFD', 'WGS84', 'cell_size', 'cell_area', 'flow_accumulation', 'slope', 'aspect', 'Topography', 'topography',
+           'ls', 'rusle', 'usped']
+
+
+def cell_size(geotransform, rows=None, ellipsoid=None):
+    """
+    (x, y) cell dimensions in map units of a geotransform, or with
+    ellipsoid in metres per row of a geographic DEM of rows rows, as
+    (rows, 1) columns.
+    """
+    if ellipsoid is not None:
+        return row_cell_sizes(geotransform, rows, ellipsoid)
+    return (abs(geotransform[1]), abs(geotransform[5]))
+
+
+def cell_area(geotransform, rows=None, ellipsoid=None):
+    """
+    Cell area in map units, or with ellipsoid in square metres per row, as cell_size.
+    """
+    if ellipsoid is not None:
+        return row_cell_areas(geotransform, rows, ellipsoid)
+    return abs(geotransform[1] * geotransform[5])
+
+
+def _padded(array):
+    return np.pad(array, 1, constant_values=np.nan)
+
+
+def flow_accumulation(dem, geotransform, method=MFD, convergence=1.1, weight=None, graph=None, feedback=None,
+                      ellipsoid=None):
+    """
+    Upslope contributing area (cell area units) of a filled DEM, NaN on
+    nodata. weight (optional) multiplies each cell's area; graph is the
+    DEM's flow graph (see erosion_flow_routing) when the caller has it.
+    """
+    dem = np.asarray(dem, dtype=np.float64)
+    nodata = np.isnan(dem)
+    if graph is None:
+        graph = build_flow_graph(dem, cell_size(geotransform, dem.shape[0], ellipsoid), method, convergence,
+                                 SubFeedback(feedback, 0, 70))
+    cells = np.where(nodata, 0, cell_area(geotransform, dem.shape[0], ellipsoid))
+    if weight is not None:
+        cells = cells * np.nan_to_num(weight)
+    flow = accumulate(graph, cells, SubFeedback(feedback, 70, 100))
+    flow[nodata] = np.nan
+    return flow
+
+
+def slope(dem, geotransform, z_factor=1.0, ellipsoid=None):
+    """
+    Slope in degrees, as native:slope.
+    """
+    return padded_slope(_padded(np.asarray(dem, dtype=np.float64)), cell_size(geotransform, np.shape(dem)[0], ellipsoid), z_factor)
+
+
+def aspect(dem, geotransform, z_factor=1.0, ellipsoid=None):
+    """
+    Aspect in degrees clockwise from north, NaN on flats, as native:aspect.
+    """
+    return padded_aspect(_padded(np.asarray(dem, dtype=np.float64)), cell_size(geotransform, np.shape(dem)[0], ellipsoid), z_factor)
+
+
+class Topography(object):
+    """
+    The DEM terms every model starts from: flow accumulation, slope and
+    aspect arrays, with the cell size they were computed at (see cell_size).
+    """
+
+    def __init__(self, flow, slope, aspect, cell_size):
+        self.flow = flow
+        self.slope = slope
+        self.aspect = aspect
+        self.cell_size = cell_size
+
+    @property
+    def nbytes(self):
+        return self.flow.nbytes + self.slope.nbytes + self.aspect.nbytes
+
+
+def topography(dem, geotransform, method=MFD, convergence=1.1, flow=None, graph=None, feedback=None, ellipsoid=None):
+    """
+    Topography of a DEM, to run several models or factor sets on it.
+    """
+    if flow is None:
+        flow = flow_accumulation(dem, geotransform, method, convergence, graph=graph, feedback=feedback, ellipsoid=ellipsoid)
+    with np.errstate(invalid='ignore'):
+        return Topography(flow, slope(dem, geotransform, ellipsoid=ellipsoid), aspect(dem, geotransform, ellipsoid=ellipsoid),
+                          cell_size(geotransform, np.shape(dem)[0], ellipsoid))
+
+
+def ls(dem, geotransform, m=0.5, n=1.1, method=MFD, convergence=1.1, flow=None, feedback=None, topo=None,
+       ellipsoid=None):
+    """
+    LS factor from upslope contributing area, Moore & Burch (1986).
+    """
+    if topo is None and flow is None:
+        flow = flow_accumulation(dem, geotransform, method, convergence, feedback=feedback, ellipsoid=ellipsoid)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if topo is not None:
+            return ls_factor(topo.flow, topo.slope, m, n)
+        return ls_factor(flow, slope(dem, geotransform, ellipsoid=ellipsoid), m, n)
+
+
+def rusle(dem, geotransform, k=0.05, c=0.5, r=750, m=0.5, n=1.1, method=MFD, convergence=1.1, flow=None, feedback=None,
+          topo=None, ellipsoid=None):
+    """
+    RUSLE soil loss LS * K * C * R.
+    """
+    return rusle_formula(ls(dem, geotransform, m, n, method, convergence, flow, feedback, topo, ellipsoid), k, c, r)
+
+
+def usped(dem, geotransform, k=0.05, c=0.5, r=750, rill=True, method=MFD, convergence=1.1, flow=None, feedback=None,
+          topo=None, ellipsoid=None):
+    """
+    USPED net erosion (negative) or deposition (positive), following the
+    steps of the USPED algorithm. rill is True for prevailing rill erosion,
+    False for sheet erosion, or a boolean array choosing per cell.
+    """
+    if topo is None:
+        topo = topography(dem, geotransform, method, convergence, flow, feedback=feedback, ellipsoid=ellipsoid)
+    size = topo.cell_size
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dem_aspect = topo.aspect
+        sflow = sediment_flow(topo.flow, topo.slope, rill)
+        qsx = sediment_flux_x(sflow, k, c, r, dem_aspect)
+        qsy = sediment_flux_y(sflow, k, c, r, dem_aspect)
+        dx = flux_change_x(padded_aspect(_padded(qsx), size), padded_slope(_padded(qsx), size))
+        dy = flux_change_y(padded_aspect(_padded(qsy), size), padded_slope(_padded(qsy), size))
+        return usped_formula(dx, dy, rill)
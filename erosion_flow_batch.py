@@ -0,0 +1,215 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from qgis.core import QgsProcessing
+from qgis.core import QgsProcessingAlgorithm
+from qgis.core import QgsProcessingException
+from qgis.core import QgsProcessingParameterMapLayer
+from qgis.core import QgsProcessingParameterFeatureSource
+from qgis.core import QgsProcessingParameterNumber
+from qgis.core import QgsProcessingParameterEnum
+from qgis.core import QgsProcessingParameterBoolean
+from qgis.core import QgsProcessingParameterFolderDestination
+from qgis.core import QgsProcessingParameterFeatureSink
+from qgis.core import QgsCoordinateTransform
+from qgis.core import QgsFeature
+from qgis.core import QgsFeatureSink
+from qgis.core import QgsField
+from qgis.PyQt.QtCore import QVariant
+
+from .erosion_flow_layers import layer_source
+from .erosion_flow_engine import Canceled, check_canceled
+from .erosion_flow_raster import read_raster, read_window, window_info, rasterize_wkt, write_raster
+from .erosion_flow_routing import ROUTING_METHODS, MFD, flow_receivers, donor_index, upstream_cells
+from .erosion_flow_settings import max_workers, memory_budget
+from .erosion_flow_memory import window_workers
+from .erosion_flow_stages import dilate, REGION_MARGIN
+from .erosion_flow_api import rusle, usped
+
+MODELS = ['RUSLE', 'USPED']
+
+
+class ParcelBatch(QgsProcessingAlgorithm):
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterMapLayer('filleddem', 'Filled sinks DEM', defaultValue=None, types=[QgsProcessing.TypeRaster]))
+        self.addParameter(QgsProcessingParameterFeatureSource('parcels', 'Parcels', types=[QgsProcessing.TypeVectorPolygon]))
+        self.addParameter(QgsProcessingParameterEnum('model', 'Model', options=MODELS, defaultValue=1))
+        self.addParameter(QgsProcessingParameterMapLayer('kfactor', 'K factor raster', optional=True, defaultValue=None, types=[QgsProcessing.TypeRaster]))
+        self.addParameter(QgsProcessingParameterMapLayer('cfactor', 'C factor raster', optional=True, defaultValue=None, types=[QgsProcessing.TypeRaster]))
+        self.addParameter(QgsProcessingParameterMapLayer('rfactor', 'R factor raster', optional=True, defaultValue=None, types=[QgsProcessing.TypeRaster]))
+        self.addParameter(QgsProcessingParameterNumber('kfactorsinglevalue', 'K factor single value', optional=True, type=QgsProcessingParameterNumber.Double, defaultValue=0.05))
+        self.addParameter(QgsProcessingParameterNumber('cfactorsinglevalue', 'C factor single value', optional=True, type=QgsProcessingParameterNumber.Double, defaultValue=0.5))
+        self.addParameter(QgsProcessingParameterNumber('rfactorsinglevalue', 'R factor single value', optional=True, type=QgsProcessingParameterNumber.Double, defaultValue=750))
+        self.addParameter(QgsProcessingParameterNumber('lssheetfactor', 'LS sheet factor (RUSLE)', optional=True, type=QgsProcessingParameterNumber.Double, minValue=0.4, maxValue=0.6, defaultValue=0.5))
+        self.addParameter(QgsProcessingParameterNumber('lsrillfactor', 'LS rill factor (RUSLE)', optional=True, type=QgsProcessingParameterNumber.Double, minValue=1, maxValue=1.3, defaultValue=1.1))
+        self.addParameter(QgsProcessingParameterBoolean('prevailingrill', 'Prevailing rill erosion (USPED, unchecked for sheet)', defaultValue=True))
+        self.addParameter(QgsProcessingParameterEnum('routingmethod', 'Flow routing method', options=ROUTING_METHODS, defaultValue=MFD))
+        self.addParameter(QgsProcessingParameterNumber('convergence', 'MFD convergence factor', optional=True, type=QgsProcessingParameterNumber.Double, minValue=0, defaultValue=1.1))
+        self.addParameter(QgsProcessingParameterFolderDestination('OUTPUT_FOLDER', 'Parcel rasters folder'))
+        self.addParameter(QgsProcessingParameterFeatureSink('SUMMARY', 'Parcel summary', type=QgsProcessing.TypeVectorPolygon))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        model = self.parameterAsEnum(parameters, 'model', context)
+        demLayer = self.parameterAsRasterLayer(parameters, 'filleddem', context)
+        parcels = self.parameterAsSource(parameters, 'parcels', context)
+        if parcels is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, 'parcels'))
+        folder = self.parameterAsString(parameters, 'OUTPUT_FOLDER', context)
+        os.makedirs(folder, exist_ok=True)
+
+        settings = {
+            'model': model,
+            'm': self.parameterAsDouble(parameters, 'lssheetfactor', context),
+            'n': self.parameterAsDouble(parameters, 'lsrillfactor', context),
+            'rill': self.parameterAsBool(parameters, 'prevailingrill', context),
+            'method': self.parameterAsEnum(parameters, 'routingmethod', context),
+            'convergence': self.parameterAsDouble(parameters, 'convergence', context),
+        }
+        factors = []
+        for factor in ('kfactor', 'cfactor', 'rfactor'):
+            layer = self.parameterAsRasterLayer(parameters, factor, context)
+            if layer is not None:
+                factors.append(layer_source(layer))
+            else:
+                factors.append(self.parameterAsDouble(parameters, factor + 'singlevalue', context))
+
+        fields = parcels.fields()
+        for name, fieldType in (('cells', QVariant.Int), ('mean', QVariant.Double), ('min', QVariant.Double),
+                                ('max', QVariant.Double), ('sum', QVariant.Double), ('raster', QVariant.String)):
+            fields.append(QgsField(name, fieldType))
+        (sink, destId) = self.parameterAsSink(parameters, 'SUMMARY', context, fields, parcels.wkbType(), parcels.sourceCrs())
+        if sink is None:
+            raise QgsProcessingException(self.invalidSinkError(parameters, 'SUMMARY'))
+
+        # receivers over the whole DEM, only used to trace contributing areas
+        feedback.pushInfo('Tracing contributing areas with ' + ROUTING_METHODS[settings['method']])
+        dem, info = read_raster(layer_source(demLayer))
+        receivers = flow_receivers(dem, info.cell_sizes(), settings['method'], settings['convergence'], feedback)[0]
+        donors = donor_index(receivers)
+        visited = np.zeros(dem.size, dtype=bool)
+        receivers = None
+
+        transform = QgsCoordinateTransform(parcels.sourceCrs(), demLayer.crs(), context.transformContext())
+        jobs = []
+        for feature in parcels.getFeatures():
+            if feedback.isCanceled():
+                return {}
+            geometry = feature.geometry()
+            geometry.transform(transform)
+            burned = rasterize_wkt(geometry.asWkt(), info)
+            if burned is None:
+                feedback.pushInfo('Parcel {} is outside the DEM, skipped'.format(feature.id()))
+                continue
+            parcelRow, parcelCol, parcelMask = burned
+            if not parcelMask.any():
+                continue
+            # cells next to the parcel feed the USPED flux divergence of its edge cells
+            rows, cols = np.nonzero(dilate(np.pad(parcelMask, 1)))
+            rows, cols = rows + parcelRow - 1, cols + parcelCol - 1
+            inside = (rows >= 0) & (rows < info.ysize) & (cols >= 0) & (cols < info.xsize)
+            upstream = upstream_cells(donors, rows[inside] * info.xsize + cols[inside], visited)
+            upRows, upCols = upstream // info.xsize, upstream % info.xsize
+            window = (max(int(upRows.min()) - REGION_MARGIN, 0), max(int(upCols.min()) - REGION_MARGIN, 0),
+                      min(int(upRows.max()) + REGION_MARGIN + 1, info.ysize), min(int(upCols.max()) + REGION_MARGIN + 1, info.xsize))
+            jobs.append((feature, window, (parcelRow, parcelCol), parcelMask))
+        donors = visited = None
+
+        # as many parcels at once as the largest window allows within the memory budget
+        largest = max([(w[2] - w[0]) * (w[3] - w[1]) for _, w, _, _ in jobs] or [0])
+        workers = window_workers(largest, memory_budget(), settings['method'], max_workers())
+        feedback.pushInfo('{} parcels on {} workers'.format(len(jobs), workers))
+        done = 0
+        pending = set()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for job in jobs:
+                future = pool.submit(self.processParcel, job, dem, info, factors, settings, folder, feedback)
+                futures[future] = job[0]
+                pending.add(future)
+            try:
+                while pending:
+                    finished, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                    check_canceled(feedback)
+                    for future in finished:
+                        stats, path = future.result()
+                        feature = futures[future]
+                        summary = QgsFeature(fields)
+                        summary.setGeometry(feature.geometry())
+                        summary.setAttributes(feature.attributes() + stats + [path])
+                        sink.addFeature(summary, QgsFeatureSink.FastInsert)
+                        done += 1
+                        feedback.setProgress(100.0 * done / len(jobs))
+            except Canceled:
+                for future in pending:
+                    future.cancel()
+                return {}
+
+        return {'OUTPUT_FOLDER': folder, 'SUMMARY': destId}
+
+    def processParcel(self, job, dem, info, factors, settings, folder, feedback):
+        """
+        Runs the model on the window holding a parcel and its contributing
+        area, writes the parcel raster and returns its summary statistics.
+        """
+        feature, (row, col, rowEnd, colEnd), (parcelRow, parcelCol), parcelMask = job
+        check_canceled(feedback)
+        windowDem = dem[row:rowEnd, col:colEnd]
+        values = [read_window(f, row, col, rowEnd - row, colEnd - col) if not isinstance(f, float) else f for f in factors]
+        # the window's own geotransform: cell sizes of geographic DEMs depend on its latitude
+        windowTransform = window_info(info, row, col, rowEnd - row, colEnd - col).geotransform
+        if settings['model'] == 0:
+            result = rusle(windowDem, windowTransform, *values, m=settings['m'], n=settings['n'],
+                           method=settings['method'], convergence=settings['convergence'], ellipsoid=info.ellipsoid)
+        else:
+            result = usped(windowDem, windowTransform, *values, rill=settings['rill'],
+                           method=settings['method'], convergence=settings['convergence'], ellipsoid=info.ellipsoid)
+        check_canceled(feedback)
+
+        # crop to the parcel envelope, nodata outside the parcel
+        top, left = parcelRow - row, parcelCol - col
+        parcel = result[top:top + parcelMask.shape[0], left:left + parcelMask.shape[1]]
+        parcelMask = parcelMask[:parcel.shape[0], :parcel.shape[1]]
+        parcel = np.where(parcelMask, parcel, np.nan)
+        path = os.path.join(folder, 'parcel_{}.tif'.format(feature.id()))
+        write_raster(path, parcel, window_info(info, parcelRow, parcelCol, parcel.shape[0], parcel.shape[1]))
+
+        valid = parcel[~np.isnan(parcel)]
+        if not valid.size:
+            return [0, None, None, None, None], path
+        return [int(valid.size), float(valid.mean()), float(valid.min()), float(valid.max()), float(valid.sum())], path
+
+    def name(self):
+        return 'ParcelBatch'
+
+    def displayName(self):
+        return 'Parcel batch (RUSLE / USPED)'
+
+    def group(self):
+        return ''
+
+    def groupId(self):
+        return ''
+
+    def shortHelpString(self):
+        return ('Runs RUSLE or USPED for every polygon of a parcel layer. Each parcel is computed on the smallest '
+                'DEM window holding it and its upstream contributing area, on a pool of workers, and written '
+                'as parcel_<id>.tif to the output folder together with a summary layer of per-parcel statistics.')
+
+    def createInstance(self):
+        return ParcelBatch()
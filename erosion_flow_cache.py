@@ -0,0 +1,188 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+
+ Content-addressed on-disk cache for intermediate rasters (slope, aspect,
+ flow accumulation) that persists between QGIS sessions.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+CACHEABLE_EXTENSIONS = ('.tif', '.tiff')
+
+HASH_INDEX = 'content_hashes.json'
+
+HASH_CHUNK = 8 * 1024 * 1024
+
+# part of every key: raised when stage results change for the same inputs
+# (2: geographic DEMs computed with cell sizes in metres)
+KEY_VERSION = 2
+
+
+def _read_index(directory):
+    try:
+        with open(os.path.join(directory, HASH_INDEX)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def content_hash(source, directory, lock):
+    """
+    SHA-256 of a file, memoised in directory by path, size and modification
+    time so unchanged inputs are only read once. lock guards the index.
+    """
+    stat = os.stat(source)
+    stamp = '{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+    source = os.path.abspath(source)
+    with lock:
+        known = _read_index(directory).get(source)
+    if known and known[0] == stamp:
+        return known[1]
+    digest = hashlib.sha256()
+    with open(source, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+    with lock:
+        index = _read_index(directory)
+        index[source] = [stamp, digest.hexdigest()]
+        with open(os.path.join(directory, HASH_INDEX), 'w') as f:
+            json.dump(index, f)
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    """
+    Files keyed by a hash of their input raster contents and parameters,
+    evicted least recently used first once over max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def content_hash(self, source):
+        return content_hash(source, self.directory, self._lock)
+
+    def key(self, stage, sources, params):
+        """
+        Cache key of a stage, None if any source is not a local file
+        (such as a raster read through a QGIS data provider).
+        """
+        if not all(isinstance(source, str) and os.path.isfile(source) for source in sources):
+            return None
+        digest = hashlib.sha256(stage.encode('utf-8'))
+        digest.update(str(KEY_VERSION).encode('ascii'))
+        for source in sources:
+            digest.update(self.content_hash(source).encode('ascii'))
+        digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+
+    def fetch(self, key, output):
+        """
+        Copies a cached result to output, returns False on a miss.
+        """
+        entry = self._entry(key, os.path.splitext(output)[1].lower())
+        if not os.path.isfile(entry):
+            return False
+        shutil.copyfile(entry, output)
+        os.utime(entry)
+        return True
+
+    def store(self, key, path):
+        partial = self._entry(key, '.part')
+        shutil.copyfile(path, partial)
+        os.replace(partial, self._entry(key, os.path.splitext(path)[1].lower()))
+        self.evict()
+
+    def entries(self):
+        found = []
+        for name in os.listdir(self.directory):
+            if os.path.splitext(name)[1] in CACHEABLE_EXTENSIONS:
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                found.append((stat.st_mtime, stat.st_size, path))
+        return sorted(found)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        with self._lock:
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                os.remove(path)
+                total -= size
+
+    def purge(self):
+        with self._lock:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            os.makedirs(self.directory, exist_ok=True)
+
+
+def _output_key(cache, stage, sources, params, output):
+    """
+    Cache key of output of a stage, None when it cannot be cached.
+    """
+    if cache is None or os.path.splitext(output)[1].lower() not in CACHEABLE_EXTENSIONS:
+        return None
+    # in-memory (GDAL /vsimem/) outputs are not files to copy
+    if not os.path.isdir(os.path.dirname(output)):
+        return None
+    return cache.key(stage, sources, params)
+
+
+def run_cached(cache, stage, sources, params, output, compute, feedback=None):
+    """
+    Produces output with compute(output), or copies it from the cache when
+    the same stage already ran on identical inputs. Returns the output path.
+    """
+    key = _output_key(cache, stage, sources, params, output)
+    if key is None:
+        return compute(output)
+    if cache.fetch(key, output):
+        if feedback is not None:
+            feedback.pushConsoleInfo('Cached result used for ' + stage)
+        return output
+    result = compute(output)
+    cache.store(key, result)
+    return result
+
+
+def run_cached_outputs(cache, stages, sources, params, outputs, compute, feedback=None):
+    """
+    run_cached for a compute(outputs) producing the outputs of several
+    stages in one pass: they are copied from the cache only when all of
+    them are there, and stored each under its stage.
+    """
+    keys = [_output_key(cache, stage, sources, params, output) for stage, output in zip(stages, outputs)]
+    if None in keys:
+        return compute(outputs)
+    if all(cache.fetch(key, output) for key, output in zip(keys, outputs)):
+        if feedback is not None:
+            feedback.pushConsoleInfo('Cached result used for ' + ', '.join(stages))
+        return outputs
+    results = compute(outputs)
+    for key, result in zip(keys, results):
+        cache.store(key, result)
+    return results
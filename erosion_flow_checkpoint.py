@@ -0,0 +1,129 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+
+ Checkpoints of long runs on large DEMs. A run keyed by the contents of its
+ input rasters and its parameters keeps its intermediate rasters in its own
+ folder, with a manifest of the stages completed and of the row bands
+ already written into rasters still being computed. Running it again with
+ the same inputs and parameters, after a crash, a cancel or a preempted
+ machine, skips the completed stages and continues half written rasters
+ from their last completed row band.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+from .erosion_flow_cache import KEY_VERSION, content_hash
+
+MANIFEST = 'manifest.json'
+
+
+class Checkpoint(object):
+    """
+    The checkpoint folder of one run, a subfolder of directory named by its
+    key. Safe to update from the stages running in parallel.
+    """
+
+    def __init__(self, directory, key):
+        self.directory = directory
+        self.key = key
+        self.folder = os.path.join(directory, key[:24])
+        self._lock = threading.Lock()
+        self._names = {}
+        os.makedirs(self.folder, exist_ok=True)
+        self.manifest = self._load()
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.folder, MANIFEST)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        if manifest.get('key') != self.key:
+            manifest = {'key': self.key, 'stages': {}, 'rows': {}}
+        return manifest
+
+    def _save(self):
+        # written aside and renamed, so a crash never leaves half a manifest
+        partial = os.path.join(self.folder, MANIFEST + '.part')
+        with open(partial, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(partial, os.path.join(self.folder, MANIFEST))
+
+    @property
+    def resumed(self):
+        return bool(self.manifest['stages'] or self.manifest['rows'])
+
+    def path(self, name, extension='.tif'):
+        """
+        Path of an intermediate raster in the run's folder. Names repeat
+        between runs as long as they are asked for in the same order.
+        """
+        with self._lock:
+            count = self._names[name] = self._names.get(name, 0) + 1
+        suffix = '' if count == 1 else '_{}'.format(count)
+        return os.path.join(self.folder, name + suffix + extension)
+
+    def stage(self, name):
+        """
+        Recorded result of a completed stage, None if it has not completed.
+        """
+        return self.manifest['stages'].get(name)
+
+    def complete(self, name, result):
+        with self._lock:
+            self.manifest['stages'][name] = result
+            if isinstance(result, str):
+                self.manifest['rows'].pop(os.path.abspath(result), None)
+            self._save()
+
+    def rows(self, output):
+        """
+        Rows of output written by an earlier attempt, 0 if none or if the
+        file is gone.
+        """
+        if not os.path.isfile(output):
+            return 0
+        return self.manifest['rows'].get(os.path.abspath(output), 0)
+
+    def rows_written(self, output, rows):
+        with self._lock:
+            self.manifest['rows'][os.path.abspath(output)] = rows
+            self._save()
+
+    def clear(self):
+        """
+        Removes the run's folder once the run has completed.
+        """
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def run_key(algorithm, sources, params, directory):
+    """
+    Key of a run of algorithm on the given input rasters (local files, hashed
+    by content and memoised in directory) with a JSON serialisable dict of
+    its parameters.
+    """
+    digest = hashlib.sha256(algorithm.encode('utf-8'))
+    digest.update(str(KEY_VERSION).encode('ascii'))
+    lock = threading.Lock()
+    os.makedirs(directory, exist_ok=True)
+    for source in sources:
+        if source and os.path.isfile(source):
+            digest.update(content_hash(source, directory, lock).encode('ascii'))
+        else:
+            digest.update(str(source).encode('utf-8'))
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
@@ -0,0 +1,100 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+
+ Quantized output encodings: outputs stored as 16 bit integers with GDAL
+ scale and offset (value = stored * scale + offset), a quarter of Float64
+ on disk and read back as floats by GDAL and QGIS. The scale is given, or
+ fitted to the first rows of the output holding data as it is computed,
+ or, staged, to its whole range at the cost of an extra pass.
+"""
+
+import numpy as np
+from osgeo import gdal
+
+# options of the output encoding parameters, in order
+ENCODINGS = ['Float (as computed)', 'Int16 with scale and offset', 'UInt16 with scale and offset']
+FLOAT = 0
+INT16 = 1
+UINT16 = 2
+
+# GDAL type, lowest and highest stored value, and the stored value kept for nodata
+LIMITS = {
+    INT16: (gdal.GDT_Int16, -32767, 32767, -32768),
+    UINT16: (gdal.GDT_UInt16, 0, 65534, 65535),
+}
+
+
+class Encoding(object):
+    """
+    Integer storage of an output. scale None fits scale and offset to the
+    range of the first rows of the output holding data (see fitted), values
+    beyond it later on being clipped; staged fits them to the whole output
+    instead, computed first into a float staging raster.
+    """
+
+    def __init__(self, kind, scale=None, offset=0.0, staged=False):
+        if scale is not None and scale <= 0:
+            raise ValueError('The encoding scale must be positive')
+        self.kind = kind
+        self.data_type, self.low, self.high, self.nodata = LIMITS[kind]
+        self.scale = scale
+        self.offset = offset
+        self.staged = staged
+
+    def fitted(self, minimum, maximum):
+        """
+        The encoding spreading [minimum, maximum] over every stored value.
+        """
+        scale = (maximum - minimum) / float(self.high - self.low)
+        return Encoding(self.kind, scale if scale > 0 else 1.0, minimum - self.low * (scale if scale > 0 else 1.0))
+
+    def resumed(self, band):
+        """
+        The fitted encoding a band was written with by an earlier attempt,
+        None when it has no scale and offset of its own.
+        """
+        scale, offset = band.GetScale(), band.GetOffset()
+        if scale in (None, 1.0) and offset in (None, 0.0):
+            return None
+        return Encoding(self.kind, scale or 1.0, offset or 0.0)
+
+    def encode(self, values):
+        """
+        Stored integers of float values, rounded to the nearest step and
+        clipped to the stored range, NaN becoming nodata, and the number of
+        values clipped.
+        """
+        steps = np.round((values - self.offset) / self.scale)
+        clipped = int(np.count_nonzero((steps < self.low) | (steps > self.high)))
+        stored = np.clip(steps, self.low, self.high)
+        return np.where(np.isnan(stored), self.nodata, stored), clipped
+
+    def decode(self, stored):
+        return np.where(stored == self.nodata, np.nan, stored * self.scale + self.offset)
+
+    def apply(self, band):
+        band.SetNoDataValue(self.nodata)
+        band.SetScale(self.scale)
+        band.SetOffset(self.offset)
+
+    def describe(self):
+        return '{} with scale {:.6g} and offset {:.6g}'.format(ENCODINGS[self.kind].split(' ')[0], self.scale, self.offset)
+
+
+def output_encoding(kind, scale=0.0, offset=0.0):
+    """
+    The Encoding of an output encoding option, None for floats; a scale of
+    0 is fitted to the output.
+    """
+    if kind == FLOAT:
+        return None
+    return Encoding(kind, scale or None, offset)
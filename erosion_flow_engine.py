@@ -0,0 +1,235 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+
+ Erosion formulas on NumPy arrays, plus cancellation and progress helpers
+ for the in-process stages. Angles are in degrees as written by the QGIS
+ slope and aspect algorithms.
+"""
+
+import numpy as np
+
+# degrees to radians as used by the USPED formulas of Mitasova et al.
+DEG = 0.01745
+
+
+class Canceled(Exception):
+    """
+    Raised inside a stage when the user cancels the algorithm.
+    """
+
+
+def check_canceled(feedback, progress=None):
+    """
+    Raises Canceled if the feedback was canceled, otherwise reports
+    progress (0 to 1) when given.
+    """
+    if feedback is None:
+        return
+    if feedback.isCanceled():
+        raise Canceled()
+    if progress is not None:
+        feedback.setProgress(100.0 * progress)
+
+
+class SubFeedback(object):
+    """
+    Maps the 0-100 progress of a sub task to the start-end range of feedback.
+    """
+
+    def __init__(self, feedback, start, end):
+        self.feedback = feedback
+        self.start = start
+        self.end = end
+
+    def isCanceled(self):
+        return self.feedback is not None and self.feedback.isCanceled()
+
+    def setProgress(self, progress):
+        if self.feedback is not None:
+            self.feedback.setProgress(self.start + (self.end - self.start) * progress / 100.0)
+
+    def pushConsoleInfo(self, message):
+        if self.feedback is not None:
+            self.feedback.pushConsoleInfo(message)
+
+    def pushWarning(self, message):
+        if self.feedback is not None:
+            self.feedback.pushWarning(message)
+
+
+def ls_factor(flow, slope, m=0.5, n=1.1):
+    """
+    LS from upslope contributing area, Moore & Burch (1986):
+    (m + 1) * (A / 22.1)^m * (sin(slope) / 0.09)^n
+    """
+    return (m + 1) * np.power(flow / 22.1, m) * np.power(np.sin(slope * 3.14159 / 180) / 0.09, n)
+
+
+def ls_sweep(flow, slope, ms, ns):
+    """
+    ls_factor for every pair of an m of ms and an n of ns, stacked as
+    (pair, rows, cols) with the pairs of the first m first. The logarithms
+    of the area and slope terms are taken once, so each m and each n costs
+    one exponential over the block and each pair one product.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_area = np.log(flow / 22.1)
+        log_slope = np.log(np.sin(slope * 3.14159 / 180) / 0.09)
+        # x^0 is 1, also where the logarithm is -inf
+        area_terms = [(m + 1) * (np.exp(m * log_area) if m else np.ones_like(log_area)) for m in ms]
+        slope_terms = [np.exp(n * log_slope) if n else np.ones_like(log_slope) for n in ns]
+    return np.stack([area * steepness for area in area_terms for steepness in slope_terms])
+
+
+# bands of the multi LS raster, in order
+LS_FORMULATIONS = [
+    'Moore & Burch 1986',
+    'Moore & Wilson 1992',
+    'Desmet & Govers 1996',
+    'McCool 1987/1989',
+]
+
+
+def mccool_s(slope):
+    """
+    RUSLE slope steepness factor, McCool et al. (1987):
+    10.8 sin(slope) + 0.03 below 9 %, 16.8 sin(slope) - 0.5 above.
+    """
+    sin_slope = np.sin(np.radians(slope))
+    return np.where(np.tan(np.radians(slope)) < 0.09, 10.8 * sin_slope + 0.03, 16.8 * sin_slope - 0.5)
+
+
+def mccool_m(slope):
+    """
+    RUSLE slope length exponent from the rill to interrill ratio beta,
+    McCool et al. (1989), for moderately erodible soils.
+    """
+    sin_slope = np.sin(np.radians(slope))
+    beta = (sin_slope / 0.0896) / (3 * np.power(sin_slope, 0.8) + 0.56)
+    return beta / (1 + beta)
+
+
+def ls_moore_wilson(flow, slope, width):
+    """
+    Moore & Wilson (1992): (As / 22.13)^0.4 * (sin(slope) / 0.0896)^1.3,
+    As the specific catchment area (area per unit contour width).
+    """
+    return np.power(flow / width / 22.13, 0.4) * np.power(np.sin(np.radians(slope)) / 0.0896, 1.3)
+
+
+def ls_desmet_govers(flow, slope, aspect, width):
+    """
+    Desmet & Govers (1996) L from the area draining into the cell, with the
+    McCool m and S:
+    ((Ain + D^2)^(m + 1) - Ain^(m + 1)) / (D^(m + 2) * x^m * 22.13^m) * S
+    where x = |sin(aspect)| + |cos(aspect)| (1 on flats).
+    """
+    m = mccool_m(slope)
+    inflow = np.maximum(flow - width * width, 0)
+    x = np.abs(np.sin(np.radians(aspect))) + np.abs(np.cos(np.radians(aspect)))
+    x = np.where(np.isnan(aspect), 1.0, x)
+    length = ((np.power(inflow + width * width, m + 1) - np.power(inflow, m + 1))
+              / (np.power(width, m + 2) * np.power(x, m) * np.power(22.13, m)))
+    return length * mccool_s(slope)
+
+
+def ls_mccool(flow, slope, width):
+    """
+    RUSLE LS of McCool et al. (1987, 1989) with the slope length taken as
+    the upslope area per unit width: (lambda / 22.13)^m * S.
+    """
+    return np.power(flow / width / 22.13, mccool_m(slope)) * mccool_s(slope)
+
+
+def ls_factors(flow, slope, aspect, width, m=0.5, n=1.1):
+    """
+    Every LS_FORMULATIONS from the same flow accumulation and slope, stacked
+    as (formulation, rows, cols).
+    """
+    return np.stack([
+        ls_factor(flow, slope, m, n),
+        ls_moore_wilson(flow, slope, width),
+        ls_desmet_govers(flow, slope, aspect, width),
+        ls_mccool(flow, slope, width),
+    ])
+
+
+def rusle(ls, k, c, r):
+    return ls * k * c * r
+
+
+def rill_regime(flow, slope, min_area=None, min_slope=None):
+    """
+    Cells under prevailing rill erosion: those with a contributing area of
+    at least min_area and a slope of at least min_slope degrees (either
+    None to not limit by it), sheet erosion elsewhere.
+    """
+    rill = np.ones(np.shape(flow), dtype=bool)
+    if min_area is not None:
+        rill &= flow >= min_area
+    if min_slope is not None:
+        rill &= slope >= min_slope
+    return rill
+
+
+def regime_values(regime, default=True):
+    """
+    Rill (True) or sheet (False) per cell from regime raster values, 1 for
+    rill and 0 for sheet, default where the raster has no data.
+    """
+    return np.where(np.isnan(regime), default, regime > 0)
+
+
+def sediment_flow(flow, slope, rill=True):
+    """
+    USPED sflowtopo, rill: A^0.6 * sin(slope)^1.3, sheet: A * sin(slope).
+    rill is one regime for all cells or a boolean array, per cell.
+    """
+    if np.ndim(rill):
+        return np.where(rill, sediment_flow(flow, slope, True), sediment_flow(flow, slope, False))
+    if rill:
+        return np.power(flow, 0.6) * np.power(np.sin(slope * DEG), 1.3)
+    return flow * np.sin(slope * DEG)
+
+
+def sediment_flux_x(sflow, k, c, r, aspect):
+    return sflow * k * c * r * np.cos((aspect * -1 + 450) * DEG)
+
+
+def sediment_flux_y(sflow, k, c, r, aspect):
+    return sflow * k * c * r * np.sin((aspect * -1 + 450) * DEG)
+
+
+def flux_change_x(aspect, slope):
+    """
+    qsx_dx from the slope and aspect of the qsx surface.
+    """
+    return np.cos((aspect * -1 + 450) * DEG) * np.tan(slope * DEG)
+
+
+def flux_change_y(aspect, slope):
+    """
+    qsy_dy from the slope and aspect of the qsy surface.
+    """
+    return np.sin((aspect * -1 + 450) * DEG) * np.tan(slope * DEG)
+
+
+def usped(dx, dy, rill=True):
+    """
+    Net erosion (negative) or deposition (positive), scaled by 10 for
+    prevailing sheet erosion; rill as for sediment_flow.
+    """
+    if np.ndim(rill):
+        return np.where(rill, dx + dy, (dx + dy) * 10)
+    if rill:
+        return dx + dy
+    return (dx + dy) * 10
@@ -0,0 +1,274 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+
+ Per cell formulas given as text, such as a C factor from NDVI
+ (exp(-2 * A / (1 - A))) or a P factor adjustment (LS * K * C * R * A).
+
+ A formula is parsed and checked once, before any raster is read, and
+ compiled to a list of NumPy ufunc calls on a few scratch arrays reused
+ for every block, so evaluating it block by block (see block_calc) makes
+ no full-size temporaries and no new array per operator. NaN (nodata)
+ propagates through arithmetic, and through comparisons and logical
+ operators, which otherwise give 1 or 0; a NaN condition of "if" or
+ where gives NaN.
+"""
+
+import ast
+import threading
+
+import numpy as np
+
+FUNCTIONS = {
+    'abs': (np.absolute, 1),
+    'sqrt': (np.sqrt, 1),
+    'exp': (np.exp, 1),
+    'log': (np.log, 1),
+    'log10': (np.log10, 1),
+    'sin': (np.sin, 1),
+    'cos': (np.cos, 1),
+    'tan': (np.tan, 1),
+    'arcsin': (np.arcsin, 1),
+    'arccos': (np.arccos, 1),
+    'arctan': (np.arctan, 1),
+    'arctan2': (np.arctan2, 2),
+    'radians': (np.radians, 1),
+    'degrees': (np.degrees, 1),
+    'floor': (np.floor, 1),
+    'ceil': (np.ceil, 1),
+    'minimum': (np.minimum, 2),
+    'maximum': (np.maximum, 2),
+    'isnan': (np.isnan, 1),
+    'where': (None, 3),
+    'clip': (np.clip, 3),
+}
+
+CONSTANTS = {'pi': np.pi, 'e': np.e}
+
+BINARY = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.Pow: np.power,
+    ast.Mod: np.mod,
+}
+
+def _missing(operands, shape):
+    missing = np.zeros(shape, dtype=bool)
+    for operand in operands:
+        missing |= np.isnan(operand)
+    return missing
+
+
+def _nan_aware(function):
+    """
+    A comparison or logical ufunc giving NaN where any operand is NaN,
+    rather than False (or True for != and not).
+    """
+    def compute(*operands, out):
+        # taken before the call, as out may be one of the operands
+        missing = _missing(operands, out.shape)
+        function(*operands, out=out)
+        out[missing] = np.nan
+    return compute
+
+
+COMPARE = {
+    ast.Lt: _nan_aware(np.less),
+    ast.LtE: _nan_aware(np.less_equal),
+    ast.Gt: _nan_aware(np.greater),
+    ast.GtE: _nan_aware(np.greater_equal),
+    ast.Eq: _nan_aware(np.equal),
+    ast.NotEq: _nan_aware(np.not_equal),
+}
+
+LOGICAL_AND = _nan_aware(np.logical_and)
+LOGICAL_OR = _nan_aware(np.logical_or)
+LOGICAL_NOT = _nan_aware(np.logical_not)
+
+
+def _where(condition, a, b, out):
+    missing = _missing([condition], out.shape)
+    # np.where has no out argument: the block sized result is copied in
+    np.copyto(out, np.where(condition != 0, a, b))
+    out[missing] = np.nan
+
+
+class Expression(object):
+    """
+    A compiled formula. evaluate(*values) takes arrays (or numbers) in the
+    order of the names it was compiled with, so it can be given to
+    block_calc directly.
+    """
+
+    def __init__(self, text, names, steps, result, temporaries, used):
+        self.text = text
+        self.names = names
+        self.steps = steps
+        self.result = result
+        self.temporaries = temporaries
+        # names the formula refers to
+        self.used = used
+        self._local = threading.local()
+
+    def _buffers(self, shape):
+        buffers = getattr(self._local, 'buffers', None)
+        if buffers is None or buffers[0].shape != shape:
+            buffers = [np.empty(shape) for _ in range(max(self.temporaries, 1))]
+            self._local.buffers = buffers
+        return buffers
+
+    def evaluate(self, *values):
+        if len(values) != len(self.names):
+            raise ValueError('Formula takes {} inputs, got {}'.format(len(self.names), len(values)))
+        shape = np.broadcast_shapes(*[np.shape(v) for v in values]) if values else ()
+        if self.result[0] != 'tmp':
+            return np.broadcast_to(np.asarray(self._operand(self.result, values, None), dtype=np.float64), shape).copy()
+        buffers = self._buffers(shape)
+        out = np.empty(shape)
+        last = len(self.steps) - 1
+        for i, (function, operands, target) in enumerate(self.steps):
+            arguments = [self._operand(o, values, buffers) for o in operands]
+            # the last step makes the result, written straight into the returned array
+            function(*arguments, out=out if i == last else buffers[target])
+        return out
+
+    __call__ = evaluate
+
+    @staticmethod
+    def _operand(operand, values, buffers):
+        kind, value = operand
+        if kind == 'in':
+            return values[value]
+        if kind == 'tmp':
+            return buffers[value]
+        return value
+
+
+class _Compiler(object):
+
+    def __init__(self, text, names):
+        self.text = text
+        self.names = list(names)
+        self.steps = []
+        self.free = []
+        self.temporaries = 0
+        self.used = set()
+
+    def error(self, node, message):
+        return ValueError('Formula "{}", column {}: {}'.format(self.text, getattr(node, 'col_offset', 0) + 1, message))
+
+    def release(self, operands):
+        for kind, value in operands:
+            if kind == 'tmp' and value not in self.free:
+                self.free.append(value)
+
+    def emit(self, function, operands, live=()):
+        # all constant: folded now
+        if all(kind == 'const' for kind, _ in operands):
+            out = np.empty(())
+            function(*[value for _, value in operands], out=out)
+            return ('const', float(out))
+        # an operand's scratch array is free once read, so it can take the result in place,
+        # unless a later step still reads it (live)
+        self.release([o for o in operands if o not in live])
+        if self.free:
+            target = self.free.pop()
+        else:
+            target = self.temporaries
+            self.temporaries += 1
+        self.steps.append((function, operands, target))
+        return ('tmp', target)
+
+    def visit(self, node):
+        if isinstance(node, ast.Expression):
+            return self.visit(node.body)
+        if isinstance(node, ast.Constant):
+            if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+                raise self.error(node, 'only numbers are allowed as constants')
+            return ('const', float(node.value))
+        if isinstance(node, ast.Name):
+            if node.id in self.names:
+                self.used.add(node.id)
+                return ('in', self.names.index(node.id))
+            if node.id in CONSTANTS:
+                return ('const', CONSTANTS[node.id])
+            raise self.error(node, 'unknown name {} (inputs are {})'.format(node.id, ', '.join(self.names) or 'none'))
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY:
+            return self.emit(BINARY[type(node.op)], [self.visit(node.left), self.visit(node.right)])
+        if isinstance(node, ast.UnaryOp):
+            operand = self.visit(node.operand)
+            if isinstance(node.op, ast.UAdd):
+                return operand
+            if isinstance(node.op, ast.USub):
+                return self.emit(np.negative, [operand])
+            if isinstance(node.op, ast.Not):
+                return self.emit(LOGICAL_NOT, [operand])
+        if isinstance(node, ast.Compare):
+            left = self.visit(node.left)
+            result = None
+            for i, (op, comparator) in enumerate(zip(node.ops, node.comparators)):
+                if type(op) not in COMPARE:
+                    raise self.error(node, 'unsupported comparison')
+                right = self.visit(comparator)
+                # in a chain (a < b < c) the right operand is read again by the next comparison
+                live = [right] if i < len(node.ops) - 1 else []
+                part = self.emit(COMPARE[type(op)], [left, right], live)
+                result = part if result is None else self.emit(LOGICAL_AND, [result, part])
+                left = right
+            return result
+        if isinstance(node, ast.BoolOp):
+            function = LOGICAL_AND if isinstance(node.op, ast.And) else LOGICAL_OR
+            result = self.visit(node.values[0])
+            for value in node.values[1:]:
+                result = self.emit(function, [result, self.visit(value)])
+            return result
+        if isinstance(node, ast.IfExp):
+            return self.emit(_where, [self.visit(node.test), self.visit(node.body), self.visit(node.orelse)])
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS:
+                raise self.error(node, 'unknown function (available: {})'.format(', '.join(sorted(FUNCTIONS))))
+            if node.keywords:
+                raise self.error(node, 'keyword arguments are not supported')
+            function, count = FUNCTIONS[node.func.id]
+            if len(node.args) != count:
+                raise self.error(node, '{} takes {} arguments'.format(node.func.id, count))
+            function = function or _where
+            return self.emit(function, [self.visit(arg) for arg in node.args])
+        raise self.error(node, 'unsupported expression {}'.format(type(node).__name__))
+
+
+def compile_expression(text, names):
+    """
+    Compiles a formula of the given input names (numbers, + - * / ** %,
+    comparisons, and/or/not, "a if condition else b" and the FUNCTIONS),
+    raising ValueError on anything else.
+    """
+    if not text or not text.strip():
+        raise ValueError('Formula is empty')
+    try:
+        tree = ast.parse(text.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError('Formula "{}", column {}: {}'.format(text, e.offset or 1, e.msg))
+    compiler = _Compiler(text, names)
+    result = compiler.visit(tree)
+    return Expression(text, compiler.names, compiler.steps, result, compiler.temporaries,
+                      [n for n in compiler.names if n in compiler.used])
+
+
+def input_names(count):
+    """
+    Names of formula layers by their order: A, B, ... Z.
+    """
+    if count > 26:
+        raise ValueError('At most 26 formula layers')
+    return [chr(ord('A') + i) for i in range(count)]
@@ -0,0 +1,69 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+
+ Paths of intermediate rasters, on disk or in GDAL memory (/vsimem/).
+ GDAL is only needed for the in-memory ones, so the stage graph keeping
+ track of a run's rasters works, and is tested, without it.
+"""
+
+import os
+import uuid
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+MEMORY_FOLDER = '/vsimem/erosion_flow'
+
+
+def memory_path(name):
+    """
+    A unique GDAL in-memory file path for an intermediate raster.
+    """
+    return '{}/{}/{}.tif'.format(MEMORY_FOLDER, uuid.uuid4().hex, name)
+
+
+def is_memory_path(path):
+    return path.startswith(MEMORY_FOLDER + '/')
+
+
+def raster_bytes(path):
+    """
+    Size of a raster file on disk or in GDAL memory, 0 if it is gone.
+    """
+    if is_memory_path(path):
+        stat = gdal.VSIStatL(path)
+        return stat.size if stat is not None else 0
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def remove_rasters(paths):
+    """
+    Deletes raster files and their sidecars, ignoring ones already gone.
+    """
+    for path in paths:
+        if is_memory_path(path):
+            try:
+                gdal.Unlink(path)
+            except RuntimeError:
+                pass
+            continue
+        for candidate in (path, path + '.aux.xml'):
+            if os.path.exists(candidate):
+                try:
+                    os.remove(candidate)
+                except OSError:
+                    pass
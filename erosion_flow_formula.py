@@ -0,0 +1,82 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+"""
+
+from qgis.core import QgsProcessing
+from qgis.core import QgsProcessingAlgorithm
+from qgis.core import QgsProcessingException
+from qgis.core import QgsProcessingParameterMultipleLayers
+from qgis.core import QgsProcessingParameterString
+from qgis.core import QgsProcessingParameterRasterDestination
+
+from .erosion_flow_layers import layer_source
+from .erosion_flow_engine import Canceled
+from .erosion_flow_expression import compile_expression, input_names
+from .erosion_flow_raster import block_calc, raster_info, remove_rasters
+
+
+class FactorFormula(QgsProcessingAlgorithm):
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterMultipleLayers('layers', 'Input rasters on one grid (A, B, ... in order)', layerType=QgsProcessing.TypeRaster, defaultValue=None))
+        self.addParameter(QgsProcessingParameterString('formula', 'Formula, e.g. exp(-2 * A / (1 - A)) for C from NDVI', defaultValue=None))
+        self.addParameter(QgsProcessingParameterRasterDestination('Output', 'Factor', createByDefault=True, defaultValue=None))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        layers = self.parameterAsLayerList(parameters, 'layers', context)
+        if not layers:
+            raise QgsProcessingException(self.invalidSourceError(parameters, 'layers'))
+        # checked and compiled before any raster is read
+        try:
+            expression = compile_expression(self.parameterAsString(parameters, 'formula', context), input_names(len(layers)))
+        except ValueError as e:
+            raise QgsProcessingException(str(e))
+        sources = [layer_source(layer) for layer in layers]
+        shape = raster_info(sources[0]).shape
+        for layer, source in zip(layers, sources):
+            if raster_info(source).shape != shape:
+                raise QgsProcessingException('{} is not on the grid of {}'.format(layer.name(), layers[0].name()))
+        for name, layer in zip(expression.names, layers):
+            feedback.pushInfo('{} = {}'.format(name, layer.name()))
+
+        output = self.parameterAsOutputLayer(parameters, 'Output', context)
+        try:
+            block_calc(output, sources, expression.evaluate, feedback, statistics=True)
+        except Canceled:
+            remove_rasters([output])
+            feedback.pushInfo('Canceled, removed partial output')
+            return {}
+        return {'Output': output}
+
+    def name(self):
+        return 'FactorFormula'
+
+    def displayName(self):
+        return 'Factor formula'
+
+    def group(self):
+        return ''
+
+    def groupId(self):
+        return ''
+
+    def shortHelpString(self):
+        return ('Computes a factor raster from a per cell formula of the input rasters, named A, B, ... '
+                'in order, e.g. a C factor from NDVI or C * P for prevention measures. Formulas use numbers, '
+                '+ - * / ** %, comparisons, and/or/not, "a if condition else b", pi, e and the functions '
+                'abs, sqrt, exp, log, log10, sin, cos, tan, arcsin, arccos, arctan, arctan2, radians, degrees, '
+                'floor, ceil, minimum, maximum, clip, where and isnan. Nodata cells are NaN in the formula, so '
+                'arithmetic on them gives nodata. The formula is checked before any raster is read and evaluated '
+                'in-process block by block.')
+
+    def createInstance(self):
+        return FactorFormula()
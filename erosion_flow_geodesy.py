@@ -0,0 +1,78 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+
+ Cell sizes and areas in metres of rasters in a geographic CRS (degrees),
+ so slope, aspect and flow accumulation run on them without reprojecting.
+
+ Along a row every cell has the same size, so sizes and areas are given
+ per row as (rows, 1) columns, broadcasting over the row's cells: widths
+ from the prime vertical and lengths from the meridian radius of curvature
+ at the row's centre latitude, areas exact on the ellipsoid.
+ Needs only NumPy.
+"""
+
+import numpy as np
+
+# semi-major axis (m) and inverse flattening
+WGS84 = (6378137.0, 298.257223563)
+
+
+def _eccentricity2(ellipsoid):
+    inverse_flattening = ellipsoid[1]
+    flattening = 1.0 / inverse_flattening if inverse_flattening else 0.0
+    return flattening * (2 - flattening)
+
+
+def _row_edges(geotransform, rows, row):
+    """
+    Latitudes in radians of the top edges of rows [row, row + rows + 1).
+    """
+    return np.radians(geotransform[3] + (row + np.arange(rows + 1)) * geotransform[5])
+
+
+def row_cell_sizes(geotransform, rows, ellipsoid=WGS84, row=0):
+    """
+    (x, y) cell sizes in metres of rows [row, row + rows) of a north-up
+    geographic raster, each a (rows, 1) column.
+    """
+    a = ellipsoid[0]
+    e2 = _eccentricity2(ellipsoid)
+    edges = _row_edges(geotransform, rows, row)
+    centre = (edges[:-1] + edges[1:]) / 2
+    w = 1 - e2 * np.sin(centre) ** 2
+    prime_vertical = a / np.sqrt(w)
+    meridian = a * (1 - e2) / w ** 1.5
+    dx = prime_vertical * np.cos(centre) * np.radians(abs(geotransform[1]))
+    dy = meridian * np.radians(abs(geotransform[5]))
+    return dx.reshape(-1, 1), dy.reshape(-1, 1)
+
+
+def _zone(latitude, e2):
+    # twice the area between the equator and latitude per radian of longitude, over b^2
+    sin = np.sin(latitude)
+    if e2 == 0:
+        return 2 * sin
+    e = np.sqrt(e2)
+    return sin / (1 - e2 * sin * sin) + np.log((1 + e * sin) / (1 - e * sin)) / (2 * e)
+
+
+def row_cell_areas(geotransform, rows, ellipsoid=WGS84, row=0):
+    """
+    Cell areas in square metres of rows [row, row + rows) of a north-up
+    geographic raster, as a (rows, 1) column.
+    """
+    a = ellipsoid[0]
+    e2 = _eccentricity2(ellipsoid)
+    b2 = a * a * (1 - e2)
+    zone = _zone(_row_edges(geotransform, rows, row), e2)
+    areas = np.abs(np.diff(zone)) * b2 / 2 * np.radians(abs(geotransform[1]))
+    return areas.reshape(-1, 1)
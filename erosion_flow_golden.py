@@ -0,0 +1,139 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+
+ Cell by cell comparison of engine outputs with reference (golden)
+ outputs of the GDAL/SAGA processing chain, and the golden folder the
+ reference outputs and the run times of both are kept in between checks.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from .erosion_flow_engine import check_canceled
+from .erosion_flow_raster import BLOCK_ROWS, _read_rows, open_raster
+
+# outputs compared by the regression check, in order
+GOLDEN_OUTPUTS = ['slope', 'aspect', 'flowaccumulation', 'ls', 'rusle']
+
+# outputs in degrees that wrap around at 360
+CIRCULAR = {'aspect': 360.0}
+
+GOLDEN_FILE = 'golden.json'
+
+
+class RasterErrors(object):
+    """
+    Differences between a reference and a candidate raster: the cells
+    compared (data in both), the max and mean absolute error, the max
+    relative error, the cells outside the tolerance and the cells with
+    data in only one of the two.
+    """
+
+    def __init__(self, cells=0, max_error=0.0, mean_error=0.0, max_relative=0.0, outside=0, nodata_mismatch=0):
+        self.cells = cells
+        self.max_error = max_error
+        self.mean_error = mean_error
+        self.max_relative = max_relative
+        self.outside = outside
+        self.nodata_mismatch = nodata_mismatch
+
+    def failed(self, max_outside=0.0):
+        """
+        True when more than max_outside (a fraction) of the cells differ
+        beyond the tolerance, or their nodata does.
+        """
+        cells = max(self.cells + self.nodata_mismatch, 1)
+        return (self.outside + self.nodata_mismatch) / float(cells) > max_outside
+
+    def describe(self):
+        return 'max error {:.6g}, mean error {:.6g}, max relative error {:.6g}, {} of {} cells outside tolerance, {} nodata mismatches'.format(
+            self.max_error, self.mean_error, self.max_relative, self.outside, self.cells, self.nodata_mismatch)
+
+
+def compare_rasters(reference, candidate, rtol=1e-3, atol=1e-6, period=None, feedback=None, block_rows=BLOCK_ROWS):
+    """
+    Compares the first bands of two rasters on the same grid, block by
+    block. A cell is within tolerance when |candidate - reference| <=
+    atol + rtol * |reference|; with period (e.g. 360 for aspect) the
+    difference is taken around the circle. Raises ValueError if the grids
+    differ in size.
+    """
+    first, second = open_raster(reference), open_raster(candidate)
+    if (first.RasterXSize, first.RasterYSize) != (second.RasterXSize, second.RasterYSize):
+        raise ValueError('{} and {} differ in size'.format(reference, candidate))
+    bands = [(band, band.GetNoDataValue()) for band in (first.GetRasterBand(1), second.GetRasterBand(1))]
+    rows = first.RasterYSize
+    errors = RasterErrors()
+    total = 0.0
+    for row in range(0, rows, block_rows):
+        check_canceled(feedback, row / float(rows))
+        count = min(block_rows, rows - row)
+        a, b = [_read_rows(band, nodata, row, count) for band, nodata in bands]
+        valid = ~np.isnan(a) & ~np.isnan(b)
+        errors.nodata_mismatch += int(np.count_nonzero(np.isnan(a) != np.isnan(b)))
+        a, b = a[valid], b[valid]
+        if not a.size:
+            continue
+        error = np.abs(b - a)
+        if period:
+            error = np.minimum(error % period, period - error % period)
+        errors.cells += int(a.size)
+        errors.outside += int(np.count_nonzero(error > atol + rtol * np.abs(a)))
+        errors.max_error = max(errors.max_error, float(error.max()))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            relative = np.where(a != 0, error / np.abs(a), np.where(error > 0, np.inf, 0))
+        errors.max_relative = max(errors.max_relative, float(relative.max()))
+        total += float(error.sum())
+    errors.mean_error = total / errors.cells if errors.cells else 0.0
+    return errors
+
+
+def golden_folder(root, dem_source):
+    """
+    Folder of the golden outputs of a DEM, named after the DEM file.
+    """
+    return os.path.join(root, os.path.splitext(os.path.basename(dem_source))[0])
+
+
+def golden_paths(folder):
+    return {name: os.path.join(folder, name + '.tif') for name in GOLDEN_OUTPUTS}
+
+
+def load_golden(folder, settings):
+    """
+    The run times of the golden outputs in folder, None if they are missing
+    or were made with other settings (a dict of the model parameters and
+    factors): {'seconds': reference chain, 'engine_seconds': the engine
+    when the golden outputs were made, None if not recorded}.
+    """
+    path = os.path.join(folder, GOLDEN_FILE)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        golden = json.load(f)
+    if golden.get('settings') != settings:
+        return None
+    if not all(os.path.isfile(p) for p in golden_paths(folder).values()):
+        return None
+    engine = golden.get('engine_seconds')
+    return {'seconds': float(golden['seconds']), 'engine_seconds': float(engine) if engine is not None else None}
+
+
+def save_golden(folder, settings, seconds, engine_seconds):
+    """
+    Records the settings of the golden outputs in folder, the run time of
+    the reference chain that made them and the engine's run time then.
+    """
+    with open(os.path.join(folder, GOLDEN_FILE), 'w') as f:
+        json.dump({'settings': settings, 'seconds': seconds, 'engine_seconds': engine_seconds}, f, indent=1)
@@ -0,0 +1,128 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+
+ Input raster layers for the engine. Layers GDAL opens by path are read
+ by GDAL; any other QGIS raster source (memory and virtual rasters, WCS,
+ layers of other providers) is read block by block through the layer's
+ data provider, on its native grid, instead of being exported to a
+ temporary file first. Also the region of interest geometries the
+ algorithms limit a run to.
+"""
+
+import threading
+
+import numpy as np
+from qgis.core import Qgis
+from qgis.core import QgsCoordinateTransform
+from qgis.core import QgsProcessingException
+from qgis.core import QgsRasterDataProvider
+from qgis.core import QgsRectangle
+
+from .erosion_flow_raster import RasterInfo, RasterReader
+
+# QGIS raster data types and the NumPy types of their block data
+DATA_TYPES = {
+    Qgis.Byte: np.uint8,
+    Qgis.UInt16: np.uint16,
+    Qgis.Int16: np.int16,
+    Qgis.UInt32: np.uint32,
+    Qgis.Int32: np.int32,
+    Qgis.Float32: np.float32,
+    Qgis.Float64: np.float64,
+}
+
+
+def layer_source(layer):
+    """
+    What the engine reads a raster layer from: its file path when GDAL
+    opens it directly, otherwise a ProviderReader on its data provider.
+    """
+    # GDAL provider sources with options after a | are not plain GDAL paths
+    if layer.providerType() == 'gdal' and '|' not in layer.source():
+        return layer.source()
+    return ProviderReader(layer)
+
+
+def region_geometries(source, crs, context):
+    """
+    Outlet or region of interest geometries of a feature source as WKT in
+    crs (the DEM's), None without a source.
+    """
+    if source is None:
+        return None
+    transform = QgsCoordinateTransform(source.sourceCrs(), crs, context.transformContext())
+    geometries = []
+    for feature in source.getFeatures():
+        geometry = feature.geometry()
+        geometry.transform(transform)
+        geometries.append(geometry.asWkt())
+    return geometries
+
+
+class ProviderReader(RasterReader):
+    """
+    Reads one band of a raster layer through its data provider. Each thread
+    reading gets its own clone of the provider, as providers are not safe
+    to share between threads.
+    """
+
+    def __init__(self, layer, band=1):
+        provider = layer.dataProvider()
+        if not provider.capabilities() & QgsRasterDataProvider.Size or not provider.xSize():
+            raise QgsProcessingException('Layer {} has no native cell size to read it on, export it to a file first'.format(layer.name()))
+        if provider.dataType(band) not in DATA_TYPES:
+            raise QgsProcessingException('Layer {} has no numeric band {}'.format(layer.name(), band))
+        self.name = layer.name()
+        self.band = band
+        self.provider = provider.clone()
+        self._local = threading.local()
+        extent = provider.extent()
+        xsize, ysize = provider.xSize(), provider.ySize()
+        geotransform = (extent.xMinimum(), extent.width() / xsize, 0,
+                        extent.yMaximum(), 0, -extent.height() / ysize)
+        nodata = provider.sourceNoDataValue(band) if provider.sourceHasNoDataValue(band) else None
+        self.info = RasterInfo(geotransform, layer.crs().toWkt(), xsize, ysize, nodata)
+
+    def __str__(self):
+        return self.name
+
+    def _provider(self):
+        if not hasattr(self._local, 'provider'):
+            self._local.provider = self.provider.clone()
+        return self._local.provider
+
+    def read_block(self, row, col, rows, cols):
+        gt = self.info.geotransform
+        extent = QgsRectangle(gt[0] + col * gt[1], gt[3] + (row + rows) * gt[5],
+                              gt[0] + (col + cols) * gt[1], gt[3] + row * gt[5])
+        block = self._provider().block(self.band, extent, cols, rows)
+        if block is None or not block.isValid():
+            raise QgsProcessingException('Could not read rows {} to {} of layer {}'.format(row, row + rows, self.name))
+        array = np.frombuffer(bytes(block.data()), dtype=DATA_TYPES[block.dataType()]).reshape(rows, cols).astype(np.float64)
+        if block.hasNoDataValue():
+            array[array == block.noDataValue()] = np.nan
+        elif block.hasNoData():
+            array[nodata_mask(block, rows, cols)] = np.nan
+        return array
+
+
+def nodata_mask(block, rows, cols):
+    """
+    Cells of a raster block marked as nodata in its nodata bitmap rather
+    than by a value. PyQGIS does not expose the bitmap itself; newer QGIS
+    versions decode it into the mask of QgsRasterBlock.as_numpy, older ones
+    are asked cell by cell as a last resort.
+    """
+    if hasattr(block, 'as_numpy'):
+        return np.ma.getmaskarray(block.as_numpy(use_masking=True)).reshape(rows, cols)
+    missing = np.fromiter((block.isNoData(i) for i in range(rows * cols)), dtype=bool, count=rows * cols)
+    return missing.reshape(rows, cols)
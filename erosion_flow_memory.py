@@ -0,0 +1,98 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+
+ Fits a run into a memory budget: picks the block size, the number of
+ concurrent stages and whether intermediate rasters stay in RAM or spill
+ to the temporary folder, from rough per-cell costs of the stages.
+"""
+
+from .erosion_flow_raster import BLOCK_ROWS
+from .erosion_flow_routing import D8, DINF, MFD
+
+MB = 1024 * 1024
+
+# bytes per cell of the whole-raster flow accumulation stage: the receiver
+# graph (see erosion_flow_routing) plus DEM, weights, result and temporaries
+FLOW_BYTES = {D8: 8 + 48, DINF: 20 + 48, MFD: 68 + 48}
+
+# float64 arrays alive per cell of a block: inputs, halo and formula temporaries
+BLOCK_ARRAYS = 16
+
+# intermediate rasters are written as float64
+INTERMEDIATE_BYTES = 8
+
+MIN_BLOCK_ROWS = 16
+MAX_BLOCK_ROWS = 4096
+
+
+class MemoryPlan(object):
+    """
+    Block rows for block_calc, concurrent stages for StageGraph and whether
+    intermediates are kept in memory; budget is in bytes, 0 for no limit.
+    """
+
+    def __init__(self, block_rows=BLOCK_ROWS, workers=1, in_memory=False, budget=0, notes=None):
+        self.block_rows = block_rows
+        self.workers = workers
+        self.in_memory = in_memory
+        self.budget = budget
+        self.notes = notes or []
+
+    def describe(self):
+        budget = '{} MB'.format(self.budget // MB) if self.budget else 'no limit'
+        lines = ['Memory budget {}: blocks of {} rows, {} concurrent stages, intermediates {}'.format(
+            budget, self.block_rows, self.workers, 'in memory' if self.in_memory else 'in the temporary folder')]
+        return '\n'.join(lines + self.notes)
+
+
+def plan_memory(shape, budget, method=MFD, intermediates=0, max_workers=1):
+    """
+    Plans a run over a raster of shape (rows, cols) within budget bytes.
+
+    The flow accumulation stage holds the whole raster and runs alongside
+    the block stages, so it is taken off the budget first; intermediates
+    (the number of temporary rasters of the run) stay in memory when they
+    fit in half of what is left, the rest is shared between the
+    concurrent stages' blocks. Without a budget the defaults are kept.
+    """
+    rows, cols = shape
+    cells = rows * cols
+    if not budget:
+        return MemoryPlan(BLOCK_ROWS, max(1, max_workers))
+    notes = []
+    flow = cells * FLOW_BYTES[method]
+    free = budget - flow
+    if free <= 0:
+        notes.append('Flow accumulation alone needs about {} MB, over the budget; '
+                     'a D8 routing or a region of interest needs less'.format(flow // MB))
+        free = 0
+    spill = intermediates * cells * INTERMEDIATE_BYTES
+    in_memory = 0 < spill <= free / 2
+    if in_memory:
+        free -= spill
+    row_bytes = cols * 8 * BLOCK_ARRAYS
+    workers = max(1, max_workers)
+    while workers > 1 and free // (workers * row_bytes) < MIN_BLOCK_ROWS:
+        workers -= 1
+    block_rows = int(min(max(free // (workers * row_bytes), MIN_BLOCK_ROWS), MAX_BLOCK_ROWS, max(rows, 1)))
+    return MemoryPlan(block_rows, workers, in_memory, budget, notes)
+
+
+def window_workers(cells, budget, method=MFD, max_workers=1):
+    """
+    Concurrent whole-window runs (flow accumulation and formulas held in
+    memory) of up to cells cells each that fit in budget bytes.
+    """
+    if not budget:
+        return max(1, max_workers)
+    per_window = cells * (FLOW_BYTES[method] + BLOCK_ARRAYS * 8)
+    return int(max(1, min(max_workers, budget // max(per_window, 1))))
@@ -23,9 +23,17 @@ __copyright__ = '(C) 2023 by Michael Tuck'
 __revision__ = '$Format:%H$'
 
 from qgis.core import QgsProcessingProvider
+from processing.core.ProcessingConfig import ProcessingConfig
 from .erosion_flow_LS import LSarea
 from .erosion_flow_RUSLE3D import RUSLE
 from .erosion_flow_USPED import USPED
+from .erosion_flow_batch import ParcelBatch
+from .erosion_flow_tiledflow import TiledFlowAccumulation
+from .erosion_flow_regression import EngineRegression
+from .erosion_flow_suite import ErosionSuite
+from .erosion_flow_formula import FactorFormula
+from .erosion_flow_sweep import LSSweep
+from .erosion_flow_settings import add_settings, remove_settings, purge_requested_cache
 
 
 class ErosionFlowProvider(QgsProcessingProvider):
@@ -36,20 +44,37 @@ class ErosionFlowProvider(QgsProcessingProvider):
         """
         QgsProcessingProvider.__init__(self)
 
+    def load(self):
+        """
+        Registers the provider settings, then loads the algorithms.
+        """
+        add_settings(self.name())
+        ProcessingConfig.readSettings()
+        self.refreshAlgorithms()
+        return True
+
     def unload(self):
         """
         Unloads the provider. Any tear-down steps required by the provider
         should be implemented here.
         """
-        pass
+        remove_settings()
 
     def loadAlgorithms(self):
         """
-        Loads all algorithms belonging to this provider.
+        Loads all algorithms belonging to this provider. Also called when the
+        Processing settings are saved, which is when a cache purge is applied.
         """
+        purge_requested_cache()
         self.addAlgorithm(LSarea())
         self.addAlgorithm(RUSLE())
         self.addAlgorithm(USPED())
+        self.addAlgorithm(ParcelBatch())
+        self.addAlgorithm(TiledFlowAccumulation())
+        self.addAlgorithm(EngineRegression())
+        self.addAlgorithm(ErosionSuite())
+        self.addAlgorithm(FactorFormula())
+        self.addAlgorithm(LSSweep())
 
     def id(self):
         """
@@ -0,0 +1,521 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+
+ Reading and writing rasters as NumPy arrays through GDAL.
+"""
+
+import os
+
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+from .erosion_flow_engine import check_canceled
+from .erosion_flow_geodesy import row_cell_sizes, row_cell_areas
+from .erosion_flow_stats import BandStatistics, stored_statistics
+from .erosion_flow_files import memory_path, remove_rasters
+
+OUTPUT_NODATA = -9999.0
+
+BLOCK_ROWS = 256
+
+# float outputs staged for fitting an integer encoding stay in memory up to this size
+STAGING_BYTES = 512 * 1024 * 1024
+
+
+class RasterInfo(object):
+    """
+    Georeferencing of a raster: geotransform, projection WKT, size and nodata.
+    """
+
+    def __init__(self, geotransform, projection, xsize, ysize, nodata=None):
+        self.geotransform = tuple(geotransform)
+        self.projection = projection
+        self.xsize = xsize
+        self.ysize = ysize
+        self.nodata = nodata
+
+    @property
+    def shape(self):
+        return (self.ysize, self.xsize)
+
+    @property
+    def cell_size(self):
+        return (abs(self.geotransform[1]), abs(self.geotransform[5]))
+
+    @property
+    def cell_area(self):
+        return self.cell_size[0] * self.cell_size[1]
+
+    @property
+    def ellipsoid(self):
+        """
+        (semi-major axis, inverse flattening) of a geographic CRS, None if projected.
+        """
+        if not hasattr(self, '_ellipsoid'):
+            self._ellipsoid = None
+            if self.projection:
+                srs = osr.SpatialReference()
+                srs.ImportFromWkt(self.projection)
+                if srs.IsGeographic():
+                    self._ellipsoid = (srs.GetSemiMajor(), srs.GetInvFlattening())
+        return self._ellipsoid
+
+    def cell_sizes(self, row=0, rows=None):
+        """
+        (x, y) cell sizes in metres of rows [row, row + rows), all rows by
+        default: per row (rows, 1) columns for a geographic raster, the
+        cell_size numbers otherwise. Rows outside the raster (a halo) are allowed.
+        """
+        if self.ellipsoid is None:
+            return self.cell_size
+        return row_cell_sizes(self.geotransform, self.ysize - row if rows is None else rows, self.ellipsoid, row)
+
+    def cell_areas(self, row=0, rows=None):
+        """
+        Cell areas in square metres of rows [row, row + rows), as cell_sizes.
+        """
+        if self.ellipsoid is None:
+            return self.cell_area
+        return row_cell_areas(self.geotransform, self.ysize - row if rows is None else rows, self.ellipsoid, row)
+
+
+class RasterReader(object):
+    """
+    A raster read through read_block rather than opened by path with GDAL,
+    such as a QGIS layer GDAL cannot open (see erosion_flow_layers). The
+    functions here taking a raster source accept one in place of a path.
+    """
+
+    info = None
+
+    def read_block(self, row, col, rows, cols):
+        """
+        Rows [row, row + rows) and columns [col, col + cols), all inside the
+        raster, as float64 with nodata replaced by NaN.
+        """
+        raise NotImplementedError
+
+
+class ArrayReader(RasterReader):
+    """
+    A raster already read into memory (see read_raster), so block-wise
+    stages can run on it without reading the file again.
+    """
+
+    def __init__(self, array, info):
+        self.array = array
+        self.info = info
+
+    def read_block(self, row, col, rows, cols):
+        return self.array[row:row + rows, col:col + cols]
+
+
+def open_raster(source, update=False):
+    """
+    Opens a raster with GDAL, raising RuntimeError if it cannot be opened.
+    GDAL exceptions are not switched on, as that would apply to every
+    plugin and script in the QGIS Python interpreter.
+    """
+    dataset = gdal.Open(source, gdal.GA_Update if update else gdal.GA_ReadOnly)
+    if dataset is None:
+        raise RuntimeError('Could not open raster {}: {}'.format(source, gdal.GetLastErrorMsg()))
+    return dataset
+
+
+def create_raster(path, xsize, ysize, bands, data_type, driver=None, options=None):
+    """
+    Creates a raster with the driver for its extension, or driver, and the
+    driver's creation options, raising RuntimeError if it cannot be created.
+    """
+    dataset = (driver or driver_for_path(path)).Create(path, xsize, ysize, bands, data_type, options or [])
+    if dataset is None:
+        raise RuntimeError('Could not create raster {}: {}'.format(path, gdal.GetLastErrorMsg()))
+    return dataset
+
+
+def _translate(output, source, **options):
+    if gdal.Translate(output, open_raster(source), format=driver_for_path(output).ShortName, **options) is None:
+        raise RuntimeError('Could not write raster {}: {}'.format(output, gdal.GetLastErrorMsg()))
+    return output
+
+
+def raster_info(source):
+    if isinstance(source, RasterReader):
+        return source.info
+    dataset = open_raster(source)
+    return RasterInfo(dataset.GetGeoTransform(), dataset.GetProjection(),
+                      dataset.RasterXSize, dataset.RasterYSize,
+                      dataset.GetRasterBand(1).GetNoDataValue())
+
+
+def read_raster(source, band=1):
+    """
+    Reads one band as a float64 array with nodata replaced by NaN.
+    Returns (array, RasterInfo).
+    """
+    if isinstance(source, RasterReader):
+        return source.read_block(0, 0, source.info.ysize, source.info.xsize), source.info
+    dataset = open_raster(source)
+    raster_band = dataset.GetRasterBand(band)
+    array = raster_band.ReadAsArray().astype(np.float64)
+    nodata = raster_band.GetNoDataValue()
+    if nodata is not None:
+        array[array == nodata] = np.nan
+    apply_scale(raster_band, array)
+    info = RasterInfo(dataset.GetGeoTransform(), dataset.GetProjection(),
+                      dataset.RasterXSize, dataset.RasterYSize, nodata)
+    return array, info
+
+
+def window_info(info, row, col, rows, cols):
+    """
+    RasterInfo of a rows x cols window of info starting at (row, col).
+    """
+    gt = info.geotransform
+    origin = (gt[0] + col * gt[1] + row * gt[2], gt[3] + col * gt[4] + row * gt[5])
+    return RasterInfo((origin[0], gt[1], gt[2], origin[1], gt[4], gt[5]),
+                      info.projection, cols, rows, info.nodata)
+
+
+def read_window(source, row, col, rows, cols, band=1, halo=0):
+    """
+    Reads a window of one band as float64 with nodata replaced by NaN.
+    With halo the window carries that many extra cells on every side,
+    NaN where they fall outside the raster.
+    """
+    if isinstance(source, RasterReader):
+        top, left = max(row - halo, 0), max(col - halo, 0)
+        bottom = min(row + rows + halo, source.info.ysize)
+        right = min(col + cols + halo, source.info.xsize)
+        array = source.read_block(top, left, bottom - top, right - left)
+    else:
+        dataset = open_raster(source)
+        raster_band = dataset.GetRasterBand(band)
+        top, left = max(row - halo, 0), max(col - halo, 0)
+        bottom = min(row + rows + halo, dataset.RasterYSize)
+        right = min(col + cols + halo, dataset.RasterXSize)
+        array = raster_band.ReadAsArray(left, top, right - left, bottom - top).astype(np.float64)
+        nodata = raster_band.GetNoDataValue()
+        if nodata is not None:
+            array[array == nodata] = np.nan
+        apply_scale(raster_band, array)
+    if halo:
+        array = np.pad(array, ((top - (row - halo), row + rows + halo - bottom),
+                               (left - (col - halo), col + cols + halo - right)), constant_values=np.nan)
+    return array
+
+
+def rasterize_wkt(wkt, info):
+    """
+    Burns a polygon given as WKT (in the raster CRS) onto the raster grid,
+    cells touched by it included. Returns (row, col, mask) for the window
+    covering its envelope, or None if it misses the raster.
+    """
+    geometry = ogr.CreateGeometryFromWkt(wkt)
+    min_x, max_x, min_y, max_y = geometry.GetEnvelope()
+    gt = info.geotransform
+    col = int(np.floor((min_x - gt[0]) / gt[1]))
+    row = int(np.floor((max_y - gt[3]) / gt[5]))
+    # at least one cell, so points and lines along a cell edge are kept
+    col_end = min(max(int(np.ceil((max_x - gt[0]) / gt[1])), col + 1), info.xsize)
+    row_end = min(max(int(np.ceil((min_y - gt[3]) / gt[5])), row + 1), info.ysize)
+    col, row = max(col, 0), max(row, 0)
+    if col_end <= col or row_end <= row:
+        return None
+    window = window_info(info, row, col, row_end - row, col_end - col)
+    target = gdal.GetDriverByName('MEM').Create('', window.xsize, window.ysize, 1, gdal.GDT_Byte)
+    target.SetGeoTransform(window.geotransform)
+    source = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer = source.CreateLayer('geometry', geom_type=geometry.GetGeometryType())
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(geometry)
+    layer.CreateFeature(feature)
+    gdal.RasterizeLayer(target, [1], layer, burn_values=[1], options=['ALL_TOUCHED=TRUE'])
+    return row, col, target.GetRasterBand(1).ReadAsArray().astype(bool)
+
+
+def clip_raster(source, info, output):
+    """
+    Copies the part of source covering the grid of info, a window of the
+    same cell size and alignment, to output.
+    """
+    gt = raster_info(source).geotransform
+    col = int(round((info.geotransform[0] - gt[0]) / gt[1]))
+    row = int(round((info.geotransform[3] - gt[3]) / gt[5]))
+    if isinstance(source, RasterReader):
+        return write_raster(output, source.read_block(row, col, info.ysize, info.xsize), info, gdal.GDT_Float64)
+    return _translate(output, source, srcWin=[col, row, info.xsize, info.ysize])
+
+
+def copy_raster(source, output):
+    """
+    Copies a raster to output, in the format of output's extension.
+    """
+    return _translate(output, source)
+
+
+def driver_for_path(path):
+    """
+    Picks the GDAL driver from the file extension, GeoTIFF if unknown.
+    """
+    extension = os.path.splitext(path)[1].lower().lstrip('.')
+    for i in range(gdal.GetDriverCount()):
+        driver = gdal.GetDriver(i)
+        metadata = driver.GetMetadata() or {}
+        if metadata.get(gdal.DCAP_RASTER) != 'YES' or metadata.get(gdal.DCAP_CREATE) != 'YES':
+            continue
+        if extension in (metadata.get(gdal.DMD_EXTENSIONS) or '').split(' '):
+            return driver
+    return gdal.GetDriverByName('GTiff')
+
+
+def write_raster(path, array, info, data_type=gdal.GDT_Float32, nodata=OUTPUT_NODATA):
+    """
+    Writes a single band array with the georeferencing of info, NaN as nodata.
+    """
+    dataset = create_raster(path, info.xsize, info.ysize, 1, data_type)
+    dataset.SetGeoTransform(info.geotransform)
+    dataset.SetProjection(info.projection)
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(nodata)
+    band.WriteArray(np.where(np.isnan(array), nodata, array))
+    band.FlushCache()
+    dataset = None
+    return path
+
+
+def apply_scale(band, array):
+    """
+    Turns the raw values of a band stored with a scale and offset (see
+    erosion_flow_encoding) into its values, in place.
+    """
+    scale, offset = band.GetScale(), band.GetOffset()
+    if scale not in (None, 1.0) or offset not in (None, 0.0):
+        array *= 1.0 if scale is None else scale
+        array += offset or 0.0
+    return array
+
+
+def _read_rows(band, nodata, row, rows, halo=0):
+    """
+    Reads rows [row, row + rows) plus halo cells on every side, NaN where
+    the halo falls outside the raster or on nodata.
+    """
+    first = max(row - halo, 0)
+    last = min(row + rows + halo, band.YSize)
+    array = band.ReadAsArray(0, first, band.XSize, last - first).astype(np.float64)
+    if nodata is not None:
+        array[array == nodata] = np.nan
+    apply_scale(band, array)
+    if halo:
+        array = np.pad(array, ((first - (row - halo), row + rows + halo - last), (halo, halo)),
+                       constant_values=np.nan)
+    return array
+
+
+def block_calc(output, inputs, function, feedback=None, data_type=gdal.GDT_Float64, block_rows=BLOCK_ROWS, halo=0,
+               band_names=None, statistics=False, checkpoint=None, encoding=None):
+    """
+    Writes function(*values) to output, evaluated one band of rows at a time.
+    output may be a list of paths written in the same pass, function then
+    returning one array per path.
+
+    inputs are raster paths or RasterReaders, read as float arrays with nodata as NaN,
+    functions of the block's (row, rows) giving per block values such as
+    RasterInfo.cell_sizes, or numbers passed through unchanged; the first
+    raster sets the output grid.
+    With halo, raster blocks carry that many extra cells on every side for
+    neighbourhood operations and function returns only the block itself.
+    With band_names the output has one band per name and function returns
+    them stacked as (band, rows, cols).
+    With statistics, band statistics, percentiles and a histogram are
+    gathered on the way and stored with the output (see erosion_flow_stats).
+    Cancellation is checked and progress reported after every row band.
+    With a checkpoint (see erosion_flow_checkpoint) every completed row band
+    is recorded, and rows written by an earlier attempt are not computed
+    again.
+    With an encoding (see erosion_flow_encoding) values are stored as its
+    scaled integers instead of data_type, with a warning on feedback when
+    values outside its range were clipped. One without a scale is fitted,
+    band by band, to the first row band holding data and written in the
+    same pass; a resumed output keeps the encoding it was fitted to. A
+    staged one is fitted to the whole output instead, as a fallback costing
+    an extra pass: the output is computed into a Float32 staging raster,
+    then packed; with a checkpoint the staging raster is kept in the
+    checkpoint folder and resumed like any other output.
+    """
+    bands = []
+    info = None
+    for source in inputs:
+        if isinstance(source, RasterReader):
+            bands.append(source)
+            if info is None:
+                info = source.info
+        elif isinstance(source, str):
+            dataset = open_raster(source)
+            band = dataset.GetRasterBand(1)
+            bands.append((dataset, band, band.GetNoDataValue()))
+            if info is None:
+                info = RasterInfo(dataset.GetGeoTransform(), dataset.GetProjection(),
+                                  dataset.RasterXSize, dataset.RasterYSize)
+        else:
+            bands.append(source)
+    if encoding is not None and encoding.scale is None and encoding.staged:
+        cells = info.xsize * info.ysize * len(band_names or [None])
+        if checkpoint is not None:
+            staging = checkpoint.path(os.path.splitext(os.path.basename(output))[0] + '_staging')
+        elif cells * 4 <= STAGING_BYTES:
+            staging = memory_path('Staging')
+        else:
+            staging = os.path.splitext(output)[0] + '_staging.tif'
+        try:
+            block_calc(staging, inputs, function, feedback, gdal.GDT_Float32, block_rows, halo, band_names, statistics=True,
+                       checkpoint=checkpoint)
+            result = pack_raster(staging, output, encoding, feedback, block_rows, statistics)
+        except Exception:
+            # a checkpointed run keeps the rows staged so far for a resume
+            if checkpoint is None:
+                remove_rasters([staging])
+            raise
+        remove_rasters([staging])
+        return result
+    nodata = encoding.nodata if encoding is not None else OUTPUT_NODATA
+    if encoding is not None:
+        data_type = encoding.data_type
+    outputs = list(output) if isinstance(output, (list, tuple)) else [output]
+    if len(outputs) > 1 and band_names:
+        raise ValueError('Several outputs are written one band each')
+    count = len(band_names or [None])
+    # rows every output has from an earlier attempt
+    start = min(checkpoint.rows(path) for path in outputs) if checkpoint is not None else 0
+    targets = []
+    for path in outputs:
+        target = None
+        if start:
+            try:
+                target = open_raster(path, update=True)
+            except RuntimeError:
+                # damaged by the interruption (e.g. a truncated file): written again from the first row
+                start = 0
+        if target is None or (target.RasterXSize, target.RasterYSize, target.RasterCount) != (info.xsize, info.ysize, count):
+            start = 0
+            target = create_raster(path, info.xsize, info.ysize, count, data_type)
+            target.SetGeoTransform(info.geotransform)
+            target.SetProjection(info.projection)
+        targets.append(target)
+    out_bands = [target.GetRasterBand(i + 1) for target in targets for i in range(count)]
+    encodings = [encoding for _ in out_bands]
+    if start and encoding is not None and encoding.scale is None:
+        # as fitted by the earlier attempt, which is repeated when it never fitted one
+        encodings = [encoding.resumed(out_band) for out_band in out_bands]
+        if None in encodings:
+            start = 0
+            encodings = [encoding for _ in out_bands]
+    for i, out_band in enumerate(out_bands):
+        out_band.SetNoDataValue(nodata)
+        if encodings[i] is not None and encodings[i].scale is not None:
+            encodings[i].apply(out_band)
+        if band_names:
+            out_band.SetDescription(band_names[i])
+    stats = [BandStatistics(info.xsize * info.ysize) for _ in out_bands] if statistics else []
+    clipped = 0
+    try:
+        # statistics of the rows resumed from are read back from the output
+        for row in range(0, start if stats else 0, block_rows):
+            rows = min(block_rows, start - row)
+            for out_band, band_stats in zip(out_bands, stats):
+                band_stats.add(_read_rows(out_band, nodata, row, rows, 0))
+        for row in range(start, info.ysize, block_rows):
+            check_canceled(feedback, row / float(info.ysize))
+            rows = min(block_rows, info.ysize - row)
+            values = [_read_rows(b[1], b[2], row, rows, halo) if isinstance(b, tuple)
+                      else read_window(b, row, 0, rows, info.xsize, halo=halo) if isinstance(b, RasterReader)
+                      else b(row, rows) if callable(b) else b
+                      for b in bands]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result = function(*values)
+            if not band_names and len(outputs) == 1:
+                result = [result]
+            for i, (out_band, band_result) in enumerate(zip(out_bands, result)):
+                band_result = np.broadcast_to(band_result, (rows, info.xsize))
+                if encodings[i] is not None and encodings[i].scale is None:
+                    finite = band_result[np.isfinite(band_result)]
+                    if finite.size:
+                        encodings[i] = encoding.fitted(float(finite.min()), float(finite.max()))
+                        encodings[i].apply(out_band)
+                        if feedback is not None:
+                            feedback.pushConsoleInfo('{} stored as {}, fitted to its first rows'.format(
+                                outputs[i // count], encodings[i].describe()))
+                if encodings[i] is None:
+                    stored = np.where(np.isnan(band_result), OUTPUT_NODATA, band_result)
+                elif encodings[i].scale is None:
+                    # no data yet to fit the encoding to
+                    stored = np.full(band_result.shape, nodata)
+                else:
+                    stored, band_clipped = encodings[i].encode(band_result)
+                    clipped += band_clipped
+                if stats:
+                    # of the values as stored, rounded and clipped when encoded
+                    stats[i].add(encodings[i].decode(stored) if encodings[i] is not None and encodings[i].scale is not None
+                                 else band_result)
+                out_band.WriteArray(stored, 0, row)
+            if checkpoint is not None:
+                for out_band in out_bands:
+                    out_band.FlushCache()
+                for path in outputs:
+                    checkpoint.rows_written(path, row + rows)
+        for i, out_band in enumerate(out_bands):
+            if encodings[i] is not None and encodings[i].scale is None:
+                # nodata throughout
+                encodings[i] = encoding.fitted(0.0, 0.0)
+                encodings[i].apply(out_band)
+        for out_band, band_encoding, band_stats in zip(out_bands, encodings, stats):
+            if band_encoding is not None:
+                band_stats.write(out_band, band_encoding.scale, band_encoding.offset)
+            else:
+                band_stats.write(out_band)
+        for out_band in out_bands:
+            out_band.FlushCache()
+        if clipped and feedback is not None:
+            if encoding.scale is None:
+                feedback.pushWarning('{} values of {} outside the range its encoding was fitted to from its first rows were '
+                                     'clipped to it; give an encoding scale covering the whole range to keep them'.format(clipped, ', '.join(outputs)))
+            else:
+                feedback.pushWarning('{} values of {} outside the range of {} were clipped to it'.format(clipped, ', '.join(outputs), encoding.describe()))
+    finally:
+        out_bands = None
+        out_band = None
+        targets = None
+        target = None
+    check_canceled(feedback, 1.0)
+    return output
+
+
+def pack_raster(source, output, encoding, feedback=None, block_rows=BLOCK_ROWS, statistics=False):
+    """
+    Copies a float raster to output stored as the integers of encoding, fitted
+    to the range in the band statistics of source when it has no scale.
+    """
+    dataset = open_raster(source)
+    bands = [dataset.GetRasterBand(i + 1) for i in range(dataset.RasterCount)]
+    if encoding.scale is None:
+        ranges = [r for r in (stored_statistics(band) for band in bands) if r is not None]
+        encoding = encoding.fitted(min([r['min'] for r in ranges] or [0.0]), max([r['max'] for r in ranges] or [0.0]))
+    if feedback is not None:
+        feedback.pushConsoleInfo('Output stored as ' + encoding.describe())
+    if len(bands) == 1:
+        return block_calc(output, [source], lambda values: values, feedback, block_rows=block_rows,
+                          statistics=statistics, encoding=encoding)
+    # every band of a multiband source, stacked
+    stacked = lambda row, rows: np.stack([_read_rows(band, band.GetNoDataValue(), row, rows) for band in bands])
+    return block_calc(output, [source, stacked], lambda first, values: values, feedback, block_rows=block_rows,
+                      band_names=[band.GetDescription() for band in bands], statistics=statistics, encoding=encoding)
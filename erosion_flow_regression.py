@@ -0,0 +1,232 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+"""
+
+import csv
+import os
+import time
+
+from qgis.core import QgsApplication
+from qgis.core import QgsProcessing
+from qgis.core import QgsProcessingAlgorithm
+from qgis.core import QgsProcessingException
+from qgis.core import QgsProcessingParameterMultipleLayers
+from qgis.core import QgsProcessingParameterMapLayer
+from qgis.core import QgsProcessingParameterNumber
+from qgis.core import QgsProcessingParameterBoolean
+from qgis.core import QgsProcessingParameterFile
+from qgis.core import QgsProcessingParameterFileDestination
+from qgis.core import QgsProcessingUtils
+from osgeo import gdal
+import processing
+
+from .erosion_flow_engine import Canceled, ls_factor, rusle
+from .erosion_flow_raster import block_calc, remove_rasters
+from .erosion_flow_routing import MFD
+from .erosion_flow_stages import flow_accumulation, slope_raster, aspect_raster
+from .erosion_flow_golden import GOLDEN_OUTPUTS, CIRCULAR, compare_rasters, golden_folder, golden_paths, load_golden, save_golden
+
+# SAGA Flow Accumulation (Top-Down), as named by the SAGA Next Gen and the older SAGA provider
+SAGA_FLOW = ['sagang:flowaccumulationtopdown', 'saga:flowaccumulationtopdown']
+
+
+class EngineRegression(QgsProcessingAlgorithm):
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterMultipleLayers('dems', 'Filled DEMs to check on', layerType=QgsProcessing.TypeRaster, defaultValue=None))
+        self.addParameter(QgsProcessingParameterMapLayer('kfactor', 'K factor raster', optional=True, defaultValue=None, types=[QgsProcessing.TypeRaster]))
+        self.addParameter(QgsProcessingParameterMapLayer('cfactor', 'C factor raster', optional=True, defaultValue=None, types=[QgsProcessing.TypeRaster]))
+        self.addParameter(QgsProcessingParameterMapLayer('rfactor', 'R factor raster', optional=True, defaultValue=None, types=[QgsProcessing.TypeRaster]))
+        self.addParameter(QgsProcessingParameterNumber('kfactorsinglevalue', 'K factor single value', optional=True, type=QgsProcessingParameterNumber.Double, defaultValue=0.05))
+        self.addParameter(QgsProcessingParameterNumber('cfactorsinglevalue', 'C factor single value', optional=True, type=QgsProcessingParameterNumber.Double, defaultValue=0.5))
+        self.addParameter(QgsProcessingParameterNumber('rfactorsinglevalue', 'R factor single value', optional=True, type=QgsProcessingParameterNumber.Double, defaultValue=750))
+        self.addParameter(QgsProcessingParameterNumber('lssheetfactor', 'LS sheet factor', optional=True, type=QgsProcessingParameterNumber.Double, minValue=0.4, maxValue=0.6, defaultValue=0.5))
+        self.addParameter(QgsProcessingParameterNumber('lsrillfactor', 'LS rill factor', optional=True, type=QgsProcessingParameterNumber.Double, minValue=1, maxValue=1.3, defaultValue=1.1))
+        self.addParameter(QgsProcessingParameterNumber('relativetolerance', 'Relative tolerance', type=QgsProcessingParameterNumber.Double, minValue=0, defaultValue=0.001))
+        self.addParameter(QgsProcessingParameterNumber('absolutetolerance', 'Absolute tolerance', type=QgsProcessingParameterNumber.Double, minValue=0, defaultValue=0.000001))
+        self.addParameter(QgsProcessingParameterNumber('maxoutside', 'Allowed share of cells outside tolerance', type=QgsProcessingParameterNumber.Double, minValue=0, maxValue=1, defaultValue=0.01))
+        self.addParameter(QgsProcessingParameterNumber('minspeedup', 'Minimum speedup over the reference chain', type=QgsProcessingParameterNumber.Double, minValue=0, defaultValue=1.0))
+        self.addParameter(QgsProcessingParameterNumber('maxslowdown', 'Allowed slowdown over the engine run time stored with golden outputs', type=QgsProcessingParameterNumber.Double, minValue=1, defaultValue=1.5))
+        self.addParameter(QgsProcessingParameterFile('goldenfolder', 'Golden outputs folder (reference outputs kept between checks)', behavior=QgsProcessingParameterFile.Folder, optional=True, defaultValue=None))
+        self.addParameter(QgsProcessingParameterBoolean('refreshgolden', 'Rerun the reference chain even if golden outputs exist', defaultValue=False))
+        self.addParameter(QgsProcessingParameterFileDestination('REPORT', 'Regression report', fileFilter='CSV files (*.csv)'))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        layers = self.parameterAsLayerList(parameters, 'dems', context)
+        if not layers:
+            raise QgsProcessingException(self.invalidRasterError(parameters, 'dems'))
+        factors = []
+        for factor in ('kfactor', 'cfactor', 'rfactor'):
+            layer = self.parameterAsRasterLayer(parameters, factor, context)
+            if layer is not None:
+                factors.append(layer.source())
+            else:
+                factors.append(self.parameterAsDouble(parameters, factor + 'singlevalue', context))
+        m = self.parameterAsDouble(parameters, 'lssheetfactor', context)
+        n = self.parameterAsDouble(parameters, 'lsrillfactor', context)
+        rtol = self.parameterAsDouble(parameters, 'relativetolerance', context)
+        atol = self.parameterAsDouble(parameters, 'absolutetolerance', context)
+        maxOutside = self.parameterAsDouble(parameters, 'maxoutside', context)
+        minSpeedup = self.parameterAsDouble(parameters, 'minspeedup', context)
+        maxSlowdown = self.parameterAsDouble(parameters, 'maxslowdown', context)
+        goldenRoot = self.parameterAsFile(parameters, 'goldenfolder', context)
+        refresh = self.parameterAsBool(parameters, 'refreshgolden', context)
+        reportPath = self.parameterAsFileOutput(parameters, 'REPORT', context)
+        settings = {'m': m, 'n': n, 'factors': [f if isinstance(f, float) else os.path.basename(f) for f in factors]}
+
+        rows = []
+        failures = []
+        try:
+            for i, layer in enumerate(layers):
+                demSource = layer.source()
+                name = os.path.basename(demSource)
+                feedback.pushInfo('Checking ' + name)
+                folder = golden_folder(goldenRoot or QgsProcessingUtils.tempFolder(), demSource)
+                os.makedirs(folder, exist_ok=True)
+                reference = golden_paths(folder)
+
+                # reference outputs from the processing chain, or the golden ones of an earlier check
+                golden = None if (refresh or not goldenRoot) else load_golden(folder, settings)
+                if golden is None:
+                    start = time.perf_counter()
+                    self.referenceChain(demSource, factors, m, n, reference, context, feedback)
+                    referenceSeconds = time.perf_counter() - start
+                else:
+                    feedback.pushInfo('Using golden outputs in ' + folder)
+                    referenceSeconds = golden['seconds']
+
+                start = time.perf_counter()
+                engine = self.engine(demSource, factors, m, n, feedback)
+                engineSeconds = time.perf_counter() - start
+                speedup = referenceSeconds / max(engineSeconds, 1e-9)
+                if golden is None:
+                    # the reference chain ran on this machine now, so the two times compare
+                    feedback.pushInfo('Reference chain {:.2f} s, engine {:.2f} s, speedup {:.2f}x'.format(referenceSeconds, engineSeconds, speedup))
+                    if speedup < minSpeedup:
+                        failures.append('{}: speedup {:.2f}x below {:.2f}x'.format(name, speedup, minSpeedup))
+                    save_golden(folder, settings, referenceSeconds, engineSeconds)
+                elif golden['engine_seconds'] is None:
+                    feedback.pushInfo('Engine {:.2f} s, recorded as the engine run time of the golden outputs'.format(engineSeconds))
+                    save_golden(folder, settings, referenceSeconds, engineSeconds)
+                else:
+                    # the stored reference time may be from another machine or load; the engine's own
+                    # stored time is the baseline for a slowdown
+                    slowdown = engineSeconds / max(golden['engine_seconds'], 1e-9)
+                    feedback.pushInfo('Engine {:.2f} s, {:.2f}x the {:.2f} s stored with the golden outputs'.format(
+                        engineSeconds, slowdown, golden['engine_seconds']))
+                    if slowdown > maxSlowdown:
+                        failures.append('{}: engine {:.2f}x slower than the {:.2f} s stored with the golden outputs, above {:.2f}x'.format(
+                            name, slowdown, golden['engine_seconds'], maxSlowdown))
+
+                for output in GOLDEN_OUTPUTS:
+                    try:
+                        errors = compare_rasters(reference[output], engine[output], rtol, atol, CIRCULAR.get(output), feedback)
+                    except ValueError as e:
+                        raise QgsProcessingException(str(e))
+                    feedback.pushInfo('  {}: {}'.format(output, errors.describe()))
+                    failed = errors.failed(maxOutside)
+                    if failed:
+                        failures.append('{} {}: {}'.format(name, output, errors.describe()))
+                    rows.append([name, output, errors.cells, errors.max_error, errors.mean_error, errors.max_relative,
+                                 errors.outside, errors.nodata_mismatch, round(referenceSeconds, 3),
+                                 round(engineSeconds, 3), round(speedup, 2), 'FAIL' if failed else 'OK'])
+                remove_rasters(engine.values())
+                feedback.setProgress(100.0 * (i + 1) / len(layers))
+        except Canceled:
+            return {}
+
+        with open(reportPath, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['dem', 'output', 'cells', 'max_error', 'mean_error', 'max_relative_error', 'outside_tolerance',
+                             'nodata_mismatch', 'reference_seconds', 'engine_seconds', 'speedup', 'result'])
+            writer.writerows(rows)
+
+        if failures:
+            raise QgsProcessingException('Engine regression check failed (report: {}):\n'.format(reportPath) + '\n'.join(failures))
+        feedback.pushInfo('Engine matches the reference chain on {} DEMs'.format(len(layers)))
+        return {'REPORT': reportPath}
+
+    def referenceChain(self, demSource, factors, m, n, outputs, context, feedback):
+        """
+        The processing chain the engine replaced: native:slope, native:aspect,
+        SAGA Flow Accumulation (Top-Down, MFD 1.1) and GDAL Calc formulas.
+        """
+        registry = QgsApplication.processingRegistry()
+        sagaFlow = next((a for a in SAGA_FLOW if registry.algorithmById(a) is not None), None)
+        if sagaFlow is None:
+            raise QgsProcessingException('The reference chain needs the SAGA provider (Flow Accumulation (Top-Down))')
+        run = lambda alg, params: processing.run(alg, params, context=context, feedback=feedback, is_child_algorithm=True)
+
+        run('native:slope', {'INPUT': demSource, 'Z_FACTOR': 1, 'OUTPUT': outputs['slope']})
+        run('native:aspect', {'INPUT': demSource, 'Z_FACTOR': 1, 'OUTPUT': outputs['aspect']})
+        run(sagaFlow, {
+            'ELEVATION': demSource,
+            'METHOD': 4,  # [4] Multiple Flow Direction
+            'CONVERGENCE': 1.1,
+            'FLOW_UNIT': 1,  # [1] cell area
+            'NO_NEGATIVES': True,
+            'LINEAR_DO': False,
+            'STEP': 1,
+            'FLOW': outputs['flowaccumulation'],
+        })
+        if feedback.isCanceled():
+            raise Canceled()
+
+        calc = {'BAND_A': 1, 'BAND_B': 1, 'BAND_C': 1, 'BAND_D': 1, 'EXTRA': '', 'NO_DATA': None, 'OPTIONS': '', 'RTYPE': 6}
+        run('gdal:rastercalculator', dict(calc, INPUT_A=outputs['flowaccumulation'], INPUT_B=outputs['slope'], OUTPUT=outputs['ls'],
+                                          FORMULA='({m} + 1) * power((A/22.1), {m}) * power((sin(B* 3.14159 / 180)/0.09), {n})'.format(m=m, n=n)))
+        formula = 'A'
+        inputs = {'INPUT_A': outputs['ls']}
+        for letter, factor in zip('BCD', factors):
+            if isinstance(factor, str):
+                inputs['INPUT_' + letter] = factor
+                formula += '*' + letter
+            else:
+                formula += '*' + str(factor)
+        run('gdal:rastercalculator', dict(calc, FORMULA=formula, OUTPUT=outputs['rusle'], **inputs))
+
+    def engine(self, demSource, factors, m, n, feedback):
+        """
+        The same outputs from the in-process engine, in temporary files.
+        """
+        outputs = {name: QgsProcessingUtils.generateTempFilename(name + '.tif') for name in GOLDEN_OUTPUTS}
+        slope_raster(demSource, outputs['slope'], feedback=feedback)
+        aspect_raster(demSource, outputs['aspect'], feedback=feedback)
+        flow_accumulation(demSource, outputs['flowaccumulation'], MFD, 1.1, feedback=feedback)
+        block_calc(outputs['ls'], [outputs['flowaccumulation'], outputs['slope']], lambda A, B: ls_factor(A, B, m, n), feedback, gdal.GDT_Float32)
+        block_calc(outputs['rusle'], [outputs['ls']] + factors, rusle, feedback)
+        return outputs
+
+    def name(self):
+        return 'EngineRegression'
+
+    def displayName(self):
+        return 'Engine regression check'
+
+    def group(self):
+        return ''
+
+    def groupId(self):
+        return ''
+
+    def shortHelpString(self):
+        return ('Runs the in-process engine and the processing chain it replaced (native slope and aspect, '
+                'SAGA Flow Accumulation (Top-Down) and GDAL raster calculator formulas) on a set of DEMs and '
+                'factors, compares slope, aspect, flow accumulation, LS and RUSLE cell by cell and reports the '
+                'max and mean error and the speedup. Fails when more cells than allowed are outside the '
+                'tolerance or the speedup falls below the minimum. With a golden outputs folder the '
+                'reference outputs are kept and reused, so later checks need no SAGA, together with the '
+                'engine run time of the check that made them; later checks fail when the engine is slower than '
+                'that by more than the allowed slowdown.')
+
+    def createInstance(self):
+        return EngineRegression()
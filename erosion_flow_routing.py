@@ -0,0 +1,458 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+
+ Flow routing on NumPy arrays: builds a receiver graph from a filled DEM
+ with D8, D-infinity or MFD routing and accumulates weights down it.
+
+ Relative cost per cell (receiver indices + weights + topological order):
+   D8     one receiver, no weights          ~8 bytes,  1x time
+   D-inf  two receivers with weights        ~20 bytes, ~2x time
+   MFD    up to eight receivers with weights ~68 bytes, ~5x time
+"""
+
+import os
+
+import numpy as np
+
+from .erosion_flow_engine import check_canceled, SubFeedback
+
+D8 = 0
+DINF = 1
+MFD = 2
+
+ROUTING_METHODS = [
+    'D8 - single receiver (fastest, least memory)',
+    'D-infinity - two receivers (Tarboton 1997)',
+    'MFD - multiple flow direction (slowest, most accurate)',
+]
+
+METHOD_KEYS = ['d8', 'dinf', 'mfd']
+
+GRAPH_SUFFIX = '.flowgraph.npz'
+
+# smallest share of a cell's flow outlet_shares follows
+MIN_SHARE = 1e-12
+
+# neighbour offsets (row, col) counter-clockwise from east
+OFFSETS = [(0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1), (1, 0), (1, 1)]
+
+# D-infinity facets as (cardinal, diagonal) indices into OFFSETS
+FACETS = [(0, 1), (2, 1), (2, 3), (4, 3), (4, 5), (6, 5), (6, 7), (0, 7)]
+
+
+class FlowGraph(object):
+    """
+    Receiver graph of a raster, cells indexed in row-major (flat) order.
+
+    receivers is a (k, n) int32 array of downstream cell indices, -1 where a
+    slot is unused; weights is a matching (k, n) float32 array of flow
+    partitions, or None for single receiver routing. order holds the cells in
+    topological order, split into independent levels by level_bounds.
+    """
+
+    def __init__(self, shape, method, receivers, weights, order, level_bounds):
+        self.shape = shape
+        self.method = method
+        self.receivers = receivers
+        self.weights = weights
+        self.order = order
+        self.level_bounds = level_bounds
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def nbytes(self):
+        total = self.receivers.nbytes + self.order.nbytes + self.level_bounds.nbytes
+        if self.weights is not None:
+            total += self.weights.nbytes
+        return total
+
+
+def _neighbour_drops(dem, cell_size):
+    """
+    Yields (direction, drop per unit distance) for each of the 8 neighbours.
+    Cells outside the raster or without data give -inf.
+    """
+    rows, cols = dem.shape
+    dx, dy = cell_size
+    padded = np.full((rows + 2, cols + 2), np.nan)
+    padded[1:-1, 1:-1] = dem
+    for d, (dr, dc) in enumerate(OFFSETS):
+        dist = np.hypot(dr * dy, dc * dx)
+        neighbour = padded[1 + dr:1 + dr + rows, 1 + dc:1 + dc + cols]
+        drop = (dem - neighbour) / dist
+        drop[np.isnan(drop)] = -np.inf
+        yield d, drop
+
+
+def _flat_offsets(cols):
+    return [dr * cols + dc for dr, dc in OFFSETS]
+
+
+def _d8_receivers(dem, cell_size, feedback=None):
+    rows, cols = dem.shape
+    best = np.zeros(dem.shape)
+    direction = np.full(dem.shape, -1, dtype=np.int8)
+    for d, drop in _neighbour_drops(dem, cell_size):
+        check_canceled(feedback, d / 8.0)
+        steeper = drop > best
+        best[steeper] = drop[steeper]
+        direction[steeper] = d
+    index = np.arange(rows * cols, dtype=np.int32)
+    flat = np.asarray(_flat_offsets(cols), dtype=np.int32)
+    direction = direction.ravel()
+    receivers = np.where(direction >= 0, index + flat[direction], -1).astype(np.int32)
+    return receivers.reshape(1, -1), None
+
+
+def _mfd_receivers(dem, cell_size, convergence, feedback=None):
+    rows, cols = dem.shape
+    n = rows * cols
+    index = np.arange(n, dtype=np.int32)
+    receivers = np.full((8, n), -1, dtype=np.int32)
+    weights = np.zeros((8, n), dtype=np.float32)
+    for d, drop in _neighbour_drops(dem, cell_size):
+        check_canceled(feedback, d / 8.0)
+        drop = drop.ravel()
+        down = drop > 0
+        weights[d, down] = np.power(drop[down], convergence)
+        receivers[d, down] = index[down] + _flat_offsets(cols)[d]
+    total = weights.sum(axis=0)
+    has_flow = total > 0
+    weights[:, has_flow] /= total[has_flow]
+    return receivers, weights
+
+
+def _per_cell(size, shape):
+    # cell sizes given per row (geographic rasters) spread over the flattened cells
+    return np.broadcast_to(size, shape).ravel() if np.ndim(size) else size
+
+
+def _dinf_receivers(dem, cell_size, feedback=None):
+    rows, cols = dem.shape
+    n = rows * cols
+    dx, dy = [_per_cell(size, dem.shape) for size in cell_size]
+    drops = dict(_neighbour_drops(dem, cell_size))
+    best_slope = np.zeros(n)
+    first = np.full(n, -1, dtype=np.int8)
+    second = np.full(n, -1, dtype=np.int8)
+    share = np.zeros(n, dtype=np.float32)
+    for facet, (cardinal, diagonal) in enumerate(FACETS):
+        check_canceled(feedback, facet / 8.0)
+        dr, dc = OFFSETS[cardinal]
+        d1, d2 = (dx, dy) if dr == 0 else (dy, dx)
+        r_max = np.arctan2(d2, d1)
+        # drop to the cardinal neighbour and from it across to the diagonal one
+        s1 = drops[cardinal].ravel()
+        with np.errstate(invalid='ignore'):
+            s2 = (drops[diagonal].ravel() * np.hypot(d1, d2) - s1 * d1) / d2
+            r = np.arctan2(s2, s1)
+            s = np.hypot(s1, s2)
+        to_cardinal = ~(r > 0)
+        to_diagonal = r > r_max
+        s[to_cardinal] = s1[to_cardinal]
+        s[to_diagonal] = drops[diagonal].ravel()[to_diagonal]
+        r = np.clip(np.nan_to_num(r), 0, r_max)
+        steeper = s > best_slope
+        best_slope[steeper] = s[steeper]
+        first[steeper] = cardinal
+        second[steeper] = diagonal
+        share[steeper] = (r / r_max)[steeper]
+    index = np.arange(n, dtype=np.int32)
+    flat = np.asarray(_flat_offsets(cols), dtype=np.int32)
+    receivers = np.full((2, n), -1, dtype=np.int32)
+    weights = np.zeros((2, n), dtype=np.float32)
+    to_first = (first >= 0) & (share < 1)
+    receivers[0, to_first] = index[to_first] + flat[first[to_first]]
+    weights[0, to_first] = 1 - share[to_first]
+    to_second = (first >= 0) & (share > 0)
+    receivers[1, to_second] = index[to_second] + flat[second[to_second]]
+    weights[1, to_second] = share[to_second]
+    return receivers, weights
+
+
+def _topological_levels(receivers, n, feedback=None):
+    """
+    Orders cells so that every cell comes after all of its donors, grouped
+    into levels whose cells do not depend on each other (Kahn's algorithm,
+    one vectorised step per level).
+    """
+    valid = receivers >= 0
+    pending = np.bincount(receivers[valid], minlength=n).astype(np.int32)
+    frontier = np.flatnonzero(pending == 0).astype(np.int32)
+    order = np.empty(n, dtype=np.int32)
+    bounds = [0]
+    pos = 0
+    while frontier.size:
+        if len(bounds) % 64 == 0:
+            check_canceled(feedback, pos / float(n))
+        order[pos:pos + frontier.size] = frontier
+        pos += frontier.size
+        bounds.append(pos)
+        downstream = receivers[:, frontier]
+        downstream = downstream[downstream >= 0]
+        cells, counts = np.unique(downstream, return_counts=True)
+        pending[cells] -= counts.astype(np.int32)
+        frontier = cells[pending[cells] == 0]
+    return order[:pos], np.asarray(bounds, dtype=np.int64)
+
+
+def flow_receivers(dem, cell_size, method=MFD, convergence=1.1, feedback=None):
+    """
+    Receivers and weights of every cell as held by FlowGraph, without the
+    topological order, which is all that tracing upstream areas needs.
+    """
+    dem = np.asarray(dem, dtype=np.float64)
+    if method == D8:
+        return _d8_receivers(dem, cell_size, feedback)
+    if method == DINF:
+        return _dinf_receivers(dem, cell_size, feedback)
+    if method == MFD:
+        return _mfd_receivers(dem, cell_size, convergence, feedback)
+    raise ValueError('Unknown flow routing method: {}'.format(method))
+
+
+def build_flow_graph(dem, cell_size, method=MFD, convergence=1.1, feedback=None, outlets=None):
+    """
+    Builds the receiver graph of a filled DEM.
+
+    dem is a 2D float array with NaN for nodata, cell_size the (x, y) cell
+    dimensions in map units, or in metres per row as (rows, 1) columns for
+    a geographic raster (see RasterInfo.cell_sizes). convergence is the MFD slope exponent.
+    feedback (optional) is checked for cancellation and given progress.
+    outlets (optional) is a boolean array of cells that keep what flows
+    into them, such as the halo of a tile.
+    """
+    dem = np.asarray(dem, dtype=np.float64)
+    receivers, weights = flow_receivers(dem, cell_size, method, convergence, SubFeedback(feedback, 0, 60))
+    if outlets is not None:
+        receivers[:, np.ravel(outlets)] = -1
+    order, bounds = _topological_levels(receivers, dem.size, SubFeedback(feedback, 60, 100))
+    return FlowGraph(dem.shape, method, receivers, weights, order, bounds)
+
+
+def accumulate(graph, weight, feedback=None):
+    """
+    Accumulates weight (a scalar or an array of the graph's shape) down the
+    flow graph, each cell including its own weight.
+    """
+    acc = np.empty(graph.size)
+    acc[:] = np.ravel(weight)
+    for level in range(len(graph.level_bounds) - 1):
+        if level % 64 == 0:
+            check_canceled(feedback, graph.level_bounds[level] / float(graph.size))
+        cells = graph.order[graph.level_bounds[level]:graph.level_bounds[level + 1]]
+        downstream = graph.receivers[:, cells]
+        routed = downstream >= 0
+        if graph.weights is None:
+            flux = np.broadcast_to(acc[cells], downstream.shape)
+        else:
+            flux = acc[cells] * graph.weights[:, cells]
+        np.add.at(acc, downstream[routed], flux[routed])
+    return acc.reshape(graph.shape)
+
+
+def route_load(graph, load, delivery_ratio=1.0, capacity=None, feedback=None):
+    """
+    Routes a load (sediment supplied by each cell, negative where it is
+    deposited) down the flow graph in one sweep. Each cell passes on what
+    it receives plus its own load, never below zero, limited to capacity
+    (optional array) and scaled by delivery_ratio (a number or an array).
+    Returns the load leaving each cell.
+    """
+    out = np.empty(graph.size)
+    out[:] = np.ravel(load)
+    ratio = np.ravel(delivery_ratio) if np.ndim(delivery_ratio) else None
+    cap = None if capacity is None else np.ravel(capacity)
+    for level in range(len(graph.level_bounds) - 1):
+        if level % 64 == 0:
+            check_canceled(feedback, graph.level_bounds[level] / float(graph.size))
+        cells = graph.order[graph.level_bounds[level]:graph.level_bounds[level + 1]]
+        # every donor of a level is in an earlier one, so its inflow is complete
+        leaving = np.maximum(out[cells], 0)
+        if cap is not None:
+            leaving = np.minimum(leaving, cap[cells])
+        leaving *= delivery_ratio if ratio is None else ratio[cells]
+        out[cells] = leaving
+        downstream = graph.receivers[:, cells]
+        routed = downstream >= 0
+        if graph.weights is None:
+            flux = np.broadcast_to(leaving, downstream.shape)
+        else:
+            flux = leaving * graph.weights[:, cells]
+        np.add.at(out, downstream[routed], flux[routed])
+    return out.reshape(graph.shape)
+
+
+def flow_graph_path(dem_path, method):
+    """
+    Path of the saved flow graph kept next to a DEM file, one per method.
+    """
+    return '{}.{}{}'.format(os.path.splitext(dem_path)[0], METHOD_KEYS[method], GRAPH_SUFFIX)
+
+
+def save_flow_graph(graph, path, key=''):
+    """
+    Saves the graph as an uncompressed .npz array file. key identifies the
+    inputs it was built from so stale graphs are not reused.
+    """
+    weights = graph.weights if graph.weights is not None else np.empty((0, 0), dtype=np.float32)
+    partial = path + '.part'
+    with open(partial, 'wb') as f:
+        np.savez(f, shape=np.asarray(graph.shape), method=np.asarray(graph.method),
+                 receivers=graph.receivers, weights=weights, order=graph.order,
+                 level_bounds=graph.level_bounds, key=np.asarray(key))
+    os.replace(partial, path)
+    return path
+
+
+def load_flow_graph(path, key=''):
+    """
+    Loads a graph saved by save_flow_graph, None if missing or built from
+    different inputs.
+    """
+    if not os.path.isfile(path):
+        return None
+    with np.load(path, allow_pickle=False) as data:
+        if str(data['key']) != key:
+            return None
+        weights = data['weights']
+        return FlowGraph(tuple(int(v) for v in data['shape']), int(data['method']),
+                         data['receivers'], weights if weights.size else None,
+                         data['order'], data['level_bounds'])
+
+
+def donor_index(receivers):
+    """
+    Reverse adjacency of a (k, n) receivers array (FlowGraph.receivers) in
+    CSR form: the donors of cell i are donors[indptr[i]:indptr[i + 1]].
+    """
+    k, n = receivers.shape
+    sources = np.tile(np.arange(n, dtype=np.int32), k)
+    targets = receivers.ravel()
+    routed = targets >= 0
+    sources, targets = sources[routed], targets[routed]
+    order = np.argsort(targets, kind='stable')
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(targets, minlength=n), out=indptr[1:])
+    return indptr, sources[order]
+
+
+def upstream_cells(donors, seeds, visited=None):
+    """
+    Flat indices of seeds and every cell draining into them, found by a
+    breadth-first walk up a donor_index. visited is an optional scratch
+    boolean array of the graph size, left cleared again on return, so
+    repeated traces do not allocate a full raster each.
+    """
+    indptr, sources = donors
+    if visited is None:
+        visited = np.zeros(len(indptr) - 1, dtype=bool)
+    frontier = np.unique(np.asarray(seeds, dtype=np.int64))
+    visited[frontier] = True
+    found = [frontier]
+    while frontier.size:
+        starts = indptr[frontier]
+        counts = indptr[frontier + 1] - starts
+        total = counts.sum()
+        if not total:
+            break
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(total)
+        candidates = np.unique(sources[positions])
+        frontier = candidates[~visited[candidates]]
+        visited[frontier] = True
+        found.append(frontier)
+    cells = np.concatenate(found)
+    visited[cells] = False
+    return cells
+
+
+def outlet_shares(graph, sources, outlets):
+    """
+    Where the flow entering each of the sources (flat indices) ends up
+    among the outlets (a boolean array of the graph's shape): returns
+    (source, outlet, share) arrays, one entry per outlet a source reaches,
+    share being the fraction of a unit of flow at the source arriving
+    there. Flow ending in other cells without receivers (pits, nodata
+    edges) is not listed.
+
+    One sweep up the graph from the outlets, each cell downstream of a
+    source taking the weighted shares of its receivers; single receiver
+    routing reaches one outlet per cell, divergent routing as many as its
+    flow spreads over. Shares below MIN_SHARE, far below the precision of
+    the float32 flow partitions, are dropped to keep those lists short.
+    """
+    sources = np.asarray(sources, dtype=np.int64)
+    outlets = np.ravel(outlets)
+    order, bounds = graph.order, graph.level_bounds
+    # cells flow from the sources passes through
+    reached = np.zeros(graph.size, dtype=bool)
+    reached[sources] = True
+    for level in range(len(bounds) - 1):
+        cells = order[bounds[level]:bounds[level + 1]]
+        cells = cells[reached[cells]]
+        downstream = graph.receivers[:, cells]
+        reached[downstream[downstream >= 0]] = True
+
+    # each cell's shares are a run of entries in targets/shares, grown by doubling
+    ends = np.flatnonzero(outlets & reached)
+    start = np.zeros(graph.size, dtype=np.int64)
+    count = np.zeros(graph.size, dtype=np.int64)
+    start[ends] = np.arange(ends.size)
+    count[ends] = 1
+    targets = np.empty(max(ends.size, 1024), dtype=np.int64)
+    shares = np.empty(targets.size)
+    targets[:ends.size] = ends
+    shares[:ends.size] = 1
+    stored = ends.size
+    for level in range(len(bounds) - 2, -1, -1):
+        cells = order[bounds[level]:bounds[level + 1]]
+        cells = cells[reached[cells] & ~outlets[cells]]
+        downstream = graph.receivers[:, cells]
+        routed = downstream >= 0
+        receivers = downstream[routed]
+        counts = count[receivers]
+        total = counts.sum()
+        if not total:
+            continue
+        owners = np.broadcast_to(cells, downstream.shape)[routed]
+        weights = np.ones(receivers.size) if graph.weights is None else graph.weights[:, cells][routed]
+        pairs = np.repeat(np.arange(receivers.size), counts)
+        positions = np.repeat(start[receivers] - np.cumsum(counts) + counts, counts) + np.arange(total)
+        # one entry per cell and outlet, in cell order
+        keys = owners[pairs].astype(np.int64) * graph.size + targets[positions]
+        amounts = shares[positions] * weights[pairs]
+        ranked = np.argsort(keys, kind='stable')
+        keys, amounts = keys[ranked], amounts[ranked]
+        first = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        amounts = np.add.reduceat(amounts, first)
+        # shares far below the float32 flow partitions are dropped
+        kept = amounts >= MIN_SHARE
+        owner, target = np.divmod(keys[first][kept], graph.size)
+        amounts = amounts[kept]
+        runs = np.flatnonzero(np.r_[True, owner[1:] != owner[:-1]])
+        if stored + owner.size > targets.size:
+            grown = max(2 * targets.size, stored + owner.size)
+            targets = np.resize(targets, grown)
+            shares = np.resize(shares, grown)
+        targets[stored:stored + owner.size] = target
+        shares[stored:stored + owner.size] = amounts
+        start[owner[runs]] = stored + runs
+        count[owner[runs]] = np.diff(np.r_[runs, owner.size])
+        stored += owner.size
+
+    counts = count[sources]
+    total = counts.sum()
+    positions = np.repeat(start[sources] - np.cumsum(counts) + counts, counts) + np.arange(total)
+    return np.repeat(sources, counts), targets[positions], shares[positions]
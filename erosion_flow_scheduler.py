@@ -0,0 +1,226 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+
+ Runs the stages of an algorithm as a dependency graph on a thread pool,
+ so independent stages (slope, aspect, flow accumulation, qsx and qsy ...)
+ overlap and the critical path sets the wall time. The NumPy and GDAL
+ work inside the stages releases the GIL.
+
+ Intermediate rasters are removed as soon as the last stage reading them
+ has finished, and the peak space they took is recorded for the run log.
+ With a checkpoint, completed stages are recorded and skipped when the
+ run is resumed.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .erosion_flow_engine import Canceled
+from .erosion_flow_files import raster_bytes, remove_rasters, is_memory_path
+
+
+def usage_message(disk_bytes, memory_bytes=0):
+    return 'Peak intermediate rasters: {:.1f} MB on disk, {:.1f} MB in memory'.format(
+        disk_bytes / 1048576.0, memory_bytes / 1048576.0)
+
+
+class StageFeedback(object):
+    """
+    Feedback handed to one stage: cancellation and console messages pass
+    through, progress is combined over all stages by the graph.
+    """
+
+    def __init__(self, graph, name):
+        self.graph = graph
+        self.name = name
+
+    def isCanceled(self):
+        return self.graph.isCanceled()
+
+    def setProgress(self, progress):
+        self.graph.stageProgress(self.name, progress / 100.0)
+
+    def pushConsoleInfo(self, message):
+        if self.graph.feedback is not None:
+            self.graph.feedback.pushConsoleInfo(message)
+
+    def pushWarning(self, message):
+        if self.graph.feedback is not None:
+            self.graph.feedback.pushWarning(message)
+
+
+class StageGraph(object):
+    """
+    Stages added with add(name, function, *depends) are called with the
+    results of the stages they depend on, as soon as those are done, and a
+    feedback keyword argument for cancellation and progress. Results of
+    stages marked with temporary(...) are dropped once every stage
+    depending on them has finished, raster paths being removed.
+    With a checkpoint (see erosion_flow_checkpoint), stages recorded as
+    completed by an earlier attempt are not run again: those whose result
+    raster still exists, and temporaries already removed which no stage
+    left to run depends on. Temporaries no stage left to run depends on
+    are skipped even when not recorded (such as an in-memory DEM).
+    """
+
+    def __init__(self, feedback=None, max_workers=1, checkpoint=None):
+        self.feedback = feedback
+        self.checkpoint = checkpoint
+        self.max_workers = max(1, int(max_workers))
+        self.stages = {}
+        self.results = {}
+        self.temporaries = set()
+        self.tracked = []
+        # bytes of intermediate rasters alive at once: now and at the peak, on disk and in memory
+        self.live = {}
+        self.peak = {'disk': 0, 'memory': 0}
+        self._progress = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, function, *depends):
+        for dependency in depends:
+            if dependency not in self.stages:
+                raise ValueError('Stage {} depends on unknown stage {}'.format(name, dependency))
+        self.stages[name] = (function, depends)
+        return name
+
+    def temporary(self, *names):
+        """
+        Marks stages whose results are intermediates of the run: rasters,
+        or values kept in memory only while stages still need them.
+        """
+        self.temporaries.update(names)
+
+    def track(self, *paths):
+        """
+        Counts intermediate rasters made before the run (such as clipped
+        factors) in the usage while it runs; the caller removes them.
+        """
+        self.tracked.extend(p for p in paths if isinstance(p, str))
+
+    def _measure(self):
+        current = {'disk': 0, 'memory': 0}
+        for path in self.tracked + list(self.live.values()):
+            current['memory' if is_memory_path(path) else 'disk'] += raster_bytes(path)
+        for where in current:
+            self.peak[where] = max(self.peak[where], current[where])
+
+    def usage(self):
+        """
+        The peak space of the run's intermediate rasters, for the log.
+        """
+        return usage_message(self.peak['disk'], self.peak['memory'])
+
+    def isCanceled(self):
+        return self.feedback is not None and self.feedback.isCanceled()
+
+    def stageProgress(self, name, fraction):
+        with self._lock:
+            self._progress[name] = min(max(fraction, 0.0), 1.0)
+            total = sum(self._progress.values()) / len(self.stages)
+        if self.feedback is not None:
+            self.feedback.setProgress(100.0 * total)
+
+    def _run_stage(self, name):
+        function, depends = self.stages[name]
+        if self.isCanceled():
+            raise Canceled()
+        result = function(*[self.results[d] for d in depends], feedback=StageFeedback(self, name))
+        self.stageProgress(name, 1.0)
+        return result
+
+    def _resumed(self):
+        """
+        Stages completed by an earlier attempt that need not run again.
+        """
+        if self.checkpoint is None:
+            return set()
+        recorded = set(name for name in self.stages if self.checkpoint.stage(name) is not None)
+        resumed = recorded | self.temporaries
+        while True:
+            # a removed or unrecorded result has to be made again for any stage still to run
+            needed = set(d for name, (_, depends) in self.stages.items() if name not in resumed for d in depends)
+            # and results handed back, unlike temporaries, have to exist
+            lost = set(name for name in resumed if (name in needed or name not in self.temporaries)
+                       and (name not in recorded or not os.path.exists(self.checkpoint.stage(name))))
+            if not lost:
+                return resumed
+            resumed -= lost
+
+    def run(self):
+        """
+        Runs every stage, returning the dict of stage results. The first
+        failing stage stops new stages from starting and its error is raised
+        once the running ones have finished.
+        """
+        resumed = self._resumed()
+        for name in resumed:
+            if self.checkpoint.stage(name) is not None:
+                self.results[name] = self.checkpoint.stage(name)
+            self.stageProgress(name, 1.0)
+        if self.results and self.feedback is not None:
+            self.feedback.pushInfo('Resumed from checkpoint: ' + ', '.join(sorted(self.results)))
+        pending = dict((name, stage) for name, stage in self.stages.items() if name not in resumed)
+        running = {}
+        error = None
+        # stages still to read each temporary result
+        readers = {name: sum(name in depends for _, depends in pending.values()) for name in self.temporaries}
+        # temporaries kept by the earlier attempt go with their last remaining reader, or now if none is left
+        for name in resumed & self.temporaries:
+            if isinstance(self.results.get(name), str):
+                self.live[name] = self.results[name]
+        self._measure()
+        for name in resumed & self.temporaries:
+            if not readers[name] and name in self.live:
+                remove_rasters([self.live.pop(name)])
+                del self.results[name]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                if error is None:
+                    ready = [name for name, (_, depends) in pending.items()
+                             if all(d in self.results for d in depends)]
+                    for name in ready[:self.max_workers - len(running)]:
+                        del pending[name]
+                        running[pool.submit(self._run_stage, name)] = name
+                if not running:
+                    break
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                    else:
+                        self.results[name] = future.result()
+                        # recorded before the inputs it consumed are removed
+                        if self.checkpoint is not None and isinstance(self.results[name], str):
+                            self.checkpoint.complete(name, self.results[name])
+                        self._release(name, readers)
+        if error is not None:
+            raise error
+        if pending:
+            raise ValueError('Stages with unmet dependencies: ' + ', '.join(sorted(pending)))
+        return self.results
+
+    def _release(self, name, readers):
+        # measured with the new result in place, before the inputs it consumed are removed
+        if name in self.temporaries and isinstance(self.results[name], str):
+            self.live[name] = self.results[name]
+        self._measure()
+        for dependency in set(self.stages[name][1]):
+            if dependency not in readers:
+                continue
+            readers[dependency] -= 1
+            if readers[dependency] == 0:
+                if dependency in self.live:
+                    remove_rasters([self.live.pop(dependency)])
+                self.results.pop(dependency, None)
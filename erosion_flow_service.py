@@ -0,0 +1,427 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+
+ Long running local job service for many small requests on the same few
+ DEMs, without a QGIS session (NumPy and GDAL only):
+
+     python -m erosion_flow.erosion_flow_service --port 8765
+     python -m erosion_flow.erosion_flow_service --socket /tmp/erosion_flow.sock
+
+ The DEM array, flow graph, flow accumulation, slope and aspect of
+ recently used DEMs stay in memory (least recently used dropped first
+ over --cache-mb), so a job on a warm DEM only reads its factors and
+ evaluates the formulas. Jobs run on a pool of --workers threads.
+
+ POST /jobs with a JSON job, e.g.
+     {"model": "usped", "dem": "/data/dem.tif", "k": 0.05, "c": "/data/c.tif",
+      "r": 750, "output": "/data/usped.tif", "wait": true}
+ model is ls, rusle, usped or flowaccumulation; k, c and r are numbers or
+ raster paths on the DEM grid; optional m, n, rill, method (d8, dinf,
+ mfd) and convergence. Returns the job with its id, status, output path
+ and result statistics, once finished with "wait". GET /jobs/<id> returns
+ a job, GET /metrics the queue depth, cache hit rate and job counts.
+
+ Jobs only read and write rasters inside --root (the working folder by
+ default), relative paths are taken from there. The service listens on
+ the loopback interface only, unless --allow-remote is given with --host.
+"""
+
+import argparse
+import ipaddress
+import itertools
+import json
+import os
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+
+from . import erosion_flow_api as api
+from .erosion_flow_raster import read_raster, write_raster
+from .erosion_flow_routing import METHOD_KEYS, MFD, flow_graph_path
+from .erosion_flow_stages import dem_graph_key, flow_graph
+
+MODELS = ['ls', 'rusle', 'usped', 'flowaccumulation']
+
+CACHE_MB = 2048
+
+# finished jobs kept for GET /jobs/<id>
+JOB_HISTORY = 1000
+
+
+class TerrainEntry(object):
+    """
+    A DEM resident in memory with the terms every job on it starts from.
+    """
+
+    def __init__(self, dem, info, graph, topo):
+        self.dem = dem
+        self.info = info
+        self.graph = graph
+        self.topo = topo
+
+    @property
+    def nbytes(self):
+        return self.dem.nbytes + self.graph.nbytes + self.topo.nbytes
+
+
+class TerrainCache(object):
+    """
+    Recently used DEMs by file state and routing settings, least recently
+    used evicted once over max_bytes. Concurrent misses on one DEM load it once.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._loading = {}
+
+    def get(self, dem_source, method=MFD, convergence=1.1):
+        """
+        (entry, hit) for a DEM file.
+        """
+        key = dem_graph_key(dem_source, method, convergence) + ':' + os.path.abspath(dem_source)
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key], True
+            loading = self._loading.setdefault(key, threading.Lock())
+        with loading:
+            with self._lock:
+                if key in self.entries:
+                    self.hits += 1
+                    return self.entries[key], True
+                self.misses += 1
+            try:
+                entry = self.load(dem_source, method, convergence)
+                with self._lock:
+                    self.entries[key] = entry
+                    self.evict()
+            finally:
+                with self._lock:
+                    self._loading.pop(key, None)
+        return entry, False
+
+    def load(self, dem_source, method, convergence):
+        dem, info = read_raster(dem_source)
+        # a flow graph saved next to the DEM by the plugin is reused
+        graph = flow_graph(dem, info, dem_source, method, convergence, reuse_graph=os.path.isfile(flow_graph_path(dem_source, method)))
+        topo = api.topography(dem, info.geotransform, method, convergence, graph=graph, ellipsoid=info.ellipsoid)
+        return TerrainEntry(dem, info, graph, topo)
+
+    def evict(self):
+        # the newest entry is kept even when alone over the limit
+        while len(self.entries) > 1 and self.size() > self.max_bytes:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def size(self):
+        return sum(entry.nbytes for entry in self.entries.values())
+
+    def metrics(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'cached_dems': len(self.entries),
+                'cache_bytes': self.size(),
+                'cache_hits': self.hits,
+                'cache_misses': self.misses,
+                'cache_hit_rate': self.hits / float(lookups) if lookups else 0.0,
+                'cache_evictions': self.evictions,
+            }
+
+
+def _factor(value, info, name):
+    if isinstance(value, str):
+        array, factor_info = read_raster(value)
+        if factor_info.shape != info.shape:
+            raise ValueError('{} raster {} is not on the DEM grid'.format(name, value))
+        return array
+    return float(value)
+
+
+def _number(value, name):
+    """
+    A job's numeric field as a float, raising ValueError for anything else.
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not np.isfinite(value):
+        raise ValueError('{} must be a number'.format(name))
+    return float(value)
+
+
+def _statistics(result):
+    valid = result[~np.isnan(result)]
+    if not valid.size:
+        return {'cells': 0}
+    return {'cells': int(valid.size), 'min': float(valid.min()), 'max': float(valid.max()),
+            'mean': float(valid.mean()), 'sum': float(valid.sum())}
+
+
+class ErosionService(object):
+    """
+    Runs jobs (dicts, see the module notes) on a worker pool against a
+    TerrainCache. With root, the rasters jobs read and write must be inside
+    that folder.
+    """
+
+    def __init__(self, workers=1, cache_bytes=CACHE_MB * 1024 * 1024, root=None):
+        self.root = os.path.realpath(root) if root else None
+        self.cache = TerrainCache(cache_bytes)
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.workers = max(1, workers)
+        self.jobs = OrderedDict()
+        self.ids = itertools.count(1)
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def submit(self, job):
+        """
+        Validates and queues a job, returns (job id, future).
+        """
+        if not isinstance(job, dict):
+            raise ValueError('a job is a JSON object')
+        model = job.get('model')
+        if model not in MODELS:
+            raise ValueError('model must be one of ' + ', '.join(MODELS))
+        if not job.get('dem') or not isinstance(job['dem'], str):
+            raise ValueError('dem is required, as a raster path')
+        if job.get('output') is not None and not isinstance(job['output'], str):
+            raise ValueError('output must be a raster path')
+        for name in ('dem', 'k', 'c', 'r', 'output'):
+            if isinstance(job.get(name), str):
+                job[name] = self.path(job[name], name)
+        for name in ('k', 'c', 'r'):
+            if name in job and not isinstance(job[name], str):
+                job[name] = _number(job[name], name)
+        for name, default in (('m', 0.5), ('n', 1.1), ('convergence', 1.1)):
+            job[name] = _number(job.get(name, default), name)
+        if job['convergence'] < 0:
+            raise ValueError('convergence must not be negative')
+        if not isinstance(job.get('rill', True), bool):
+            raise ValueError('rill must be true or false')
+        method = job.get('method', MFD)
+        if isinstance(method, str) and method in METHOD_KEYS:
+            job['method'] = METHOD_KEYS.index(method)
+        elif isinstance(method, bool) or not isinstance(method, int) or not 0 <= method < len(METHOD_KEYS):
+            raise ValueError('method must be one of {} or its index'.format(', '.join(METHOD_KEYS)))
+        with self._lock:
+            job_id = str(next(self.ids))
+            self.jobs[job_id] = {'id': job_id, 'model': model, 'status': 'queued'}
+            while len(self.jobs) > JOB_HISTORY:
+                self.jobs.popitem(last=False)
+            self.queued += 1
+        return job_id, self.pool.submit(self._run, job_id, job)
+
+    def path(self, path, name):
+        """
+        The full path of a job's raster, raising ValueError outside the root folder.
+        """
+        if self.root is None:
+            return path
+        full = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath([full, self.root]) != self.root:
+            raise ValueError('{} {} is not inside the service root {}'.format(name, path, self.root))
+        return full
+
+    def _update(self, job_id, **values):
+        with self._lock:
+            if job_id in self.jobs:
+                self.jobs[job_id].update(values)
+
+    def _run(self, job_id, job):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        self._update(job_id, status='running')
+        start = time.perf_counter()
+        try:
+            result = self.compute(job_id, job)
+        except Exception as e:
+            with self._lock:
+                self.running -= 1
+                self.failed += 1
+            self._update(job_id, status='failed', error=str(e), seconds=time.perf_counter() - start)
+            return self.job(job_id)
+        seconds = time.perf_counter() - start
+        with self._lock:
+            self.running -= 1
+            self.completed += 1
+            self.seconds += seconds
+        self._update(job_id, status='done', seconds=seconds, **result)
+        return self.job(job_id)
+
+    def compute(self, job_id, job):
+        method = job['method']
+        entry, hit = self.cache.get(job['dem'], method, job['convergence'])
+        self._update(job_id, cache='hit' if hit else 'miss')
+        info, topo = entry.info, entry.topo
+        model = job['model']
+        if model == 'flowaccumulation':
+            result = topo.flow
+        elif model == 'ls':
+            result = api.ls(entry.dem, info.geotransform, job['m'], job['n'], topo=topo)
+        else:
+            k, c, r = [_factor(job.get(name, default), info, name.upper()) for name, default in (('k', 0.05), ('c', 0.5), ('r', 750))]
+            if model == 'rusle':
+                result = api.rusle(entry.dem, info.geotransform, k, c, r, job['m'], job['n'], topo=topo)
+            else:
+                result = api.usped(entry.dem, info.geotransform, k, c, r, job.get('rill', True), topo=topo)
+        values = {'statistics': _statistics(result)}
+        if job.get('output'):
+            values['output'] = write_raster(job['output'], result, info)
+        return values
+
+    def job(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def metrics(self):
+        with self._lock:
+            metrics = {
+                'queue_depth': self.queued,
+                'running': self.running,
+                'workers': self.workers,
+                'jobs_completed': self.completed,
+                'jobs_failed': self.failed,
+                'mean_job_seconds': self.seconds / self.completed if self.completed else 0.0,
+            }
+        metrics.update(self.cache.metrics())
+        return metrics
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    JSON over HTTP for an ErosionService, set as the server's service.
+    """
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == '/metrics':
+            return self._send(200, service.metrics())
+        if self.path.startswith('/jobs/'):
+            job = service.job(self.path[len('/jobs/'):])
+            if job is None:
+                return self._send(404, {'error': 'unknown job'})
+            return self._send(200, job)
+        self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            return self._send(404, {'error': 'not found'})
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            job_id, future = self.server.service.submit(job)
+        except ValueError as e:
+            return self._send(400, {'error': str(e)})
+        if job.get('wait'):
+            return self._send(200, future.result())
+        self._send(202, self.server.service.job(job_id))
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class ThreadingServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+def make_server(service, port=8765, host='127.0.0.1', socket_path=None, verbose=False):
+    """
+    An HTTP server for service on host:port, or on a Unix socket at socket_path.
+    """
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixServer(socket_path, ServiceHandler)
+    else:
+        server = ThreadingServer((host, port), ServiceHandler)
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+def _loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ErosionFlow job service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--allow-remote', action='store_true', help='listen on a --host other than the loopback interface')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--socket', help='serve on this Unix socket instead of TCP')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--cache-mb', type=int, default=CACHE_MB, help='memory for resident DEMs and their terms')
+    parser.add_argument('--root', default=os.getcwd(), help='folder the rasters of jobs must be in')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+    if not args.socket and not args.allow_remote and not _loopback(args.host):
+        parser.error('--host {} is not a loopback address, the service has no authentication; add --allow-remote to listen on it anyway'.format(args.host))
+    service = ErosionService(args.workers, args.cache_mb * 1024 * 1024, args.root)
+    server = make_server(service, args.port, args.host, args.socket, args.verbose)
+    print('ErosionFlow service on {}, rasters in {}'.format(args.socket or '{}:{}'.format(args.host, args.port), service.root), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()
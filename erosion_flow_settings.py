@@ -0,0 +1,78 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+
+ ErosionFlow provider settings, shown under Settings > Options > Processing.
+"""
+
+import os
+
+from qgis.core import QgsApplication
+from processing.core.ProcessingConfig import ProcessingConfig, Setting
+
+from .erosion_flow_cache import ResultCache
+
+CACHE_FOLDER = 'EROSIONFLOW_CACHE_FOLDER'
+CACHE_SIZE_MB = 'EROSIONFLOW_CACHE_SIZE_MB'
+CACHE_PURGE = 'EROSIONFLOW_CACHE_PURGE'
+MAX_WORKERS = 'EROSIONFLOW_MAX_WORKERS'
+MEMORY_BUDGET_MB = 'EROSIONFLOW_MEMORY_BUDGET_MB'
+
+
+def default_cache_folder():
+    return os.path.join(QgsApplication.qgisSettingsDirPath(), 'erosion_flow_cache')
+
+
+def add_settings(group):
+    ProcessingConfig.addSetting(Setting(group, CACHE_FOLDER, 'Result cache folder (empty disables caching)', default_cache_folder(), valuetype=Setting.FOLDER))
+    ProcessingConfig.addSetting(Setting(group, CACHE_SIZE_MB, 'Result cache size limit (MB)', 2048, valuetype=Setting.INT))
+    ProcessingConfig.addSetting(Setting(group, CACHE_PURGE, 'Purge result cache when settings are saved', False))
+    ProcessingConfig.addSetting(Setting(group, MAX_WORKERS, 'Maximum concurrent stages per algorithm run', min(4, os.cpu_count() or 1), valuetype=Setting.INT))
+    ProcessingConfig.addSetting(Setting(group, MEMORY_BUDGET_MB, 'Memory budget per algorithm run (MB, 0 for no limit)', 0, valuetype=Setting.INT))
+
+
+def remove_settings():
+    for name in (CACHE_FOLDER, CACHE_SIZE_MB, CACHE_PURGE, MAX_WORKERS, MEMORY_BUDGET_MB):
+        ProcessingConfig.removeSetting(name)
+
+
+def result_cache():
+    """
+    The persistent result cache, None when disabled.
+    """
+    folder = ProcessingConfig.getSetting(CACHE_FOLDER)
+    if not folder:
+        return None
+    return ResultCache(folder, int(ProcessingConfig.getSetting(CACHE_SIZE_MB) or 0) * 1024 * 1024)
+
+
+def max_workers():
+    return max(1, int(ProcessingConfig.getSetting(MAX_WORKERS) or 1))
+
+
+def memory_budget():
+    """
+    Memory budget of a run in bytes, 0 for no limit.
+    """
+    return max(0, int(ProcessingConfig.getSetting(MEMORY_BUDGET_MB) or 0)) * 1024 * 1024
+
+
+def purge_requested_cache():
+    """
+    Purges the cache if requested from the provider settings, then clears the request.
+    """
+    if not ProcessingConfig.getSetting(CACHE_PURGE):
+        return False
+    cache = result_cache()
+    if cache is not None:
+        cache.purge()
+    ProcessingConfig.setSettingValue(CACHE_PURGE, False)
+    return True
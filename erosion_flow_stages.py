@@ -0,0 +1,415 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+
+ In-process processing stages shared by the algorithms, reading and
+ writing raster files with GDAL.
+"""
+
+import os
+
+import numpy as np
+from osgeo import gdal
+
+from .erosion_flow_raster import read_raster, write_raster, raster_info, block_calc, window_info, rasterize_wkt, BLOCK_ROWS
+from .erosion_flow_raster import read_window, create_raster, driver_for_path, clip_raster, ArrayReader, OUTPUT_NODATA
+from .erosion_flow_terrain import slope, aspect
+from .erosion_flow_engine import SubFeedback, rill_regime, regime_values
+from .erosion_flow_engine import sediment_flow, sediment_flux_x, sediment_flux_y, flux_change_x, flux_change_y, usped
+from .erosion_flow_routing import build_flow_graph, route_load, flow_receivers, donor_index, upstream_cells, MFD
+from .erosion_flow_routing import flow_graph_path, save_flow_graph, load_flow_graph
+from .erosion_flow_tiled import TiledAccumulation, TILE_SIZE
+from . import erosion_flow_api as api
+from .erosion_flow_cache import KEY_VERSION, run_cached, run_cached_outputs
+
+
+# cells kept around a traced area so slope, aspect and the USPED flux
+# divergence of its cells see their real neighbours
+REGION_MARGIN = 2
+
+# rill or sheet erosion per cell
+REGIMES = ['Prevailing rill setting everywhere', 'Rill above contributing area / slope thresholds', 'Regime raster (1 rill, 0 sheet)']
+REGIME_GLOBAL = 0
+REGIME_THRESHOLD = 1
+REGIME_RASTER = 2
+
+
+def _log(feedback, message):
+    if feedback is not None:
+        feedback.pushConsoleInfo(message)
+
+
+def dem_graph_key(dem_source, method, convergence):
+    """
+    Identifies the DEM file state and routing settings a saved graph was built from.
+    """
+    stat = os.stat(dem_source)
+    return '{}:{}:{}:{}:{}'.format(stat.st_size, stat.st_mtime_ns, method, convergence, KEY_VERSION)
+
+
+def flow_graph(dem, info, dem_source, method=MFD, convergence=1.1, reuse_graph=False, feedback=None):
+    """
+    Builds the flow graph of dem, or with reuse_graph loads the one saved next
+    to the DEM file by an earlier run (saving it there on a miss).
+    """
+    if not reuse_graph or not isinstance(dem_source, str) or not os.path.isfile(dem_source):
+        return build_flow_graph(dem, info.cell_sizes(), method, convergence, feedback)
+    path = flow_graph_path(dem_source, method)
+    key = dem_graph_key(dem_source, method, convergence)
+    graph = load_flow_graph(path, key)
+    if graph is not None:
+        _log(feedback, 'Reusing flow graph ' + path)
+        return graph
+    graph = build_flow_graph(dem, info.cell_sizes(), method, convergence, feedback)
+    try:
+        save_flow_graph(graph, path, key)
+        _log(feedback, 'Saved flow graph ' + path)
+    except OSError as e:
+        _log(feedback, 'Could not save flow graph next to DEM: ' + str(e))
+    return graph
+
+
+def dem_flow_graph(dem_source, method=MFD, convergence=1.1, reuse_graph=False, feedback=None):
+    """
+    Flow graph of a DEM file, for stages sharing one graph within a run.
+    """
+    dem, info = read_raster(dem_source)
+    return flow_graph(dem, info, dem_source, method, convergence, reuse_graph, feedback)
+
+
+def flow_accumulation(dem_source, output, method=MFD, convergence=1.1, reuse_graph=False,
+                      weight_source=None, graph=None, feedback=None, dem=None):
+    """
+    Flow accumulation as upslope contributing area (cell area units),
+    the equivalent of SAGA Flow Accumulation (Top-Down) with FLOW_UNIT 1.
+    With weight_source each cell area is multiplied by that raster, giving
+    a weighted accumulation over the same flow graph. graph is the DEM's
+    flow graph and dem its read_raster result when the run already has them.
+    """
+    dem, info = dem if dem is not None else read_raster(dem_source)
+    if graph is None:
+        graph = flow_graph(dem, info, dem_source, method, convergence, reuse_graph, SubFeedback(feedback, 0, 70))
+    weight = read_raster(weight_source)[0] if weight_source is not None else None
+    flow = api.flow_accumulation(dem, info.geotransform, method, convergence, weight, graph, SubFeedback(feedback, 70, 100),
+                                 info.ellipsoid)
+    write_raster(output, flow, info)
+    return output
+
+
+def tiled_flow_accumulation(dem_source, output, scratch, size=TILE_SIZE, method=MFD, convergence=1.1,
+                            workers=1, feedback=None):
+    """
+    Flow accumulation of dem_source into output tile by tile (see
+    erosion_flow_tiled), for DEMs too large to route in one pass. scratch
+    is a folder for per tile files, removed after.
+    """
+    info = raster_info(dem_source)
+    driver = driver_for_path(output)
+    # a mosaic sized output is written tiled and compressed when it is a GeoTIFF
+    options = ['TILED=YES', 'COMPRESS=LZW', 'BIGTIFF=IF_SAFER'] if driver.ShortName == 'GTiff' else []
+    target = create_raster(output, info.xsize, info.ysize, 1, gdal.GDT_Float32, driver, options)
+    target.SetGeoTransform(info.geotransform)
+    target.SetProjection(info.projection)
+    band = target.GetRasterBand(1)
+    band.SetNoDataValue(OUTPUT_NODATA)
+
+    def read(row, col, rows, cols):
+        return read_window(dem_source, row, col, rows, cols, halo=1)
+
+    def write(row, col, acc):
+        band.WriteArray(np.where(np.isnan(acc), OUTPUT_NODATA, acc), col, row)
+
+    try:
+        TiledAccumulation(info, read, write, scratch, size, method, convergence, workers, feedback).run()
+        band.FlushCache()
+    finally:
+        band = None
+        target = None
+    return output
+
+
+def sediment_flux(graph, usped_source, output, delivery_ratio=1.0, qsx_source=None, qsy_source=None, feedback=None):
+    """
+    Sediment leaving each cell (mass per time), USPED net erosion routed
+    downstream over the flow graph of the run in one sweep: eroding cells
+    add to the load, depositing cells take from it. delivery_ratio is the
+    share of its load each cell passes on. With the USPED fluxes qsx and
+    qsy the load is capped at the transport capacity |qs| across the cell.
+    """
+    erosion, info = read_raster(usped_source)
+    nodata = np.isnan(erosion)
+    # USPED is negative for erosion
+    load = np.where(nodata, 0, -erosion * info.cell_areas())
+    capacity = None
+    if qsx_source is not None and qsy_source is not None:
+        qs = np.hypot(read_raster(qsx_source)[0], read_raster(qsy_source)[0])
+        # no transport on flats (aspect, hence qs, is undefined there)
+        capacity = np.nan_to_num(qs) * info.cell_sizes()[0]
+    flux = route_load(graph, load, delivery_ratio, capacity, feedback)
+    flux[nodata] = np.nan
+    write_raster(output, flux, info)
+    return output
+
+
+def slope_raster(dem_source, output, z_factor=1.0, feedback=None, block_rows=BLOCK_ROWS, checkpoint=None):
+    """
+    Slope in degrees, the in-process equivalent of native:slope. Cell sizes
+    of a geographic DEM are taken in metres per row, so no Z factor is needed.
+    """
+    info = raster_info(dem_source)
+    return block_calc(output, [dem_source, info.cell_sizes], lambda z, cell_size: slope(z, cell_size, z_factor), feedback,
+                      block_rows=block_rows, halo=1, checkpoint=checkpoint)
+
+
+def aspect_raster(dem_source, output, z_factor=1.0, feedback=None, block_rows=BLOCK_ROWS, checkpoint=None):
+    """
+    Aspect in degrees clockwise from north, the in-process equivalent of native:aspect.
+    """
+    info = raster_info(dem_source)
+    return block_calc(output, [dem_source, info.cell_sizes], lambda z, cell_size: aspect(z, cell_size, z_factor), feedback,
+                      block_rows=block_rows, halo=1, checkpoint=checkpoint)
+
+
+def terrain_rasters(dem_source, slope_output, aspect_output, z_factor=1.0, feedback=None, block_rows=BLOCK_ROWS,
+                    checkpoint=None):
+    """
+    Slope and aspect (see slope_raster and aspect_raster) in one pass over
+    the DEM, which may be an ArrayReader of a DEM the run has already read.
+    """
+    info = raster_info(dem_source)
+    return block_calc([slope_output, aspect_output], [dem_source, info.cell_sizes],
+                      lambda z, cell_size: (slope(z, cell_size, z_factor), aspect(z, cell_size, z_factor)), feedback,
+                      block_rows=block_rows, halo=1, checkpoint=checkpoint)
+
+
+def dilate(mask, cells=1):
+    """
+    Grows a boolean mask by cells in all 8 directions.
+    """
+    rows, cols = mask.shape
+    for _ in range(cells):
+        padded = np.pad(mask, 1)
+        mask = np.zeros_like(mask)
+        for dr in (0, 1, 2):
+            for dc in (0, 1, 2):
+                mask |= padded[dr:dr + rows, dc:dc + cols]
+    return mask
+
+
+def upstream_region(dem_source, geometries, dem_output, region_output, method=MFD, convergence=1.1,
+                    reuse_graph=False, feedback=None):
+    """
+    Limits a run to the area draining into outlet points, stream lines or
+    regions of interest, given as WKT geometries in the DEM CRS.
+
+    Writes to dem_output the DEM window covering that area, nodata beyond a
+    margin around it, so flow accumulation and every later stage only see
+    the cells that matter, and to region_output a mask of the area itself
+    (1 inside, nodata outside) for masking the final outputs.
+    Raises ValueError when no geometry falls on the DEM.
+    """
+    dem, info = read_raster(dem_source)
+    if reuse_graph:
+        receivers = flow_graph(dem, info, dem_source, method, convergence, True, SubFeedback(feedback, 0, 60)).receivers
+    else:
+        receivers = flow_receivers(dem, info.cell_sizes(), method, convergence, SubFeedback(feedback, 0, 60))[0]
+    donors = donor_index(receivers)
+    receivers = None
+
+    seeds = np.zeros(dem.shape, dtype=bool)
+    for wkt in geometries:
+        burned = rasterize_wkt(wkt, info)
+        if burned is not None:
+            top, left, mask = burned
+            seeds[top:top + mask.shape[0], left:left + mask.shape[1]] |= mask
+    seeds &= ~np.isnan(dem)
+    if not seeds.any():
+        raise ValueError('The outlets or region of interest do not overlap the DEM')
+
+    # the area itself, and the area draining into it and its neighbours,
+    # whose accumulation the divergence at its edge depends on
+    region = np.zeros(dem.size, dtype=bool)
+    region[upstream_cells(donors, np.flatnonzero(seeds))] = True
+    traced = np.zeros(dem.size, dtype=bool)
+    traced[upstream_cells(donors, np.flatnonzero(dilate(seeds) & ~np.isnan(dem)))] = True
+    donors = None
+    needed = dilate(traced.reshape(dem.shape), REGION_MARGIN)
+    region = region.reshape(dem.shape)
+
+    rows = np.flatnonzero(needed.any(axis=1))
+    cols = np.flatnonzero(needed.any(axis=0))
+    row, col = int(rows[0]), int(cols[0])
+    window = (slice(row, int(rows[-1]) + 1), slice(col, int(cols[-1]) + 1))
+    clipped = window_info(info, row, col, int(rows[-1]) + 1 - row, int(cols[-1]) + 1 - col)
+    _log(feedback, 'Upstream area: {} of {} cells, window {} x {}'.format(
+        int(region.sum()), dem.size, clipped.xsize, clipped.ysize))
+    write_raster(dem_output, np.where(needed, dem, np.nan)[window], clipped, gdal.GDT_Float64)
+    write_raster(region_output, np.where(region, 1, np.nan)[window], clipped, gdal.GDT_Byte, 0)
+    return dem_output, region_output
+
+
+class ErosionRegime(object):
+    """
+    Rill or sheet erosion per cell: everywhere as prevailing_rill says
+    (REGIME_GLOBAL), rill where both the contributing area and slope reach
+    min_area and min_slope (REGIME_THRESHOLD), or as the regime raster
+    source says (REGIME_RASTER, prevailing_rill where it has no data).
+    """
+
+    def __init__(self, mode=REGIME_GLOBAL, prevailing_rill=True, min_area=0.0, min_slope=0.0, source=None):
+        self.mode = mode
+        self.prevailing_rill = prevailing_rill
+        self.min_area = min_area
+        self.min_slope = min_slope
+        self.source = source
+
+    @property
+    def reads_terrain(self):
+        return self.mode == REGIME_THRESHOLD
+
+    def inputs(self, flow=None, slope=None):
+        """
+        Extra block_calc inputs the regime is read from.
+        """
+        if self.mode == REGIME_THRESHOLD:
+            return [flow, slope]
+        if self.mode == REGIME_RASTER:
+            return [self.source]
+        return []
+
+    def rill(self, *values):
+        """
+        The regime of a block from the values of its inputs.
+        """
+        if self.mode == REGIME_THRESHOLD:
+            return rill_regime(values[0], values[1], self.min_area, self.min_slope)
+        if self.mode == REGIME_RASTER:
+            return regime_values(values[0], self.prevailing_rill)
+        return self.prevailing_rill
+
+
+def add_terrain_stages(stages, dem_source, temp_raster, slope_output=None, flow_output=None, aspect=False,
+                       graph=False, flow_source=None, method=MFD, convergence=1.1, reuse_graph=False,
+                       block_rows=BLOCK_ROWS, cache=None, checkpoint=None):
+    """
+    Adds the stages of a StageGraph every erosion product starts from:
+    'Slope', with aspect also 'Aspect', written in one pass over the DEM,
+    'FlowAccumulation', copied from flow_source (clipped to the DEM) when
+    given, and with graph the 'FlowGraph' a sediment flux routes over.
+    When flow is routed the DEM is read once ('Dem') for the flow graph,
+    slope and aspect. Slope and flow accumulation go to slope_output and
+    flow_output, or are temporaries when those are None; temp_raster(name)
+    gives the path of an intermediate raster.
+    """
+    slope_path = slope_output or temp_raster('Slope')
+    aspect_path = temp_raster('Aspect') if aspect else None
+    flow_path = flow_output or temp_raster('FlowAccumulation')
+    read = flow_source is None or graph
+    if read:
+        stages.add('Dem', lambda feedback: read_raster(dem_source))
+        stages.temporary('Dem')
+    if graph:
+        stages.add('FlowGraph', lambda dem, feedback: flow_graph(dem[0], dem[1], dem_source, method, convergence, reuse_graph, feedback), 'Dem')
+        stages.temporary('FlowGraph')
+
+    def terrain(*dem, feedback):
+        source = ArrayReader(*dem[0]) if dem else dem_source
+        if aspect:
+            compute = lambda outputs: terrain_rasters(source, outputs[0], outputs[1], feedback=feedback, block_rows=block_rows,
+                                                      checkpoint=checkpoint)
+            return run_cached_outputs(cache, ['slope', 'aspect'], [dem_source], {'z_factor': 1}, [slope_path, aspect_path], compute, feedback)
+        compute = lambda output: slope_raster(source, output, feedback=feedback, block_rows=block_rows, checkpoint=checkpoint)
+        return [run_cached(cache, 'slope', [dem_source], {'z_factor': 1}, slope_path, compute, feedback)]
+
+    # one stage writes both, handed on as rasters of their own so each is removed after its last reader
+    stages.add('Terrain', terrain, *(['Dem'] if read else []))
+    stages.add('Slope', lambda rasters, feedback: rasters[0], 'Terrain')
+    stages.temporary('Terrain')
+    if aspect:
+        stages.add('Aspect', lambda rasters, feedback: rasters[1], 'Terrain')
+        stages.temporary('Aspect')
+
+    def accumulation(*inputs, feedback):
+        if flow_source is not None:
+            return clip_raster(flow_source, raster_info(dem_source), flow_path)
+        compute = lambda output: flow_accumulation(dem_source, output, method, convergence, reuse_graph,
+                                                   graph=inputs[1] if graph else None, feedback=feedback, dem=inputs[0])
+        return run_cached(cache, 'flowaccumulation', [dem_source], {'method': method, 'convergence': convergence}, flow_path, compute, feedback)
+
+    stages.add('FlowAccumulation', accumulation, *([] if flow_source is not None else ['Dem'] + (['FlowGraph'] if graph else [])))
+    if slope_output is None:
+        stages.temporary('Slope')
+    if flow_output is None:
+        stages.temporary('FlowAccumulation')
+
+
+def add_usped_stages(stages, temp_raster, factors, output, regime=None, region=None, encoding=None,
+                     sediment_output=None, delivery_ratio=1.0, transport_cap=False, block_rows=BLOCK_ROWS,
+                     checkpoint=None):
+    """
+    Adds the USPED stages (see erosion_flow_USPED for the steps) to a
+    StageGraph holding those of add_terrain_stages with aspect, and with
+    graph for a sediment_output. factors are the K, C and R rasters or
+    numbers, regime an ErosionRegime, region an optional mask raster of
+    the area to keep, encoding that of the output.
+    """
+    regime = regime or ErosionRegime()
+    region = [region] if region else []
+    rows = block_rows
+
+    def blocks(name, inputs, function, feedback):
+        return block_calc(temp_raster(name), inputs, function, feedback, block_rows=rows, checkpoint=checkpoint)
+
+    # sflowtopo = Pow([flowacc] * resolution , 0.6) * Pow(Sin([slope] * 0.01745) , 1.3))
+    # Note: flow accumulation already calculates area so no need for resolution
+    stages.add('sflowtopo', lambda flow, slope, feedback: blocks('sflowtopo', [flow, slope] + regime.inputs(flow, slope), lambda A, B, *G: sediment_flow(A, B, regime.rill(*G)), feedback), 'FlowAccumulation', 'Slope')
+    # qsx = [sflowtopo] * [kfac] * [cfac] * R * Cos((([aspect] *  (-1)) + 450) * .01745)
+    stages.add('qsx', lambda sflow, aspect, feedback: blocks('qsx', [sflow] + factors + [aspect], sediment_flux_x, feedback), 'sflowtopo', 'Aspect')
+    # qsy = [sflowtopo] * [kfac] * [cfac] * R * Sin((([aspect] *  (-1)) + 450) * .01745)
+    stages.add('qsy', lambda sflow, aspect, feedback: blocks('qsy', [sflow] + factors + [aspect], sediment_flux_y, feedback), 'sflowtopo', 'Aspect')
+
+    # slope and aspect of qsx and qsy, each in one pass
+    for flux in ('qsx', 'qsy'):
+        stages.add(flux + 'Terrain', lambda qs, feedback, flux=flux: terrain_rasters(qs, temp_raster(flux + 'Slope'), temp_raster(flux + 'Aspect'), feedback=feedback, block_rows=rows, checkpoint=checkpoint), flux)
+        stages.add(flux + 'Slope', lambda rasters, feedback: rasters[0], flux + 'Terrain')
+        stages.add(flux + 'Aspect', lambda rasters, feedback: rasters[1], flux + 'Terrain')
+
+    # qsx_dx = Cos((([qsx_aspect] * (-1)) + 450) * .01745) * Tan([qsx_slope] * .01745)
+    stages.add('qsx_dx', lambda aspect, slope, feedback: blocks('qsx_dx', [aspect, slope], flux_change_x, feedback), 'qsxAspect', 'qsxSlope')
+    # qsy_dy =  Sin((([qsy_aspect] * (-1)) + 450) * .01745) * Tan([qsy_slope] * .01745)
+    stages.add('qsy_dy', lambda aspect, slope, feedback: blocks('qsy_dy', [aspect, slope], flux_change_y, feedback), 'qsyAspect', 'qsySlope')
+
+    # USPED = [qsx_dx] + [qsy_dy] for rill erosion, ([qsx_dx] + [qsy_dy]) * 10 for sheet erosion,
+    # masked to the upstream area (nodata outside it) when limited to one
+    count = len(regime.inputs())
+
+    def cells(dx, dy, *values):
+        result = usped(dx, dy, regime.rill(*values[:count]))
+        return result * values[count] if region else result
+
+    # only the threshold regime reads flow accumulation and slope again, otherwise the slope is removed before USPED
+    terrain = ['FlowAccumulation', 'Slope'] if regime.reads_terrain else []
+
+    def uspedStage(dx, dy, *flow_slope, feedback):
+        return block_calc(output, [dx, dy] + regime.inputs(*(flow_slope or (None, None))) + region, cells, feedback,
+                          block_rows=rows, statistics=True, checkpoint=checkpoint, encoding=encoding)
+
+    stages.add('Usped', uspedStage, 'qsx_dx', 'qsy_dy', *terrain)
+
+    # USPED net erosion routed downstream in one more sweep of the flow graph, passing on
+    # delivery_ratio of the load per cell, optionally capped at the transport capacity |qs|
+    if sediment_output:
+        if transport_cap:
+            stages.add('SedimentFlux', lambda graph, erosion, qsx, qsy, feedback: sediment_flux(graph, erosion, sediment_output, delivery_ratio, qsx, qsy, feedback), 'FlowGraph', 'Usped', 'qsx', 'qsy')
+        else:
+            stages.add('SedimentFlux', lambda graph, erosion, feedback: sediment_flux(graph, erosion, sediment_output, delivery_ratio, feedback=feedback), 'FlowGraph', 'Usped')
+
+    stages.temporary('sflowtopo', 'qsx', 'qsy', 'qsxTerrain', 'qsyTerrain', 'qsxSlope', 'qsxAspect', 'qsySlope', 'qsyAspect', 'qsx_dx', 'qsy_dy')
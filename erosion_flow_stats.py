@@ -0,0 +1,153 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+
+ Band statistics gathered while an output is written block by block and
+ stored as GDAL PAM metadata (the .aux.xml sidecar of a GeoTIFF), so QGIS
+ finds them when loading the layer instead of scanning the raster again.
+
+ Min, max, mean and standard deviation are exact. Percentiles and the
+ histogram come from an even sample of at most SAMPLE_SIZE cells, the
+ histogram counts scaled up to all cells.
+"""
+
+import numpy as np
+
+SAMPLE_SIZE = 1 << 18
+
+HISTOGRAM_BUCKETS = 256
+
+# stored as STATISTICS_P<n> metadata items
+PERCENTILES = [2, 5, 50, 95, 98]
+
+
+class BandStatistics(object):
+    """
+    Running statistics of one band of cells, total the number of cells
+    the band has (sets the sampling step).
+    """
+
+    def __init__(self, total):
+        self.step = max(1, int(total) // SAMPLE_SIZE)
+        self.count = 0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+        self.sum = 0.0
+        self.sum_squares = 0.0
+        self.seen = 0
+        self.samples = []
+
+    def add(self, values):
+        """
+        Adds a block of values, NaN for nodata.
+        """
+        flat = np.ravel(values)
+        # sample every step-th cell of the band, data or not, so the sample is spread evenly
+        offset = (-self.seen) % self.step
+        self.seen += flat.size
+        valid = flat[~np.isnan(flat)]
+        sample = flat[offset::self.step]
+        sample = sample[~np.isnan(sample)]
+        if sample.size:
+            self.samples.append(sample.astype(np.float64))
+        if not valid.size:
+            return
+        self.count += int(valid.size)
+        self.minimum = min(self.minimum, float(valid.min()))
+        self.maximum = max(self.maximum, float(valid.max()))
+        self.sum += float(valid.sum())
+        self.sum_squares += float(np.square(valid, dtype=np.float64).sum())
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    @property
+    def std(self):
+        if not self.count:
+            return 0.0
+        return float(np.sqrt(max(self.sum_squares / self.count - self.mean ** 2, 0.0)))
+
+    def sample(self):
+        return np.concatenate(self.samples) if self.samples else np.empty(0)
+
+    def percentiles(self):
+        sample = self.sample()
+        if not sample.size:
+            return {}
+        return dict(zip(PERCENTILES, np.percentile(sample, PERCENTILES).tolist()))
+
+    def histogram(self, buckets=HISTOGRAM_BUCKETS):
+        """
+        (min, max, counts) of the band over buckets equal intervals.
+        """
+        sample = self.sample()
+        if not sample.size:
+            return None
+        # GDAL histogram bounds are the outer edges of the first and last bucket
+        counts = np.histogram(sample, buckets, (self.minimum, self.maximum if self.maximum > self.minimum else self.minimum + 1))[0]
+        counts = np.round(counts * (self.count / float(sample.size))).astype(int)
+        return self.minimum, self.maximum, counts.tolist()
+
+    def summary(self):
+        """
+        The statistics as stored_statistics gives them back from a band,
+        None without data.
+        """
+        if not self.count:
+            return None
+        statistics = {'min': self.minimum, 'max': self.maximum, 'mean': self.mean, 'std': self.std}
+        for percentile, value in self.percentiles().items():
+            statistics['p{}'.format(percentile)] = value
+        return statistics
+
+    def write(self, band, scale=1.0, offset=0.0):
+        """
+        Stores the statistics on a GDAL band, kept as PAM metadata. On a band
+        stored with a scale and offset they are stored in its raw values,
+        as GDAL keeps them.
+        """
+        if not self.count:
+            return
+        raw = lambda value: (value - offset) / scale
+        band.SetStatistics(raw(self.minimum), raw(self.maximum), raw(self.mean), self.std / scale)
+        band.SetMetadataItem('STATISTICS_VALID_PERCENT', '{:.4f}'.format(100.0 * self.count / max(self.seen, 1)))
+        for percentile, value in self.percentiles().items():
+            band.SetMetadataItem('STATISTICS_P{}'.format(percentile), repr(raw(value)))
+        histogram = self.histogram()
+        if histogram is not None:
+            band.SetDefaultHistogram(raw(histogram[0]), raw(histogram[1]), histogram[2])
+
+
+def stored_statistics(band):
+    """
+    The statistics a band holds without computing them: a dict of min,
+    max, mean, std and the stored percentiles (p2, p98, ...), None if the
+    band has none. Those of a band stored with a scale and offset are
+    given in its values rather than the raw ones.
+    """
+    metadata = band.GetMetadata() or {}
+    if 'STATISTICS_MINIMUM' not in metadata or 'STATISTICS_MAXIMUM' not in metadata:
+        return None
+    scale = band.GetScale() or 1.0
+    offset = band.GetOffset() or 0.0
+    value = lambda key, default=0: float(metadata.get(key, default)) * scale + offset
+    statistics = {
+        'min': value('STATISTICS_MINIMUM'),
+        'max': value('STATISTICS_MAXIMUM'),
+        'mean': value('STATISTICS_MEAN'),
+        'std': float(metadata.get('STATISTICS_STDDEV', 0)) * scale,
+    }
+    for percentile in PERCENTILES:
+        key = 'STATISTICS_P{}'.format(percentile)
+        if key in metadata:
+            statistics['p{}'.format(percentile)] = value(key)
+    return statistics
@@ -0,0 +1,77 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+
+ Default styles of loaded outputs, built from the statistics stored with
+ them when written (see erosion_flow_stats), so loading needs no scan.
+"""
+
+from qgis.core import QgsColorRampShader
+from qgis.core import QgsRasterShader
+from qgis.core import QgsSingleBandPseudoColorRenderer
+from qgis.PyQt.QtGui import QColor
+
+from .erosion_flow_raster import open_raster
+from .erosion_flow_stats import stored_statistics
+
+# USPED: net erosion (negative) red, deposition (positive) blue
+DIVERGING = [('#b2182b', 'Erosion'), ('#ef8a62', ''), ('#f7f7f7', 'Stable'), ('#67a9cf', ''), ('#2166ac', 'Deposition')]
+
+# LS and RUSLE: low to high soil loss
+SEQUENTIAL = [('#ffffcc', 'Low'), ('#fed976', ''), ('#fd8d3c', ''), ('#e31a1c', ''), ('#800026', 'High')]
+
+
+def _statistics(source):
+    try:
+        dataset = open_raster(source)
+    except RuntimeError:
+        return None
+    return stored_statistics(dataset.GetRasterBand(1))
+
+
+def apply_default_style(layer, diverging=False):
+    """
+    Styles a single band output layer: diverging around 0 between the 2nd
+    and 98th percentiles for USPED, otherwise sequential from the minimum
+    to the 98th percentile. Returns False, leaving the layer as it is, if
+    the raster has no stored statistics.
+    """
+    statistics = _statistics(layer.source())
+    if statistics is None:
+        return False
+    if diverging:
+        limit = max(abs(statistics.get('p2', statistics['min'])), abs(statistics.get('p98', statistics['max']))) or 1.0
+        minimum, maximum = -limit, limit
+        colors = DIVERGING
+    else:
+        minimum = statistics['min']
+        maximum = statistics.get('p98', statistics['max'])
+        if maximum <= minimum:
+            maximum = minimum + 1.0
+        colors = SEQUENTIAL
+    step = (maximum - minimum) / (len(colors) - 1)
+    items = []
+    for i, (color, label) in enumerate(colors):
+        value = minimum + i * step
+        items.append(QgsColorRampShader.ColorRampItem(value, QColor(color), label or '{:.4g}'.format(value)))
+    ramp = QgsColorRampShader(minimum, maximum)
+    ramp.setColorRampType(QgsColorRampShader.Interpolated)
+    ramp.setColorRampItemList(items)
+    # values beyond the percentiles take the end colors
+    ramp.setClip(False)
+    shader = QgsRasterShader(minimum, maximum)
+    shader.setRasterShaderFunction(ramp)
+    renderer = QgsSingleBandPseudoColorRenderer(layer.dataProvider(), 1, shader)
+    renderer.setClassificationMin(minimum)
+    renderer.setClassificationMax(maximum)
+    layer.setRenderer(renderer)
+    layer.triggerRepaint()
+    return True
@@ -0,0 +1,349 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+"""
+
+import os
+
+import numpy as np
+
+from qgis.core import QgsProcessing
+from qgis.core import QgsProcessingAlgorithm
+from qgis.core import QgsProcessingException
+from qgis.core import QgsProcessingParameterMapLayer
+from qgis.core import QgsProcessingParameterFeatureSource
+from qgis.core import QgsProcessingParameterNumber
+from qgis.core import QgsProcessingParameterRasterDestination
+from qgis.core import QgsProcessingParameterFolderDestination
+from qgis.core import QgsProcessingLayerPostProcessorInterface
+from qgis.core import QgsProcessingParameterBoolean
+from qgis.core import QgsProcessingParameterEnum
+from qgis.core import QgsProcessingParameterFile
+from qgis.core import QgsProcessingUtils
+from osgeo import gdal
+
+from .erosion_flow_encoding import ENCODINGS, FLOAT, output_encoding
+from .erosion_flow_layers import layer_source, region_geometries
+from .erosion_flow_engine import Canceled, ls_factor, rusle
+from .erosion_flow_raster import block_calc, remove_rasters, raster_info, clip_raster, memory_path, copy_raster
+from .erosion_flow_routing import ROUTING_METHODS, MFD
+from .erosion_flow_stages import upstream_region, add_terrain_stages, add_usped_stages, ErosionRegime
+from .erosion_flow_stages import REGIMES, REGIME_GLOBAL, REGIME_RASTER
+from .erosion_flow_scheduler import StageGraph
+from .erosion_flow_checkpoint import Checkpoint, run_key
+from .erosion_flow_settings import result_cache, max_workers, memory_budget
+from .erosion_flow_memory import plan_memory
+from .erosion_flow_zarr import store_outputs
+from .erosion_flow_style import apply_default_style
+from .erosion_flow_USPED import USPED_INTERMEDIATES
+
+class ErosionSuite(QgsProcessingAlgorithm):
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterMapLayer('filleddem', 'Filled sinks DEM', defaultValue=None, types=[QgsProcessing.TypeRaster]))
+        self.addParameter(QgsProcessingParameterBoolean('computels', 'Compute LS', defaultValue=True))
+        self.addParameter(QgsProcessingParameterBoolean('computerusle', 'Compute RUSLE', defaultValue=True))
+        self.addParameter(QgsProcessingParameterBoolean('computeusped', 'Compute USPED', defaultValue=True))
+        self.addParameter(QgsProcessingParameterMapLayer('kfactor', 'K factor raster', optional=True, defaultValue=None, types=[QgsProcessing.TypeRaster]))
+        self.addParameter(QgsProcessingParameterMapLayer('cfactor', 'C factor raster', optional=True, defaultValue=None, types=[QgsProcessing.TypeRaster]))
+        self.addParameter(QgsProcessingParameterMapLayer('rfactor', 'R factor raster', optional=True, defaultValue=None, types=[QgsProcessing.TypeRaster]))
+        self.addParameter(QgsProcessingParameterNumber('kfactorsinglevalue', 'K factor single value', optional=True, type=QgsProcessingParameterNumber.Double, defaultValue=0.05))
+        self.addParameter(QgsProcessingParameterNumber('cfactorsinglevalue', 'C factor single value', optional=True, type=QgsProcessingParameterNumber.Double, defaultValue=0.5))
+        self.addParameter(QgsProcessingParameterNumber('rfactorsinglevalue', 'R factor single value', optional=True, type=QgsProcessingParameterNumber.Double, defaultValue=750))
+        self.addParameter(QgsProcessingParameterNumber('lssheetfactor', 'LS sheet factor', optional=True, type=QgsProcessingParameterNumber.Double, minValue=0.4, maxValue=0.6, defaultValue=0.5))
+        self.addParameter(QgsProcessingParameterNumber('lsrillfactor', 'LS rill factor', optional=True, type=QgsProcessingParameterNumber.Double, minValue=1, maxValue=1.3, defaultValue=1.1))
+        self.addParameter(QgsProcessingParameterBoolean('prevailingrill', 'Prevailing rill erosion (USPED, unchecked for sheet)', defaultValue=True))
+        self.addParameter(QgsProcessingParameterEnum('erosionregime', 'Rill / sheet erosion regime (USPED)', options=REGIMES, defaultValue=REGIME_GLOBAL))
+        self.addParameter(QgsProcessingParameterNumber('rillminarea', 'Rill erosion from contributing area (map units², thresholds regime)', optional=True, type=QgsProcessingParameterNumber.Double, minValue=0, defaultValue=0))
+        self.addParameter(QgsProcessingParameterNumber('rillminslope', 'Rill erosion from slope (degrees, thresholds regime)', optional=True, type=QgsProcessingParameterNumber.Double, minValue=0, maxValue=90, defaultValue=0))
+        self.addParameter(QgsProcessingParameterMapLayer('regimeraster', 'Regime raster (1 rill, 0 sheet, nodata as the prevailing setting)', optional=True, defaultValue=None, types=[QgsProcessing.TypeRaster]))
+        self.addParameter(QgsProcessingParameterEnum('routingmethod', 'Flow routing method', options=ROUTING_METHODS, defaultValue=MFD))
+        self.addParameter(QgsProcessingParameterNumber('convergence', 'MFD convergence factor', optional=True, type=QgsProcessingParameterNumber.Double, minValue=0, defaultValue=1.1))
+        self.addParameter(QgsProcessingParameterBoolean('reuseflowgraph', 'Save and reuse the flow direction graph next to the DEM', defaultValue=False))
+        self.addParameter(QgsProcessingParameterMapLayer('flowaccumulation', 'Precomputed flow accumulation on the DEM grid (skips flow routing)', optional=True, defaultValue=None, types=[QgsProcessing.TypeRaster]))
+        self.addParameter(QgsProcessingParameterFeatureSource('region', 'Outlet points or region of interest (limits the run to its upstream area)', optional=True, types=[QgsProcessing.TypeVectorAnyGeometry]))
+        self.addParameter(QgsProcessingParameterNumber('deliveryratio', 'Sediment delivery ratio per cell (sediment flux)', optional=True, type=QgsProcessingParameterNumber.Double, minValue=0, maxValue=1, defaultValue=1))
+        self.addParameter(QgsProcessingParameterBoolean('transportcap', 'Cap sediment flux at the transport capacity', defaultValue=False))
+        self.addParameter(QgsProcessingParameterEnum('outputencoding', 'Output encoding of LS, RUSLE and USPED (16 bit integers read back as floats, a quarter of Float64)', options=ENCODINGS, defaultValue=FLOAT))
+        self.addParameter(QgsProcessingParameterNumber('encodingscale', 'Encoding scale, value per integer step (0 fits it to the first rows of each output)', optional=True, type=QgsProcessingParameterNumber.Double, minValue=0, defaultValue=0))
+        self.addParameter(QgsProcessingParameterNumber('encodingoffset', 'Encoding offset, value of integer 0 (with a given scale)', optional=True, type=QgsProcessingParameterNumber.Double, defaultValue=0))
+        self.addParameter(QgsProcessingParameterRasterDestination('Ls', 'LS', optional=True, createByDefault=True, defaultValue=None))
+        self.addParameter(QgsProcessingParameterRasterDestination('Rusle', 'RUSLE', optional=True, createByDefault=True, defaultValue=None))
+        self.addParameter(QgsProcessingParameterRasterDestination('Usped', 'USPED', optional=True, createByDefault=True, defaultValue=None))
+        self.addParameter(QgsProcessingParameterRasterDestination('Slope', 'Slope', optional=True, createByDefault=False, defaultValue=None))
+        self.addParameter(QgsProcessingParameterRasterDestination('FlowAccumulation', 'Flow Accumulation', optional=True, createByDefault=False, defaultValue=None))
+        self.addParameter(QgsProcessingParameterRasterDestination('SedimentFlux', 'Sediment flux (with USPED)', optional=True, createByDefault=False, defaultValue=None))
+        self.addParameter(QgsProcessingParameterFolderDestination('ChunkedStore', 'Chunked store (Zarr) to write outputs into', optional=True, createByDefault=False, defaultValue=None))
+        self.addParameter(QgsProcessingParameterFile('checkpointfolder', 'Checkpoint folder (an interrupted run with the same inputs resumes from it)', behavior=QgsProcessingParameterFile.Folder, optional=True, defaultValue=None))
+
+    def processAlgorithm(self, parameters, context, model_feedback):
+        # rasters written by this run, removed again if it is canceled
+        self.rasters = []
+        # intermediate rasters, removed when the run ends if not already by the stage graph
+        self.intermediates = []
+        self.checkpoint = None
+        try:
+            results = self.runStages(parameters, context, model_feedback)
+        except (Canceled, QgsProcessingException):
+            # with a checkpoint, what was written is kept for the run resuming from it
+            if self.checkpoint is None:
+                remove_rasters(self.rasters)
+            if not model_feedback.isCanceled():
+                raise
+            if self.checkpoint is None:
+                model_feedback.pushInfo('Canceled, removed intermediate rasters')
+            else:
+                model_feedback.pushInfo('Canceled, completed stages kept in ' + self.checkpoint.folder)
+            return {}
+        finally:
+            if self.checkpoint is None:
+                remove_rasters(self.intermediates)
+        if self.checkpoint is not None:
+            self.checkpoint.clear()
+        return results
+
+    def tempRaster(self, name):
+        if self.checkpoint is not None:
+            path = self.checkpoint.path(name)
+        elif self.plan.in_memory:
+            path = memory_path(name)
+        else:
+            path = QgsProcessingUtils.generateTempFilename(name + '.tif')
+        self.rasters.append(path)
+        self.intermediates.append(path)
+        return path
+
+    def outputRaster(self, parameters, name, context):
+        path = self.parameterAsOutputLayer(parameters, name, context) or QgsProcessingUtils.generateTempFilename(name + '.tif')
+        self.rasters.append(path)
+        return path
+
+    def requested(self, parameters, name, context):
+        return bool(self.parameterAsOutputLayer(parameters, name, context))
+
+    def runStages(self, parameters, context, feedback):
+        computeLs = self.parameterAsBool(parameters, 'computels', context)
+        computeRusle = self.parameterAsBool(parameters, 'computerusle', context)
+        computeUsped = self.parameterAsBool(parameters, 'computeusped', context)
+        if not (computeLs or computeRusle or computeUsped):
+            raise QgsProcessingException('Nothing to compute, enable LS, RUSLE or USPED')
+        prevailingRill = self.parameterAsBool(parameters, 'prevailingrill', context)
+
+        cache = result_cache()
+        demLayer = self.parameterAsRasterLayer(parameters, 'filleddem', context)
+        demSource = layer_source(demLayer)
+        demInfo = raster_info(demSource)
+
+        routingMethod = self.parameterAsEnum(parameters, 'routingmethod', context)
+        convergence = self.parameterAsDouble(parameters, 'convergence', context)
+        reuseGraph = self.parameterAsBool(parameters, 'reuseflowgraph', context)
+        feedback.pushConsoleInfo('Flow routing: ' + ROUTING_METHODS[routingMethod])
+
+        # e.g. from Tiled flow accumulation over a DEM too large for one pass
+        flowLayer = self.parameterAsRasterLayer(parameters, 'flowaccumulation', context)
+        flowSource = layer_source(flowLayer) if flowLayer is not None else None
+        if flowSource is not None:
+            flowInfo = raster_info(flowSource)
+            if flowInfo.shape != demInfo.shape or not np.allclose(flowInfo.geotransform, demInfo.geotransform):
+                raise QgsProcessingException('Precomputed flow accumulation must be on the grid of the DEM')
+
+        # only USPED has intermediates worth keeping in memory
+        self.plan = plan_memory(demInfo.shape, memory_budget(), routingMethod, USPED_INTERMEDIATES if computeUsped else 0, max_workers())
+        feedback.pushInfo(self.plan.describe())
+        rows = self.plan.block_rows
+
+        geometries = region_geometries(self.parameterAsSource(parameters, 'region', context), demLayer.crs(), context)
+
+        # with a checkpoint folder the intermediates are kept there, under the run's inputs and
+        # parameters, so a run stopped part way resumes from its completed stages and row bands
+        checkpointFolder = self.parameterAsFile(parameters, 'checkpointfolder', context)
+        if checkpointFolder:
+            self.checkpoint = self.runCheckpoint(parameters, context, checkpointFolder, geometries)
+            if self.checkpoint is None:
+                feedback.pushWarning('Not checkpointed: a run is keyed by the contents of its input rasters, so all of them must be local files')
+            else:
+                feedback.pushInfo(('Resuming from checkpoint ' if self.checkpoint.resumed else 'Checkpoint ') + self.checkpoint.folder)
+        checkpoint = self.checkpoint
+
+        # limit the run to the area draining into the outlets or region of interest
+        regionMask = None
+        if geometries is not None:
+            regionDem, regionOutput = self.tempRaster('RegionDem'), self.tempRaster('Region')
+            # traced once per checkpoint, like the stages
+            recorded = checkpoint.stage('Region') if checkpoint is not None else None
+            if recorded and all(os.path.exists(path) for path in recorded):
+                demSource, regionMask = recorded
+                feedback.pushInfo('Upstream area resumed from the checkpoint')
+            else:
+                try:
+                    demSource, regionMask = upstream_region(demSource, geometries, regionDem, regionOutput,
+                                                            routingMethod, convergence, reuseGraph, feedback)
+                except ValueError as e:
+                    raise QgsProcessingException(str(e))
+                if checkpoint is not None:
+                    checkpoint.complete('Region', [demSource, regionMask])
+            reuseGraph = False
+        region = [regionMask] if regionMask else []
+
+        # factor rasters or single values, read once by whichever products need them
+        factors = []
+        for factor in ('kfactor', 'cfactor', 'rfactor'):
+            layer = self.parameterAsRasterLayer(parameters, factor, context)
+            if layer is not None:
+                factors.append(layer_source(layer))
+            else:
+                factors.append(self.parameterAsDouble(parameters, factor + 'singlevalue', context))
+
+        # rill or sheet erosion per cell for USPED, as in the USPED algorithm
+        regimeMode = self.parameterAsEnum(parameters, 'erosionregime', context)
+        regimeSource = None
+        if computeUsped and regimeMode == REGIME_RASTER:
+            regimeLayer = self.parameterAsRasterLayer(parameters, 'regimeraster', context)
+            if regimeLayer is None:
+                raise QgsProcessingException('The regime raster erosion regime needs a regime raster')
+            regimeSource = layer_source(regimeLayer)
+
+        if regionMask and (computeRusle or computeUsped):
+            regionInfo = raster_info(demSource)
+            factors = [clip_raster(f, regionInfo, self.tempRaster('Factor')) if not isinstance(f, float) else f for f in factors]
+            if regimeSource:
+                regimeSource = clip_raster(regimeSource, regionInfo, self.tempRaster('Regime'))
+        regime = ErosionRegime(regimeMode, prevailingRill, self.parameterAsDouble(parameters, 'rillminarea', context),
+                               self.parameterAsDouble(parameters, 'rillminslope', context), regimeSource)
+
+        m = self.parameterAsDouble(parameters, 'lssheetfactor', context)
+        n = self.parameterAsDouble(parameters, 'lsrillfactor', context)
+        # LS, RUSLE and USPED stored as floats, or as scaled 16 bit integers
+        encoding = output_encoding(self.parameterAsEnum(parameters, 'outputencoding', context), self.parameterAsDouble(parameters, 'encodingscale', context),
+                                   self.parameterAsDouble(parameters, 'encodingoffset', context))
+
+        # every product is written where asked; with a checkpoint slope and flow accumulation are
+        # written in its folder, where a resumed run finds them again, and copied there at the end
+        outputs = {}
+        for name, computed in (('Ls', computeLs), ('Rusle', computeRusle), ('Usped', computeUsped)):
+            if computed:
+                outputs[name] = self.outputRaster(parameters, name, context)
+        storePath = self.parameterAsString(parameters, 'ChunkedStore', context)
+        sedimentOutput = self.parameterAsOutputLayer(parameters, 'SedimentFlux', context) if computeUsped else None
+        if sedimentOutput:
+            outputs['SedimentFlux'] = sedimentOutput
+            self.rasters.append(sedimentOutput)
+        if self.requested(parameters, 'Slope', context):
+            outputs['Slope'] = self.outputRaster(parameters, 'Slope', context)
+        if self.requested(parameters, 'FlowAccumulation', context) or storePath:
+            outputs['FlowAccumulation'] = self.outputRaster(parameters, 'FlowAccumulation', context)
+        targets = dict(outputs)
+        if checkpoint is not None:
+            for name in ('Slope', 'FlowAccumulation'):
+                if name in targets:
+                    targets[name] = self.tempRaster(name)
+
+        # slope and flow accumulation are shared by every product, aspect by USPED only, and with
+        # flow routed the DEM is read once for all three; intermediates are removed as soon as the
+        # last stage reading them is done
+        stages = StageGraph(feedback, self.plan.workers, checkpoint)
+        stages.track(*self.intermediates)
+        add_terrain_stages(stages, demSource, self.tempRaster, targets.get('Slope'), targets.get('FlowAccumulation'), aspect=computeUsped,
+                           graph=bool(sedimentOutput), flow_source=flowSource, method=routingMethod, convergence=convergence,
+                           reuse_graph=reuseGraph, block_rows=rows, cache=cache, checkpoint=checkpoint)
+
+        # LS = (m + 1) * (A / 22.1)^m * (sin(B) / 0.09)^n
+        if computeLs:
+            stages.add('Ls', lambda flow, slope, feedback: block_calc(targets['Ls'], [flow, slope] + region, lambda A, B, R=1: ls_factor(A, B, m, n) * R, feedback, gdal.GDT_Float32, rows, statistics=True, checkpoint=checkpoint, encoding=encoding), 'FlowAccumulation', 'Slope')
+
+        # RUSLE = LS * K * C * R, from LS values computed inline (an encoded LS raster would round them)
+        if computeRusle:
+            stages.add('Rusle', lambda flow, slope, feedback: block_calc(targets['Rusle'], [flow, slope] + factors + region, lambda A, B, K, C, R, M=1: rusle(ls_factor(A, B, m, n), K, C, R) * M, feedback, block_rows=rows, statistics=True, checkpoint=checkpoint, encoding=encoding), 'FlowAccumulation', 'Slope')
+
+        # USPED, see erosion_flow_USPED for the steps
+        if computeUsped:
+            add_usped_stages(stages, self.tempRaster, factors, targets['Usped'], regime, regionMask, encoding, sedimentOutput,
+                             self.parameterAsDouble(parameters, 'deliveryratio', context), self.parameterAsBool(parameters, 'transportcap', context),
+                             rows, checkpoint)
+
+        results = stages.run()
+        feedback.pushInfo(stages.usage())
+        # outputs completed by an earlier attempt, or kept in the checkpoint, are copied to where this run writes them
+        results = {name: results[name] if results[name] == output else copy_raster(results[name], output)
+                   for name, output in outputs.items()}
+
+        # products into the chunked store, at their place in its grid (the DEM's when created)
+        if storePath:
+            stored = {key: results[name] for key, name in (('ls', 'Ls'), ('rusle', 'Rusle'), ('usped', 'Usped'), ('flowaccumulation', 'FlowAccumulation')) if name in results}
+            try:
+                results['ChunkedStore'] = store_outputs(storePath, demInfo, stored, feedback)
+            except ValueError as e:
+                raise QgsProcessingException(str(e))
+
+        global outputRenamers
+        outputRenamers = []
+        for name, label in (('Ls', 'LSarea'), ('Rusle', 'RUSLE'), ('Usped', 'USPED')):
+            if name in results and context.willLoadLayerOnCompletion(results[name]):
+                renamer = OutputRenamer(label, diverging=name == 'Usped')
+                context.layerToLoadOnCompletionDetails(results[name]).setPostProcessor(renamer)
+                outputRenamers.append(renamer)
+
+        return results
+
+    def runCheckpoint(self, parameters, context, folder, geometries):
+        """
+        The checkpoint of this run in folder, keyed by its input rasters and
+        parameters, None if an input raster is not a local file.
+        """
+        sources = []
+        for name in ('filleddem', 'kfactor', 'cfactor', 'rfactor', 'regimeraster', 'flowaccumulation'):
+            layer = self.parameterAsRasterLayer(parameters, name, context)
+            source = layer_source(layer) if layer is not None else None
+            if source is not None and not (isinstance(source, str) and os.path.isfile(source)):
+                return None
+            sources.append(source)
+        params = {'geometries': geometries}
+        for name in ('kfactorsinglevalue', 'cfactorsinglevalue', 'rfactorsinglevalue', 'lssheetfactor', 'lsrillfactor', 'rillminarea',
+                     'rillminslope', 'convergence', 'deliveryratio', 'encodingscale', 'encodingoffset'):
+            params[name] = self.parameterAsDouble(parameters, name, context)
+        for name in ('erosionregime', 'routingmethod', 'outputencoding'):
+            params[name] = self.parameterAsEnum(parameters, name, context)
+        for name in ('computels', 'computerusle', 'computeusped', 'prevailingrill', 'transportcap'):
+            params[name] = self.parameterAsBool(parameters, name, context)
+        for name in ('Slope', 'FlowAccumulation', 'SedimentFlux'):
+            params[name] = self.requested(parameters, name, context)
+        return Checkpoint(folder, run_key(self.name(), sources, params, folder))
+
+    def name(self):
+        return 'ErosionSuite'
+
+    def displayName(self):
+        return 'Erosion suite (LS, RUSLE, USPED)'
+
+    def group(self):
+        return ''
+
+    def groupId(self):
+        return ''
+
+    def shortHelpString(self):
+        return ('LS, RUSLE and USPED in one run: the DEM slope and flow accumulation (and aspect for USPED) '
+                'are computed once, from one read of the DEM, and shared by the enabled products, and disabled '
+                'products add no stages. USPED takes the same regime, sediment flux, encoding and checkpoint '
+                'options as the USPED algorithm, and a precomputed flow accumulation skips flow routing.')
+
+    def createInstance(self):
+        return ErosionSuite()
+
+class OutputRenamer (QgsProcessingLayerPostProcessorInterface):
+    def __init__(self, layer_name, diverging=False):
+        self.name = layer_name
+        self.diverging = diverging
+        super().__init__()
+
+    def postProcessLayer(self, layer, context, feedback):
+        layer.setName(self.name)
+        apply_default_style(layer, diverging=self.diverging)
@@ -0,0 +1,183 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+"""
+
+import csv
+
+import numpy as np
+
+from qgis.core import QgsProcessing
+from qgis.core import QgsProcessingAlgorithm
+from qgis.core import QgsProcessingException
+from qgis.core import QgsProcessingParameterMapLayer
+from qgis.core import QgsProcessingParameterNumber
+from qgis.core import QgsProcessingParameterString
+from qgis.core import QgsProcessingParameterRasterDestination
+from qgis.core import QgsProcessingParameterFileDestination
+from qgis.core import QgsProcessingParameterEnum
+from qgis.core import QgsProcessingParameterBoolean
+from qgis.core import QgsProcessingUtils
+from osgeo import gdal
+
+from .erosion_flow_layers import layer_source
+from .erosion_flow_engine import Canceled, check_canceled, ls_sweep
+from .erosion_flow_raster import block_calc, remove_rasters, raster_info, read_window, memory_path, open_raster
+from .erosion_flow_routing import ROUTING_METHODS, MFD
+from .erosion_flow_stages import flow_accumulation, slope_raster
+from .erosion_flow_scheduler import StageGraph
+from .erosion_flow_cache import run_cached
+from .erosion_flow_settings import result_cache, max_workers, memory_budget
+from .erosion_flow_memory import plan_memory, BLOCK_ARRAYS, MIN_BLOCK_ROWS
+from .erosion_flow_stats import BandStatistics, stored_statistics, PERCENTILES
+
+
+class LSSweep(QgsProcessingAlgorithm):
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterMapLayer('filleddem', 'Filled DEM no nulls or sinks', defaultValue=None, types=[QgsProcessing.TypeRaster]))
+        self.addParameter(QgsProcessingParameterString('sheetfactors', 'LS sheet erosion factors m (comma separated)', defaultValue='0.4, 0.45, 0.5, 0.55, 0.6'))
+        self.addParameter(QgsProcessingParameterString('rillfactors', 'LS rill erosion factors n (comma separated)', defaultValue='1.0, 1.1, 1.2, 1.3'))
+        self.addParameter(QgsProcessingParameterEnum('routingmethod', 'Flow routing method', options=ROUTING_METHODS, defaultValue=MFD))
+        self.addParameter(QgsProcessingParameterNumber('convergence', 'MFD convergence factor', optional=True, type=QgsProcessingParameterNumber.Double, minValue=0, defaultValue=1.1))
+        self.addParameter(QgsProcessingParameterBoolean('reuseflowgraph', 'Save and reuse the flow direction graph next to the DEM', defaultValue=False))
+        self.addParameter(QgsProcessingParameterMapLayer('flowaccumulation', 'Precomputed flow accumulation on the DEM grid (skips flow routing)', optional=True, defaultValue=None, types=[QgsProcessing.TypeRaster]))
+        self.addParameter(QgsProcessingParameterFileDestination('STATISTICS', 'LS statistics per m and n', fileFilter='CSV files (*.csv)'))
+        self.addParameter(QgsProcessingParameterRasterDestination('LsSweep', 'LS per m and n (one band each)', optional=True, createByDefault=False, defaultValue=None))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        ms = self.parameterAsValues(parameters, 'sheetfactors', context)
+        ns = self.parameterAsValues(parameters, 'rillfactors', context)
+        names = ['m={} n={}'.format(m, n) for m in ms for n in ns]
+        feedback.pushInfo('{} combinations of m and n'.format(len(names)))
+
+        cache = result_cache()
+        demSource = layer_source(self.parameterAsRasterLayer(parameters, 'filleddem', context))
+        demInfo = raster_info(demSource)
+        routingMethod = self.parameterAsEnum(parameters, 'routingmethod', context)
+        convergence = self.parameterAsDouble(parameters, 'convergence', context)
+        reuseGraph = self.parameterAsBool(parameters, 'reuseflowgraph', context)
+
+        flowLayer = self.parameterAsRasterLayer(parameters, 'flowaccumulation', context)
+        flowSource = layer_source(flowLayer) if flowLayer is not None else None
+        if flowSource is not None:
+            flowInfo = raster_info(flowSource)
+            if flowInfo.shape != demInfo.shape or not np.allclose(flowInfo.geotransform, demInfo.geotransform):
+                raise QgsProcessingException('Precomputed flow accumulation must be on the grid of the DEM')
+
+        sweepOutput = self.parameterAsOutputLayer(parameters, 'LsSweep', context)
+        statisticsOutput = self.parameterAsFileOutput(parameters, 'STATISTICS', context)
+
+        # a block holds every combination at once, so blocks get fewer rows the more there are
+        plan = plan_memory(demInfo.shape, memory_budget(), routingMethod, 2, max_workers())
+        feedback.pushInfo(plan.describe())
+        rows = max(MIN_BLOCK_ROWS, plan.block_rows * BLOCK_ARRAYS // max(BLOCK_ARRAYS, len(names) + 4))
+        tempRaster = lambda name: memory_path(name) if plan.in_memory else QgsProcessingUtils.generateTempFilename(name + '.tif')
+        intermediates = []
+
+        # flow accumulation and slope once, for every combination
+        stages = StageGraph(feedback, plan.workers)
+
+        def demSlope(feedback):
+            compute = lambda output: slope_raster(demSource, output, feedback=feedback, block_rows=rows)
+            intermediates.append(tempRaster('Slope'))
+            return run_cached(cache, 'slope', [demSource], {'z_factor': 1}, intermediates[-1], compute, feedback)
+
+        def flowAccumulation(feedback):
+            if flowSource is not None:
+                return flowSource
+            compute = lambda output: flow_accumulation(demSource, output, routingMethod, convergence, reuseGraph, feedback=feedback)
+            intermediates.append(tempRaster('FlowAccumulation'))
+            return run_cached(cache, 'flowaccumulation', [demSource], {'method': routingMethod, 'convergence': convergence}, intermediates[-1], compute, feedback)
+
+        stages.add('Slope', demSlope)
+        stages.add('FlowAccumulation', flowAccumulation)
+
+        # then the whole grid of m and n in one pass over the blocks, from logarithms taken once per block
+        if sweepOutput:
+            stages.add('LsSweep', lambda flow, slope, feedback: block_calc(sweepOutput, [flow, slope], lambda A, B: ls_sweep(A, B, ms, ns), feedback,
+                                                                           gdal.GDT_Float32, rows, band_names=names, statistics=True), 'FlowAccumulation', 'Slope')
+        else:
+            stages.add('LsSweep', lambda flow, slope, feedback: self.sweepStatistics(flow, slope, ms, ns, rows, feedback), 'FlowAccumulation', 'Slope')
+
+        try:
+            result = stages.run()['LsSweep']
+        except Canceled:
+            remove_rasters([sweepOutput] if sweepOutput else [])
+            feedback.pushInfo('Canceled, removed intermediate rasters')
+            return {}
+        finally:
+            remove_rasters(intermediates)
+
+        if sweepOutput:
+            dataset = open_raster(result)
+            statistics = [stored_statistics(dataset.GetRasterBand(i + 1)) for i in range(dataset.RasterCount)]
+            dataset = None
+        else:
+            statistics = result
+
+        columns = ['min', 'max', 'mean', 'std'] + ['p{}'.format(p) for p in PERCENTILES]
+        with open(statisticsOutput, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['m', 'n'] + columns)
+            for (m, n), values in zip([(m, n) for m in ms for n in ns], statistics):
+                writer.writerow([m, n] + [(values or {}).get(column, '') for column in columns])
+
+        results = {'STATISTICS': statisticsOutput}
+        if sweepOutput:
+            results['LsSweep'] = sweepOutput
+        return results
+
+    def parameterAsValues(self, parameters, name, context):
+        text = self.parameterAsString(parameters, name, context)
+        try:
+            values = [float(value) for value in text.replace(';', ',').split(',') if value.strip()]
+        except ValueError:
+            raise QgsProcessingException('{} must be numbers separated by commas: {}'.format(self.parameterDefinition(name).description(), text))
+        if not values:
+            raise QgsProcessingException(self.parameterDefinition(name).description() + ' needs at least one value')
+        return values
+
+    def sweepStatistics(self, flow, slope, ms, ns, rows, feedback):
+        """
+        Statistics of LS for every m and n, without writing the rasters.
+        """
+        info = raster_info(flow)
+        statistics = [BandStatistics(info.xsize * info.ysize) for _ in range(len(ms) * len(ns))]
+        for row in range(0, info.ysize, rows):
+            check_canceled(feedback, row / float(info.ysize))
+            count = min(rows, info.ysize - row)
+            block = ls_sweep(read_window(flow, row, 0, count, info.xsize), read_window(slope, row, 0, count, info.xsize), ms, ns)
+            for bandStatistics, values in zip(statistics, block):
+                bandStatistics.add(values)
+        return [bandStatistics.summary() for bandStatistics in statistics]
+
+    def name(self):
+        return 'LSSweep'
+
+    def displayName(self):
+        return 'LS exponent sweep'
+
+    def group(self):
+        return ''
+
+    def groupId(self):
+        return ''
+
+    def shortHelpString(self):
+        return ('LS = (m + 1) * (A / 22.1)^m * (sin(B) / 0.09)^n for every combination of the listed sheet (m) and '
+                'rill (n) erosion factors, for calibration. Flow accumulation and slope are computed once, and the '
+                'whole grid of m and n is evaluated in one pass over the DEM from logarithms taken once per block. '
+                'Writes the statistics of every combination to a CSV file, and optionally all LS rasters as the '
+                'bands of one raster.')
+
+    def createInstance(self):
+        return LSSweep()
@@ -0,0 +1,56 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+
+ Slope and aspect on NumPy arrays with Horn's method, matching the QGIS
+ native slope and aspect algorithms (degrees, aspect clockwise from north).
+
+ Inputs are padded by one cell on every side (NaN outside the raster);
+ missing neighbours take the value of the centre cell as QGIS does.
+"""
+
+import numpy as np
+
+
+def horn_derivatives(padded, cell_size, z_factor=1.0):
+    """
+    First derivatives dz/dx (east) and dz/dy (north-up, QGIS sign) of the
+    interior of a padded elevation array.
+    """
+    dx, dy = cell_size
+    centre = padded[1:-1, 1:-1]
+    rows, cols = centre.shape
+
+    def window(r, c):
+        values = padded[r:r + rows, c:c + cols]
+        return np.where(np.isnan(values), centre, values)
+
+    x11, x12, x13 = window(0, 0), window(0, 1), window(0, 2)
+    x21, x23 = window(1, 0), window(1, 2)
+    x31, x32, x33 = window(2, 0), window(2, 1), window(2, 2)
+    der_x = ((x13 + 2 * x23 + x33) - (x11 + 2 * x21 + x31)) / (8 * dx)
+    der_y = ((x31 + 2 * x32 + x33) - (x11 + 2 * x12 + x13)) / (8 * -dy)
+    return der_x * z_factor, der_y * z_factor
+
+
+def slope(padded, cell_size, z_factor=1.0):
+    der_x, der_y = horn_derivatives(padded, cell_size, z_factor)
+    return np.degrees(np.arctan(np.hypot(der_x, der_y)))
+
+
+def aspect(padded, cell_size, z_factor=1.0):
+    """
+    Downslope direction in degrees clockwise from north, NaN on flats.
+    """
+    der_x, der_y = horn_derivatives(padded, cell_size, z_factor)
+    result = 180.0 + np.degrees(np.arctan2(der_x, der_y))
+    result[(der_x == 0) & (der_y == 0)] = np.nan
+    return result
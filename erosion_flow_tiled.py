@@ -0,0 +1,258 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+
+ Flow accumulation of DEMs too large for memory, one tile at a time, in
+ the style of Barnes (2016), "Parallel non-divergent flow accumulation
+ for trillion cell digital elevation models on desktops or clusters".
+
+ 1. Every tile, read with a one cell halo so its receivers match the
+    whole DEM, is accumulated on its own. Its halo cells are outlets, so
+    they end up holding the flow leaving the tile into each neighbour.
+    The tile also keeps a perimeter summary: for each of its edge cells,
+    the share of flow entering there that leaves through each halo cell
+    (one sweep up its graph, see outlet_shares).
+ 2. The halo cells of a tile are edge cells of its neighbours, so the
+    summaries link all tile edges into one perimeter graph. It is solved
+    once, in memory, in topological order, giving the flow every edge
+    cell receives from outside its tile.
+ 3. A final pass routes each tile's edge inflow through it, adds it to
+    its own accumulation and hands the tile to the writer.
+
+ Accumulation is linear, so the result equals the whole-DEM accumulation
+ for every routing method (up to the negligible shares outlet_shares
+ drops), while a worker only ever holds one tile. With divergent routing
+ a summary lists every halo cell an edge cell's flow spreads to, so
+ smaller tiles keep summaries small. Tile graphs and first
+ pass accumulations are kept in a scratch folder. This module only needs
+ NumPy; reading and writing rasters is left to the caller (see
+ erosion_flow_stages.tiled_flow_accumulation).
+"""
+
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+from .erosion_flow_engine import check_canceled
+from .erosion_flow_routing import MFD, build_flow_graph, accumulate, outlet_shares, save_flow_graph, load_flow_graph
+
+TILE_SIZE = 2048
+
+# .npy headers are parsed with ast, which some Python versions cannot run
+# from several threads at once; scratch files are loaded one at a time
+_load_lock = threading.Lock()
+
+
+class TileGrid(object):
+    """
+    Splits a raster grid into tiles of size x size cells. Tile arrays are
+    padded with a one cell halo; cells are addressed by flat index into
+    the padded tile, or into the raster (global).
+    """
+
+    def __init__(self, info, size=TILE_SIZE):
+        self.info = info
+        self.size = size
+        self.tile_rows = -(-info.ysize // size)
+        self.tile_cols = -(-info.xsize // size)
+
+    def tiles(self):
+        return [(i, j) for i in range(self.tile_rows) for j in range(self.tile_cols)]
+
+    def window(self, tile):
+        """
+        (row, col, rows, cols) of a tile in the raster, halo excluded.
+        """
+        row, col = tile[0] * self.size, tile[1] * self.size
+        return row, col, min(self.size, self.info.ysize - row), min(self.size, self.info.xsize - col)
+
+    def halo(self, tile):
+        """
+        Boolean mask of the halo cells of a padded tile.
+        """
+        _, _, rows, cols = self.window(tile)
+        mask = np.ones((rows + 2, cols + 2), dtype=bool)
+        mask[1:-1, 1:-1] = False
+        return mask
+
+    def edge(self, tile):
+        """
+        Flat indices of the padded tile's edge cells, the ring inside its halo.
+        """
+        _, _, rows, cols = self.window(tile)
+        mask = np.zeros((rows + 2, cols + 2), dtype=bool)
+        mask[1:-1, 1:-1] = True
+        mask[2:-2, 2:-2] = False
+        return np.flatnonzero(mask)
+
+    def global_cells(self, tile, cells):
+        """
+        Global flat indices of cells of a padded tile (inside the raster).
+        """
+        row, col, _, cols = self.window(tile)
+        return (cells // (cols + 2) + row - 1) * self.info.xsize + cells % (cols + 2) + col - 1
+
+
+def solve_inflows(sources, targets, shares, cells, amounts):
+    """
+    Solves the perimeter graph. Tile summaries pass the share of the flow
+    entering edge cell source on to edge cell target of another tile
+    (global flat indices); the first pass delivers amounts to cells.
+    Returns (nodes, inflow): the edge cells involved, sorted, and the flow
+    each receives from outside its tile, found in one topological sweep
+    (Kahn's algorithm, one vectorised step per level).
+    Raises ValueError if the flow between tiles has a cycle.
+    """
+    nodes = np.unique(np.concatenate([sources, targets, cells]))
+    inflow = np.bincount(np.searchsorted(nodes, cells), amounts, minlength=nodes.size)
+    sources = np.searchsorted(nodes, sources)
+    targets = np.searchsorted(nodes, targets)
+    ranked = np.argsort(sources, kind='stable')
+    targets, shares = targets[ranked], shares[ranked]
+    indptr = np.zeros(nodes.size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=nodes.size), out=indptr[1:])
+    pending = np.bincount(targets, minlength=nodes.size)
+    frontier = np.flatnonzero(pending == 0)
+    solved = 0
+    while frontier.size:
+        solved += frontier.size
+        starts = indptr[frontier]
+        counts = indptr[frontier + 1] - starts
+        total = counts.sum()
+        if not total:
+            break
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(total)
+        # every edge into a frontier cell has been applied, so its inflow is complete
+        np.add.at(inflow, targets[positions], shares[positions] * np.repeat(inflow[frontier], counts))
+        reached, reaching = np.unique(targets[positions], return_counts=True)
+        pending[reached] -= reaching
+        frontier = reached[pending[reached] == 0]
+    if solved < nodes.size:
+        raise ValueError('The flow between tiles has a cycle')
+    return nodes, inflow
+
+
+class TiledAccumulation(object):
+    """
+    Tile by tile flow accumulation, see the module notes. info describes
+    the grid like RasterInfo (xsize, ysize, cell_sizes, cell_areas);
+    read(row, col, rows, cols) returns a window of the filled DEM with a one
+    cell halo, NaN for nodata and outside the raster; write(row, col, acc)
+    takes each finished tile. scratch is a folder for per tile files,
+    emptied after.
+    """
+
+    def __init__(self, info, read, write, scratch, size=TILE_SIZE, method=MFD, convergence=1.1,
+                 workers=1, feedback=None):
+        self.info = info
+        self.read = read
+        self.write = write
+        self.scratch = scratch
+        self.grid = TileGrid(info, size)
+        self.method = method
+        self.convergence = convergence
+        self.workers = max(1, workers)
+        self.feedback = feedback
+
+    def _path(self, tile, kind):
+        return os.path.join(self.scratch, '{}_{}.{}'.format(tile[0], tile[1], kind))
+
+    def _local(self, tile):
+        """
+        First pass: the tile's own accumulation, what it passes on and its
+        perimeter summary, all as global cells.
+        """
+        row, col, rows, cols = self.grid.window(tile)
+        dem = self.read(row, col, rows, cols)
+        halo = self.grid.halo(tile)
+        # cell sizes of the tile's rows and its halo rows (per row for geographic DEMs)
+        graph = build_flow_graph(dem, self.info.cell_sizes(row - 1, rows + 2), self.method, self.convergence, outlets=halo)
+        save_flow_graph(graph, self._path(tile, 'npz'))
+        acc = accumulate(graph, np.where(np.isnan(dem) | halo, 0, self.info.cell_areas(row - 1, rows + 2)))
+        acc[np.isnan(dem)] = np.nan
+        np.save(self._path(tile, 'npy'), acc)
+
+        leaving = np.flatnonzero(halo.ravel() & (acc.ravel() > 0))
+        edge = self.grid.edge(tile)
+        sources, targets, shares = outlet_shares(graph, edge[~np.isnan(dem.ravel()[edge])], halo)
+        return (self.grid.global_cells(tile, sources), self.grid.global_cells(tile, targets), shares,
+                self.grid.global_cells(tile, leaving), acc.ravel()[leaving])
+
+    def _final(self, tile, nodes, inflow):
+        """
+        Last pass: the tile's accumulation with its edge inflow routed through it.
+        """
+        with _load_lock:
+            acc = np.load(self._path(tile, 'npy'))
+        edge = self.grid.edge(tile)
+        cells = self.grid.global_cells(tile, edge)
+        found = np.searchsorted(nodes, cells)
+        entering = found < nodes.size
+        entering[entering] = nodes[found[entering]] == cells[entering]
+        if entering.any():
+            with _load_lock:
+                graph = load_flow_graph(self._path(tile, 'npz'))
+            weight = np.zeros(graph.size)
+            weight[edge[entering]] = inflow[found[entering]]
+            acc = acc + accumulate(graph, weight)
+        return acc[1:-1, 1:-1]
+
+    def _each(self, function, tiles, args, start, end):
+        """
+        Runs function(tile, *args) for tiles on the workers, yielding
+        (tile, result) as they finish.
+        """
+        done = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(function, tile, *args): tile for tile in tiles}
+            try:
+                for future in as_completed(futures):
+                    done += 1
+                    check_canceled(self.feedback, (start + (end - start) * done / float(len(futures))) / 100.0)
+                    yield futures[future], future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def run(self):
+        os.makedirs(self.scratch, exist_ok=True)
+        try:
+            self._run()
+        finally:
+            shutil.rmtree(self.scratch, ignore_errors=True)
+
+    def _run(self):
+        grid = self.grid
+        if self.feedback is not None:
+            self.feedback.pushConsoleInfo('Tiled flow accumulation: {} x {} tiles of {} cells'.format(
+                grid.tile_rows, grid.tile_cols, grid.size))
+
+        # 1. every tile on its own
+        parts = [[], [], [], [], []]
+        for _, summary in self._each(self._local, grid.tiles(), (), 0, 60):
+            for part, values in zip(parts, summary):
+                part.append(values)
+
+        # 2. the perimeter graph of all tiles
+        sources, targets, shares, cells, amounts = [np.concatenate(part) for part in parts]
+        parts = None
+        nodes, inflow = solve_inflows(sources, targets, shares, cells, amounts)
+        if self.feedback is not None:
+            self.feedback.pushConsoleInfo('Perimeter graph: {} edge cells, {} links'.format(nodes.size, sources.size))
+        sources = targets = shares = cells = amounts = None
+
+        # 3. edge inflow routed and tiles written
+        for tile, acc in self._each(self._final, grid.tiles(), (nodes, inflow), 60, 100):
+            row, col, _, _ = grid.window(tile)
+            self.write(row, col, acc)
@@ -0,0 +1,95 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+"""
+
+import os
+
+from qgis.core import QgsProcessing
+from qgis.core import QgsProcessingAlgorithm
+from qgis.core import QgsProcessingException
+from qgis.core import QgsProcessingParameterMultipleLayers
+from qgis.core import QgsProcessingParameterNumber
+from qgis.core import QgsProcessingParameterEnum
+from qgis.core import QgsProcessingParameterRasterDestination
+from qgis.core import QgsProcessingUtils
+from osgeo import gdal
+
+from .erosion_flow_engine import Canceled
+from .erosion_flow_routing import ROUTING_METHODS, MFD
+from .erosion_flow_settings import max_workers, memory_budget
+from .erosion_flow_memory import window_workers
+from .erosion_flow_stages import tiled_flow_accumulation
+from .erosion_flow_tiled import TILE_SIZE
+
+
+class TiledFlowAccumulation(QgsProcessingAlgorithm):
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterMultipleLayers('filleddem', 'Filled DEM or DEM tiles of a mosaic', layerType=QgsProcessing.TypeRaster, defaultValue=None))
+        self.addParameter(QgsProcessingParameterNumber('tilesize', 'Tile size (cells)', type=QgsProcessingParameterNumber.Integer, minValue=64, defaultValue=TILE_SIZE))
+        self.addParameter(QgsProcessingParameterEnum('routingmethod', 'Flow routing method', options=ROUTING_METHODS, defaultValue=MFD))
+        self.addParameter(QgsProcessingParameterNumber('convergence', 'MFD convergence factor', optional=True, type=QgsProcessingParameterNumber.Double, minValue=0, defaultValue=1.1))
+        self.addParameter(QgsProcessingParameterRasterDestination('FlowAccumulation', 'Flow Accumulation', createByDefault=True, defaultValue=None))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        layers = self.parameterAsLayerList(parameters, 'filleddem', context)
+        if not layers:
+            raise QgsProcessingException(self.invalidRasterError(parameters, 'filleddem'))
+        tileSize = self.parameterAsInt(parameters, 'tilesize', context)
+        routingMethod = self.parameterAsEnum(parameters, 'routingmethod', context)
+        convergence = self.parameterAsDouble(parameters, 'convergence', context)
+        output = self.parameterAsOutputLayer(parameters, 'FlowAccumulation', context)
+
+        # tiles of a mosaic are read through one virtual raster
+        demSource = layers[0].source()
+        if len(layers) > 1:
+            demSource = QgsProcessingUtils.generateTempFilename('Mosaic.vrt')
+            mosaic = gdal.BuildVRT(demSource, [layer.source() for layer in layers])
+            if mosaic is None:
+                raise QgsProcessingException('Could not build a mosaic of the DEM tiles: ' + gdal.GetLastErrorMsg())
+            mosaic = None
+        scratch = os.path.join(QgsProcessingUtils.tempFolder(), 'tiled_flow_' + os.path.basename(os.path.splitext(output)[0]))
+
+        # as many tiles at once as fit in the memory budget
+        workers = window_workers((tileSize + 2) ** 2, memory_budget(), routingMethod, max_workers())
+        feedback.pushInfo('Flow routing: {}, tiles of {} cells on {} workers'.format(ROUTING_METHODS[routingMethod], tileSize, workers))
+        try:
+            tiled_flow_accumulation(demSource, output, scratch, tileSize, routingMethod, convergence, workers, feedback)
+        except Canceled:
+            if os.path.isfile(output):
+                os.remove(output)
+            feedback.pushInfo('Canceled, removed partial output')
+            return {}
+        return {'FlowAccumulation': output}
+
+    def name(self):
+        return 'TiledFlowAccumulation'
+
+    def displayName(self):
+        return 'Tiled flow accumulation'
+
+    def group(self):
+        return ''
+
+    def groupId(self):
+        return ''
+
+    def shortHelpString(self):
+        return ('Flow accumulation of DEMs too large to route in one pass, or of a mosaic of DEM tiles. '
+                'Each tile is routed on its own, keeping where flow entering its edges leaves it; the flow '
+                'crossing tile edges is then solved once over all tile edges, and each tile is corrected and '
+                'written, matching a single pass over the whole DEM with only one tile per worker in memory. '
+                'The result can be given to LS Area '
+                'and RUSLE as a precomputed flow accumulation.')
+
+    def createInstance(self):
+        return TiledFlowAccumulation()
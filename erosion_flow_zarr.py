@@ -0,0 +1,269 @@
+"""
+/***************************************************************************
+ErosionFlow
+ A QGIS plugin with QGIS : 32214
+ Provides Basic erosion processing algorithms, such as RUSLE AND USPED
+                              -------------------
+        begin                : 2023-03-28
+        copyright            : (C) 2023 by Michael Tuck
+        email                : contact@michaeltuck.com
+        MIT LICENCE
+ ***************************************************************************/
+
+ Chunked array store output in the Zarr v2 directory layout, written with
+ NumPy and zlib only: one group per store, one float32 array per output,
+ one zlib compressed file per chunk. Georeferencing is kept as the GDAL
+ _CRS attribute, a geotransform attribute and x/y coordinate arrays, so
+ GDAL, xarray and zarr can read the store.
+
+ A store covers a fixed grid, usually a whole mosaic; each run writes its
+ outputs into the window it covers. Whole chunks are replaced atomically
+ and partly covered chunks are updated under a per-chunk lock file, so
+ runs in separate processes can write neighbouring tiles concurrently.
+ Only cells with data are written, leaving neighbouring tiles intact.
+"""
+
+import json
+import os
+import time
+import uuid
+import zlib
+
+import numpy as np
+
+from .erosion_flow_engine import check_canceled
+from .erosion_flow_raster import RasterInfo, OUTPUT_NODATA, BLOCK_ROWS, apply_scale, open_raster
+
+CHUNK = 512
+
+DTYPE = '<f4'
+
+COMPRESSOR = {'id': 'zlib', 'level': 1}
+
+LOCK_TIMEOUT = 60.0
+
+
+def _write_bytes(path, data):
+    """
+    Writes a file atomically, readers see either the old or the new content.
+    """
+    partial = '{}.{}.part'.format(path, uuid.uuid4().hex)
+    with open(partial, 'wb') as f:
+        f.write(data)
+    os.replace(partial, path)
+
+
+def _write_json(path, value):
+    _write_bytes(path, json.dumps(value, indent=1).encode('utf-8'))
+
+
+def _read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+class ChunkedStore(object):
+    """
+    A Zarr v2 group of 2D float32 arrays on the grid of info.
+    """
+
+    def __init__(self, path, info, chunk=CHUNK):
+        self.path = path
+        self.info = info
+        self.chunk = chunk
+
+    def offset(self, info):
+        """
+        (row, col) of a raster grid inside the store grid. Raises ValueError
+        if it has another cell size or is not aligned with the store cells.
+        """
+        store, other = self.info.geotransform, info.geotransform
+        if not np.allclose(store[1:3] + store[4:6], other[1:3] + other[4:6]):
+            raise ValueError('Raster cell size differs from the chunked store {}'.format(self.path))
+        col = (other[0] - store[0]) / store[1]
+        row = (other[3] - store[3]) / store[5]
+        if abs(col - round(col)) > 1e-6 or abs(row - round(row)) > 1e-6:
+            raise ValueError('Raster is not aligned with the chunked store {}'.format(self.path))
+        return int(round(row)), int(round(col))
+
+    def array_path(self, name):
+        return os.path.join(self.path, name)
+
+    def create_array(self, name):
+        """
+        Creates the array name if the store does not hold it yet.
+        """
+        folder = self.array_path(name)
+        if os.path.isfile(os.path.join(folder, '.zarray')):
+            return folder
+        os.makedirs(folder, exist_ok=True)
+        _write_json(os.path.join(folder, '.zattrs'), {
+            '_ARRAY_DIMENSIONS': ['y', 'x'],
+            '_CRS': {'wkt': self.info.projection},
+        })
+        _write_json(os.path.join(folder, '.zarray'), {
+            'zarr_format': 2,
+            'shape': [self.info.ysize, self.info.xsize],
+            'chunks': [self.chunk, self.chunk],
+            'dtype': DTYPE,
+            'compressor': COMPRESSOR,
+            'fill_value': OUTPUT_NODATA,
+            'order': 'C',
+            'filters': None,
+        })
+        return folder
+
+    def _chunk_file(self, name, i, j):
+        return os.path.join(self.array_path(name), '{}.{}'.format(i, j))
+
+    def read_chunk(self, name, i, j):
+        try:
+            with open(self._chunk_file(name, i, j), 'rb') as f:
+                data = zlib.decompress(f.read())
+        except FileNotFoundError:
+            return np.full((self.chunk, self.chunk), OUTPUT_NODATA, dtype=DTYPE)
+        return np.frombuffer(data, dtype=DTYPE).reshape(self.chunk, self.chunk).copy()
+
+    def _replace_chunk(self, name, i, j, chunk):
+        data = zlib.compress(np.ascontiguousarray(chunk, dtype=DTYPE).tobytes(), COMPRESSOR['level'])
+        _write_bytes(self._chunk_file(name, i, j), data)
+
+    def _lock(self, name, i, j):
+        path = self._chunk_file(name, i, j) + '.lock'
+        start = time.time()
+        while True:
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return path
+            except FileExistsError:
+                if time.time() - start > LOCK_TIMEOUT:
+                    # left behind by a crashed writer
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    start = time.time()
+                time.sleep(0.01)
+
+    def write_window(self, name, row, col, array):
+        """
+        Writes the cells of array that have data (not NaN) at (row, col) of
+        the store grid, the part outside the store grid is dropped.
+        """
+        rows, cols = array.shape
+        size = self.chunk
+        first_row, first_col = max(row, 0), max(col, 0)
+        last_row, last_col = min(row + rows, self.info.ysize), min(col + cols, self.info.xsize)
+        for i in range(first_row // size, (last_row - 1) // size + 1 if last_row > first_row else 0):
+            for j in range(first_col // size, (last_col - 1) // size + 1 if last_col > first_col else 0):
+                # overlap of the window and chunk (i, j) in store coordinates
+                top, bottom = max(first_row, i * size), min(last_row, (i + 1) * size)
+                left, right = max(first_col, j * size), min(last_col, (j + 1) * size)
+                values = array[top - row:bottom - row, left - col:right - col]
+                valid = ~np.isnan(values)
+                if not valid.any():
+                    continue
+                whole = valid.all() and bottom - top == size and right - left == size
+                lock = None if whole else self._lock(name, i, j)
+                try:
+                    chunk = self.read_chunk(name, i, j) if lock else np.empty((size, size), dtype=DTYPE)
+                    target = chunk[top - i * size:bottom - i * size, left - j * size:right - j * size]
+                    target[valid] = values[valid]
+                    self._replace_chunk(name, i, j, chunk)
+                finally:
+                    if lock:
+                        os.remove(lock)
+
+    def read_window(self, name, row, col, rows, cols):
+        """
+        Reads a window of an array as float64 with nodata as NaN.
+        """
+        result = np.full((rows, cols), np.nan)
+        size = self.chunk
+        for i in range(max(row, 0) // size, (min(row + rows, self.info.ysize) - 1) // size + 1):
+            for j in range(max(col, 0) // size, (min(col + cols, self.info.xsize) - 1) // size + 1):
+                chunk = self.read_chunk(name, i, j).astype(np.float64)
+                chunk[chunk == OUTPUT_NODATA] = np.nan
+                top, bottom = max(row, i * size), min(row + rows, (i + 1) * size)
+                left, right = max(col, j * size), min(col + cols, (j + 1) * size)
+                result[top - row:bottom - row, left - col:right - col] = \
+                    chunk[top - i * size:bottom - i * size, left - j * size:right - j * size]
+        return result
+
+    def write_raster(self, name, source, feedback=None):
+        """
+        Copies the first band of a raster file into array name at its place
+        in the store, BLOCK_ROWS rows at a time.
+        """
+        self.create_array(name)
+        dataset = open_raster(source)
+        band = dataset.GetRasterBand(1)
+        nodata = band.GetNoDataValue()
+        info = RasterInfo(dataset.GetGeoTransform(), dataset.GetProjection(),
+                          dataset.RasterXSize, dataset.RasterYSize, nodata)
+        row, col = self.offset(info)
+        # blocks aligned to chunk rows, so each chunk is rewritten at most once per column of chunks
+        step = max(BLOCK_ROWS // self.chunk, 1) * self.chunk
+        first = (-row) % self.chunk or step
+        block = 0
+        while block < info.ysize:
+            check_canceled(feedback, block / float(info.ysize))
+            rows = min(first if block == 0 else step, info.ysize - block)
+            values = band.ReadAsArray(0, block, info.xsize, rows).astype(np.float64)
+            if nodata is not None:
+                values[values == nodata] = np.nan
+            apply_scale(band, values)
+            self.write_window(name, row + block, col, values)
+            block += rows
+        return self.array_path(name)
+
+
+def _coordinates(store, name, values):
+    folder = os.path.join(store.path, name)
+    os.makedirs(folder, exist_ok=True)
+    _write_json(os.path.join(folder, '.zattrs'), {'_ARRAY_DIMENSIONS': [name]})
+    _write_json(os.path.join(folder, '.zarray'), {
+        'zarr_format': 2, 'shape': [len(values)], 'chunks': [len(values)], 'dtype': '<f8',
+        'compressor': COMPRESSOR, 'fill_value': None, 'order': 'C', 'filters': None,
+    })
+    _write_bytes(os.path.join(folder, '0'), zlib.compress(np.asarray(values, dtype='<f8').tobytes(), COMPRESSOR['level']))
+
+
+def open_store(path, info, chunk=CHUNK):
+    """
+    Opens the chunked store at path, creating it on the grid of info (a
+    RasterInfo, usually the full DEM or mosaic extent) if it does not exist.
+    """
+    attributes = os.path.join(path, '.zattrs')
+    if os.path.isfile(attributes):
+        attrs = _read_json(attributes)
+        grid = RasterInfo(attrs['geotransform'], attrs['_CRS']['wkt'], attrs['xsize'], attrs['ysize'], OUTPUT_NODATA)
+        return ChunkedStore(path, grid, int(attrs['chunk']))
+    os.makedirs(path, exist_ok=True)
+    gt = info.geotransform
+    store = ChunkedStore(path, RasterInfo(gt, info.projection, info.xsize, info.ysize, OUTPUT_NODATA), chunk)
+    _coordinates(store, 'x', gt[0] + (np.arange(info.xsize) + 0.5) * gt[1])
+    _coordinates(store, 'y', gt[3] + (np.arange(info.ysize) + 0.5) * gt[5])
+    _write_json(os.path.join(path, '.zgroup'), {'zarr_format': 2})
+    # written last: a store is complete once it has its attributes
+    _write_json(attributes, {
+        'geotransform': list(gt),
+        '_CRS': {'wkt': info.projection},
+        'xsize': info.xsize,
+        'ysize': info.ysize,
+        'chunk': chunk,
+    })
+    return store
+
+
+def store_outputs(path, info, outputs, feedback=None):
+    """
+    Writes the rasters of outputs, a dict of array name to raster path, to
+    the chunked store at path, created on the grid of info if missing.
+    """
+    store = open_store(path, info)
+    for name, source in outputs.items():
+        if feedback is not None:
+            feedback.pushConsoleInfo('Writing {} to chunked store {}'.format(name, path))
+        store.write_raster(name, source, feedback)
+    return path
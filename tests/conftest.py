@@ -0,0 +1,22 @@
+"""
+Makes the plugin folder importable as the erosion_flow package, whatever
+the checkout is called, so tests import its modules as QGIS does.
+"""
+
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if 'erosion_flow' not in sys.modules:
+    spec = importlib.util.spec_from_file_location('erosion_flow', os.path.join(ROOT, '__init__.py'),
+                                                  submodule_search_locations=[ROOT])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules['erosion_flow'] = package
+    spec.loader.exec_module(package)
+
+
+def pytest_addoption(parser):
+    parser.addoption('--update-golden', action='store_true', default=False,
+                     help='Rewrite the golden outputs in tests/data from the current engine')
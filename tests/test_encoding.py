@@ -0,0 +1,108 @@
+import os
+
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+
+from erosion_flow.erosion_flow_checkpoint import Checkpoint  # noqa: E402
+from erosion_flow.erosion_flow_engine import Canceled  # noqa: E402
+from erosion_flow.erosion_flow_encoding import INT16, Encoding  # noqa: E402
+from erosion_flow.erosion_flow_raster import RasterInfo, ArrayReader, block_calc, read_raster  # noqa: E402
+
+
+class Feedback(object):
+
+    def __init__(self, cancel_after=None):
+        self.warnings = []
+        self.progress = []
+        self.cancel_after = cancel_after
+
+    def isCanceled(self):
+        return self.cancel_after is not None and len(self.progress) >= self.cancel_after
+
+    def setProgress(self, value):
+        self.progress.append(value)
+
+    def pushWarning(self, text):
+        self.warnings.append(text)
+
+    def pushConsoleInfo(self, text):
+        pass
+
+
+def reader(values):
+    info = RasterInfo((0.0, 10.0, 0, 1000.0, 0, -10.0), '', values.shape[1], values.shape[0])
+    return ArrayReader(values.astype(np.float64), info)
+
+
+def test_fitted_encoding_is_written_in_one_pass(tmp_path):
+    values = np.linspace(0.0, 100.0, 40 * 8).reshape(40, 8)
+    values[0, :2] = -5.0, 120.0
+    calls = []
+
+    def function(v):
+        calls.append(v.shape)
+        return v
+    output = str(tmp_path / 'encoded.tif')
+    feedback = Feedback()
+    block_calc(output, [reader(values)], function, feedback, block_rows=10, statistics=True, encoding=Encoding(INT16))
+    # every row band computed once, no staging raster beside the output
+    assert len(calls) == 4
+    assert not [name for name in os.listdir(str(tmp_path)) if 'staging' in name]
+    band = gdal.Open(output).GetRasterBand(1)
+    assert band.DataType == gdal.GDT_Int16
+    # the first rows span the range of the rest
+    assert not feedback.warnings
+    assert np.allclose(read_raster(output)[0], values, atol=band.GetScale())
+
+
+def test_values_beyond_the_first_rows_are_clipped_with_a_warning(tmp_path):
+    values = np.arange(40 * 8, dtype=np.float64).reshape(40, 8)
+    output = str(tmp_path / 'encoded.tif')
+    feedback = Feedback()
+    block_calc(output, [reader(values)], lambda v: v, feedback, block_rows=10, encoding=Encoding(INT16))
+    assert len(feedback.warnings) == 1
+    assert np.nanmax(read_raster(output)[0]) == pytest.approx(values[:10].max(), abs=0.01)
+
+
+def test_leading_nodata_rows_wait_for_data_to_fit(tmp_path):
+    values = np.full((40, 8), np.nan)
+    values[20:] = np.linspace(1.0, 1.5, 20 * 8).reshape(20, 8)
+    values[20, 0] = 2.0
+    output = str(tmp_path / 'encoded.tif')
+    block_calc(output, [reader(values)], lambda v: v, Feedback(), block_rows=10, encoding=Encoding(INT16))
+    result = read_raster(output)[0]
+    assert np.isnan(result[:20]).all()
+    assert np.allclose(result[20:], values[20:], atol=1e-4)
+
+
+def test_resumed_output_keeps_its_fitted_encoding(tmp_path):
+    values = np.linspace(0.0, 50.0, 40 * 8).reshape(40, 8)
+    values[:10] = np.linspace(-100.0, 100.0, 10 * 8).reshape(10, 8)
+    checkpoint = Checkpoint(str(tmp_path), 'k' * 24)
+    output = checkpoint.path('encoded')
+    with pytest.raises(Canceled):
+        block_calc(output, [reader(values)], lambda v: v, Feedback(cancel_after=2), block_rows=10,
+                   checkpoint=checkpoint, encoding=Encoding(INT16))
+    assert checkpoint.rows(output) == 20
+    scale = gdal.Open(output).GetRasterBand(1).GetScale()
+    calls = []
+
+    def function(v):
+        calls.append(v.shape)
+        return v
+    block_calc(output, [reader(values)], function, Feedback(), block_rows=10, checkpoint=checkpoint,
+               encoding=Encoding(INT16))
+    assert len(calls) == 2
+    assert gdal.Open(output).GetRasterBand(1).GetScale() == scale
+    assert np.allclose(read_raster(output)[0], values, atol=scale)
+
+
+def test_staged_encoding_fits_the_whole_output(tmp_path):
+    values = np.arange(40 * 8, dtype=np.float64).reshape(40, 8)
+    output = str(tmp_path / 'encoded.tif')
+    feedback = Feedback()
+    block_calc(output, [reader(values)], lambda v: v, feedback, block_rows=10, encoding=Encoding(INT16, staged=True))
+    assert not feedback.warnings
+    assert np.allclose(read_raster(output)[0], values, atol=0.01)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from erosion_flow.erosion_flow_engine import (ls_factor, ls_sweep, rusle, rill_regime, sediment_flow, usped,
+                                              sediment_flux_x, sediment_flux_y)
+
+
+def test_ls_factor_at_the_unit_plot():
+    # 22.1 m of contributing area at the 9% slope of the unit plot gives m + 1
+    slope = np.degrees(np.arcsin(0.09))
+    assert ls_factor(np.array([22.1]), np.array([slope]), m=0.4, n=1.3) == pytest.approx(1.4, rel=1e-5)
+
+
+def test_ls_sweep_matches_ls_factor():
+    rng = np.random.default_rng(3)
+    flow = rng.random((6, 7)) * 1000 + 1
+    slope = rng.random((6, 7)) * 30
+    ms, ns = [0.0, 0.4, 0.6], [1.0, 1.3]
+    sweep = ls_sweep(flow, slope, ms, ns)
+    assert sweep.shape == (6, 6, 7)
+    for i, (m, n) in enumerate((m, n) for m in ms for n in ns):
+        assert np.allclose(sweep[i], ls_factor(flow, slope, m, n))
+
+
+def test_rusle_is_the_product_of_factors():
+    assert rusle(2.0, 0.3, 0.5, 100.0) == pytest.approx(30.0)
+
+
+def test_regime_per_cell():
+    flow = np.array([10.0, 1000.0, 1000.0])
+    slope = np.array([10.0, 1.0, 10.0])
+    rill = rill_regime(flow, slope, min_area=100, min_slope=5)
+    assert rill.tolist() == [False, False, True]
+    assert np.allclose(sediment_flow(flow, slope, rill), [sediment_flow(flow[0], slope[0], False),
+                                                          sediment_flow(flow[1], slope[1], False),
+                                                          sediment_flow(flow[2], slope[2], True)])
+    assert np.allclose(usped(np.ones(3), np.ones(3), rill), [20.0, 20.0, 2.0])
+
+
+# the engine's degree to radian factor is 0.01745
+@pytest.mark.parametrize('aspect, x, y', [(0.0, 0.0, 1.0), (90.0, 1.0, 0.0), (180.0, 0.0, -1.0), (270.0, -1.0, 0.0)])
+def test_sediment_flux_follows_the_aspect(aspect, x, y):
+    assert sediment_flux_x(1.0, 1.0, 1.0, 1.0, aspect) == pytest.approx(x, abs=1e-2)
+    assert sediment_flux_y(1.0, 1.0, 1.0, 1.0, aspect) == pytest.approx(y, abs=1e-2)
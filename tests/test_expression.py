@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from erosion_flow.erosion_flow_expression import compile_expression
+
+A = np.array([1.0, np.nan, 3.0, -1.0])
+B = np.array([2.0, 2.0, np.nan, -2.0])
+
+
+def evaluate(text, *values):
+    return compile_expression(text, ['A', 'B'][:len(values)]).evaluate(*values)
+
+
+def same(result, expected):
+    return np.array_equal(result, np.asarray(expected, dtype=float), equal_nan=True)
+
+
+def test_arithmetic():
+    assert same(evaluate('A * 2 + B', A, B), A * 2 + B)
+    assert np.allclose(evaluate('exp(-2 * A / (1 - A))', np.array([0.5])), [np.exp(-2.0)])
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('A < B', [1, np.nan, np.nan, 0]),
+    ('A != B', [1, np.nan, np.nan, 1]),
+    ('B < A < 2', [0, np.nan, np.nan, 1]),
+    ('A > 0 and B > 0', [1, np.nan, np.nan, 0]),
+    ('A > 0 or B > 0', [1, np.nan, np.nan, 0]),
+    ('not A > 2', [1, np.nan, 0, 1]),
+])
+def test_comparisons_and_logic_propagate_nan(text, expected):
+    assert same(evaluate(text, A, B), expected)
+
+
+def test_nan_condition_gives_nan():
+    assert same(evaluate('A if A > 0 else B', A, B), [1, np.nan, 3, -2])
+    assert same(evaluate('where(A > 2, A, B)', A, B), [2, np.nan, 3, -2])
+
+
+def test_isnan_fills_nodata():
+    assert same(evaluate('where(isnan(A), 0, A)', A), [1, 0, 3, -1])
+    assert same(evaluate('0 if isnan(A) else A', A), [1, 0, 3, -1])
+
+
+def test_constants_are_folded():
+    assert same(evaluate('2 < 3', A), [1, 1, 1, 1])
+
+
+def test_unknown_names_are_refused():
+    with pytest.raises(ValueError, match='unknown name'):
+        compile_expression('A + C', ['A', 'B'])
@@ -0,0 +1,62 @@
+"""
+Engine outputs on the fixture DEMs in tests/data against the golden
+outputs stored next to them. After an intended change of results rewrite
+the golden outputs with python -m pytest tests --update-golden and commit
+them with the change.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from erosion_flow import erosion_flow_api as api
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# fixture DEMs: data/<name>.npz holds the DEM, its geotransform and whether it is geographic
+DEMS = ['valley', 'geographic']
+
+# outputs in degrees that wrap around at 360
+CIRCULAR = {'aspect': 360.0}
+
+RTOL = 1e-6
+ATOL = 1e-9
+
+
+def engine_outputs(dem, geotransform, ellipsoid=None):
+    outputs = {}
+    for key, method in (('d8', api.D8), ('dinf', api.DINF)):
+        outputs['flowaccumulation_' + key] = api.flow_accumulation(dem, geotransform, method, ellipsoid=ellipsoid)
+    topo = api.topography(dem, geotransform, api.MFD, 1.1, ellipsoid=ellipsoid)
+    outputs['flowaccumulation'] = topo.flow
+    outputs['slope'] = topo.slope
+    outputs['aspect'] = topo.aspect
+    outputs['ls'] = api.ls(dem, geotransform, 0.5, 1.1, topo=topo)
+    outputs['rusle'] = api.rusle(dem, geotransform, 0.05, 0.5, 750, topo=topo)
+    outputs['usped'] = api.usped(dem, geotransform, 0.05, 0.5, 750, topo=topo)
+    return outputs
+
+
+def load_dem(name):
+    with np.load(os.path.join(DATA, name + '.npz')) as data:
+        return data['dem'], tuple(data['geotransform']), api.WGS84 if bool(data['geographic']) else None
+
+
+@pytest.mark.parametrize('name', DEMS)
+def test_engine_matches_golden_outputs(request, name):
+    dem, geotransform, ellipsoid = load_dem(name)
+    outputs = engine_outputs(dem, geotransform, ellipsoid)
+    path = os.path.join(DATA, name + '_golden.npz')
+    if request.config.getoption('--update-golden'):
+        np.savez_compressed(path, **outputs)
+    with np.load(path) as golden:
+        assert sorted(golden.files) == sorted(outputs)
+        for key, value in outputs.items():
+            expected = golden[key]
+            assert np.array_equal(np.isnan(value), np.isnan(expected)), key + ' nodata differs'
+            valid = ~np.isnan(expected)
+            error = np.abs(value[valid] - expected[valid])
+            if key in CIRCULAR:
+                error = np.minimum(error, CIRCULAR[key] - error)
+            assert np.all(error <= ATOL + RTOL * np.abs(expected[valid])), key
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from erosion_flow.erosion_flow_routing import D8, DINF, MFD, build_flow_graph, accumulate, route_load, outlet_shares
+
+CELL = 10.0
+
+# flow partitions are stored as float32
+TOLERANCE = 1e-6
+
+
+def valley(rows=20, cols=20):
+    """
+    A V shaped valley draining to its lowest cell, the middle of the last row.
+    """
+    row, col = np.mgrid[0:rows, 0:cols]
+    return np.abs(col - cols // 2) + 0.1 * (rows - 1 - row)
+
+
+@pytest.mark.parametrize('method', [D8, DINF, MFD])
+def test_outlet_receives_whole_area(method):
+    dem = valley()
+    graph = build_flow_graph(dem, (CELL, CELL), method)
+    acc = accumulate(graph, CELL * CELL)
+    assert acc[-1, 10] == pytest.approx(dem.size * CELL * CELL, rel=TOLERANCE)
+    assert np.all(acc >= CELL * CELL * (1 - TOLERANCE))
+
+
+@pytest.mark.parametrize('method', [D8, DINF, MFD])
+def test_accumulation_is_linear_in_weight(method):
+    dem = valley()
+    graph = build_flow_graph(dem, (CELL, CELL), method)
+    weight = np.random.default_rng(1).random(dem.shape)
+    acc = accumulate(graph, weight)
+    assert acc[-1, 10] == pytest.approx(weight.sum(), rel=TOLERANCE)
+
+
+def test_nodata_cells_take_no_flow():
+    dem = valley()
+    dem[5, 3] = np.nan
+    graph = build_flow_graph(dem, (CELL, CELL), MFD)
+    acc = accumulate(graph, np.where(np.isnan(dem), 0, 1.0))
+    assert acc[-1, 10] == pytest.approx(dem.size - 1)
+
+
+def test_route_load_without_capacity_delivers_everything():
+    dem = valley()
+    graph = build_flow_graph(dem, (CELL, CELL), D8)
+    assert route_load(graph, np.ones(dem.shape))[-1, 10] == pytest.approx(dem.size)
+
+
+def test_route_load_is_limited_by_capacity():
+    dem = valley()
+    graph = build_flow_graph(dem, (CELL, CELL), D8)
+    leaving = route_load(graph, np.ones(dem.shape), capacity=np.full(dem.shape, 3.0))
+    assert leaving.max() == pytest.approx(3.0)
+
+
+@pytest.mark.parametrize('method', [D8, DINF, MFD])
+def test_outlet_shares_split_each_source_over_the_outlets(method):
+    dem = valley()
+    outlets = np.zeros(dem.shape, dtype=bool)
+    outlets[-1] = True
+    graph = build_flow_graph(dem, (CELL, CELL), method, outlets=outlets)
+    sources = np.arange(dem.shape[1])
+    owner, outlet, share = outlet_shares(graph, sources, outlets)
+    # no pits, so all flow entering the first row leaves through the last
+    assert np.allclose(np.bincount(owner, share, minlength=sources.size), 1, rtol=TOLERANCE)
+    assert outlets.ravel()[outlet].all()
+    # a unit at each source, accumulated, reaches the outlets in the same shares
+    weight = np.zeros(dem.size)
+    weight[sources] = 1
+    acc = accumulate(graph, weight).ravel()
+    assert np.allclose(np.bincount(outlet, share, minlength=dem.size)[outlets.ravel()], acc[outlets.ravel()])
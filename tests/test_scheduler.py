@@ -0,0 +1,118 @@
+import os
+
+import pytest
+
+from erosion_flow.erosion_flow_checkpoint import Checkpoint
+from erosion_flow.erosion_flow_scheduler import StageGraph
+
+
+class Failed(Exception):
+    pass
+
+
+def writer(checkpoint, name, calls, fail=False):
+    """
+    A stage writing a small file into the checkpoint folder, recording its calls.
+    """
+    path = checkpoint.path(name)
+
+    def stage(*inputs, feedback):
+        calls.append(name)
+        if fail:
+            raise Failed(name)
+        assert all(os.path.exists(i) for i in inputs if isinstance(i, str))
+        with open(path, 'w') as f:
+            f.write(name)
+        return path
+    return stage
+
+
+def build(checkpoint, calls, fail=()):
+    # a and b are intermediates, both read by c, whose result d reads
+    stages = StageGraph(None, 1, checkpoint)
+    stages.add('a', writer(checkpoint, 'a', calls, 'a' in fail))
+    stages.add('b', writer(checkpoint, 'b', calls, 'b' in fail), 'a')
+    stages.add('c', writer(checkpoint, 'c', calls, 'c' in fail), 'a', 'b')
+    stages.add('d', writer(checkpoint, 'd', calls, 'd' in fail), 'c')
+    stages.temporary('a', 'b', 'c')
+    return stages
+
+
+def test_without_a_checkpoint_intermediates_go_after_their_last_reader(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path), 'k' * 24)
+    calls = []
+    results = build(checkpoint, calls).run()
+    assert calls == ['a', 'b', 'c', 'd']
+    assert os.path.exists(results['d'])
+    assert sorted(os.listdir(checkpoint.folder)) == ['d.tif', 'manifest.json']
+
+
+def test_resumed_intermediates_go_after_their_last_remaining_reader(tmp_path):
+    calls = []
+    with pytest.raises(Failed):
+        build(Checkpoint(str(tmp_path), 'k' * 24), calls, fail=('c',)).run()
+    # a and b are still needed by c
+    checkpoint = Checkpoint(str(tmp_path), 'k' * 24)
+    assert checkpoint.resumed
+    assert sorted(os.listdir(checkpoint.folder)) == ['a.tif', 'b.tif', 'manifest.json']
+
+    calls = []
+    results = build(checkpoint, calls).run()
+    assert calls == ['c', 'd']
+    assert os.path.exists(results['d'])
+    assert sorted(os.listdir(checkpoint.folder)) == ['d.tif', 'manifest.json']
+
+
+def test_resumed_intermediates_no_stage_reads_are_removed(tmp_path):
+    calls = []
+    with pytest.raises(Failed):
+        build(Checkpoint(str(tmp_path), 'k' * 24), calls, fail=('d',)).run()
+    # as if the attempt stopped after c completed but before its inputs were removed
+    checkpoint = Checkpoint(str(tmp_path), 'k' * 24)
+    for name in ('a', 'b'):
+        with open(checkpoint.path(name), 'w') as f:
+            f.write(name)
+
+    calls = []
+    results = build(checkpoint, calls).run()
+    assert calls == ['d']
+    assert os.path.exists(results['d'])
+    assert sorted(os.listdir(checkpoint.folder)) == ['d.tif', 'manifest.json']
+
+
+def test_lost_intermediates_are_made_again(tmp_path):
+    calls = []
+    with pytest.raises(Failed):
+        build(Checkpoint(str(tmp_path), 'k' * 24), calls, fail=('c',)).run()
+    checkpoint = Checkpoint(str(tmp_path), 'k' * 24)
+    os.remove(os.path.join(checkpoint.folder, 'b.tif'))
+
+    calls = []
+    build(checkpoint, calls).run()
+    assert calls == ['b', 'c', 'd']
+    assert sorted(os.listdir(checkpoint.folder)) == ['d.tif', 'manifest.json']
+
+
+def test_values_kept_in_memory_are_dropped_and_skipped_on_resume(tmp_path):
+    calls = []
+
+    def build_memory(checkpoint, fail=False):
+        stages = StageGraph(None, 1, checkpoint)
+
+        def dem(feedback):
+            calls.append('dem')
+            return [1.0, 2.0]
+        stages.add('dem', dem)
+        stages.add('a', writer(checkpoint, 'a', calls), 'dem')
+        stages.add('b', writer(checkpoint, 'b', calls, fail), 'a')
+        stages.temporary('dem', 'a')
+        return stages
+
+    results = build_memory(Checkpoint(str(tmp_path), 'm' * 24)).run()
+    assert 'dem' not in results
+    with pytest.raises(Failed):
+        build_memory(Checkpoint(str(tmp_path), 'n' * 24), fail=True).run()
+    # a is kept for b, so the value it was made from is not read again
+    calls = []
+    build_memory(Checkpoint(str(tmp_path), 'n' * 24)).run()
+    assert calls == ['b']
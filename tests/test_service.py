@@ -0,0 +1,52 @@
+import os
+
+import pytest
+
+pytest.importorskip('osgeo.gdal')
+
+from erosion_flow.erosion_flow_service import ErosionService, main  # noqa: E402
+
+
+@pytest.fixture
+def service(tmp_path):
+    service = ErosionService(1, root=str(tmp_path))
+    yield service
+    service.shutdown()
+
+
+@pytest.mark.parametrize('job', [[], 'usped', 3, None])
+def test_jobs_must_be_objects(service, job):
+    with pytest.raises(ValueError):
+        service.submit(job)
+
+
+@pytest.mark.parametrize('name, path', [('dem', '/etc/passwd'), ('output', '../usped.tif'), ('c', '/tmp/../etc/c.tif')])
+def test_rasters_outside_the_root_are_refused(service, name, path):
+    job = {'model': 'usped', 'dem': 'dem.tif', name: path}
+    with pytest.raises(ValueError, match='not inside'):
+        service.submit(job)
+
+
+def test_relative_paths_are_taken_from_the_root(service, tmp_path):
+    assert service.path('out/usped.tif', 'output') == os.path.realpath(str(tmp_path / 'out' / 'usped.tif'))
+
+
+def test_remote_host_needs_allow_remote():
+    with pytest.raises(SystemExit):
+        main(['--host', '0.0.0.0'])
+
+
+@pytest.mark.parametrize('method', ['d9', [1], 3, -1, 1.0, True, None])
+def test_unknown_methods_are_refused(service, method):
+    with pytest.raises(ValueError, match='method'):
+        service.submit({'model': 'ls', 'dem': 'dem.tif', 'method': method})
+
+
+@pytest.mark.parametrize('name, value', [('m', [1]), ('n', '1.1'), ('convergence', None), ('convergence', -1),
+                                         ('k', [0.05]), ('r', float('nan')), ('m', True), ('rill', 'yes'),
+                                         ('dem', 5), ('output', 3)])
+def test_bad_fields_are_refused(service, name, value):
+    job = {'model': 'usped', 'dem': 'dem.tif'}
+    job[name] = value
+    with pytest.raises(ValueError, match=name):
+        service.submit(job)
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+
+from erosion_flow.erosion_flow_raster import read_raster, block_calc  # noqa: E402
+from erosion_flow.erosion_flow_engine import sediment_flow, sediment_flux_x, sediment_flux_y, flux_change_x, flux_change_y, usped  # noqa: E402
+from erosion_flow.erosion_flow_scheduler import StageGraph  # noqa: E402
+from erosion_flow.erosion_flow_stages import slope_raster, aspect_raster, terrain_rasters, flow_accumulation  # noqa: E402
+from erosion_flow.erosion_flow_stages import add_terrain_stages, add_usped_stages  # noqa: E402
+
+CELL = 10.0
+FACTORS = [0.05, 0.5, 750.0]
+
+
+@pytest.fixture
+def dem_source(tmp_path):
+    row, col = np.mgrid[0:30, 0:24]
+    dem = np.abs(col - 12) * 0.5 + 0.3 * (30 - row) + np.random.default_rng(3).random((30, 24))
+    path = str(tmp_path / 'dem.tif')
+    dataset = gdal.GetDriverByName('GTiff').Create(path, 24, 30, 1, gdal.GDT_Float64)
+    dataset.SetGeoTransform((500000.0, CELL, 0, 4000000.0, 0, -CELL))
+    dataset.GetRasterBand(1).WriteArray(dem)
+    dataset.FlushCache()
+    dataset = None
+    return path
+
+
+def same(a, b):
+    return np.allclose(read_raster(a)[0], read_raster(b)[0], equal_nan=True)
+
+
+def test_slope_and_aspect_in_one_pass(tmp_path, dem_source):
+    slope, aspect = terrain_rasters(dem_source, str(tmp_path / 'slope.tif'), str(tmp_path / 'aspect.tif'), block_rows=7)
+    assert same(slope, slope_raster(dem_source, str(tmp_path / 'expected_slope.tif')))
+    assert same(aspect, aspect_raster(dem_source, str(tmp_path / 'expected_aspect.tif')))
+
+
+def test_usped_stages_match_the_steps_one_by_one(tmp_path, dem_source):
+    paths = iter(range(100))
+
+    def temp(name):
+        return str(tmp_path / '{}_{}.tif'.format(name, next(paths)))
+
+    stages = StageGraph(None, 2)
+    add_terrain_stages(stages, dem_source, temp, aspect=True, block_rows=7)
+    add_usped_stages(stages, temp, FACTORS, temp('Usped'), block_rows=7)
+    result = stages.run()['Usped']
+
+    slope = slope_raster(dem_source, temp('slope'))
+    aspect = aspect_raster(dem_source, temp('aspect'))
+    sflow = block_calc(temp('sflow'), [flow_accumulation(dem_source, temp('flow')), slope], sediment_flow)
+    qsx = block_calc(temp('qsx'), [sflow] + FACTORS + [aspect], sediment_flux_x)
+    qsy = block_calc(temp('qsy'), [sflow] + FACTORS + [aspect], sediment_flux_y)
+    dx = block_calc(temp('dx'), [aspect_raster(qsx, temp('qsxa')), slope_raster(qsx, temp('qsxs'))], flux_change_x)
+    dy = block_calc(temp('dy'), [aspect_raster(qsy, temp('qsya')), slope_raster(qsy, temp('qsys'))], flux_change_y)
+    assert same(result, block_calc(temp('expected'), [dx, dy], usped))
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from erosion_flow.erosion_flow_terrain import slope, aspect
+
+CELL = (10.0, 10.0)
+
+
+def plane(east, north, rows=8, cols=9):
+    """
+    Padded elevations of z = east * x + north * y, rows running south.
+    """
+    row, col = np.mgrid[0:rows + 2, 0:cols + 2]
+    return east * col * CELL[0] - north * row * CELL[1]
+
+
+@pytest.mark.parametrize('east, north', [(0.1, 0.0), (0.0, 0.2), (-0.3, 0.4), (0.05, -0.05)])
+def test_slope_of_a_plane(east, north):
+    expected = np.degrees(np.arctan(np.hypot(east, north)))
+    assert np.allclose(slope(plane(east, north), CELL), expected)
+
+
+@pytest.mark.parametrize('east, north, expected', [(0.1, 0.0, 270.0), (-0.1, 0.0, 90.0), (0.0, 0.1, 180.0),
+                                                   (0.0, -0.1, 0.0), (0.1, 0.1, 225.0), (-0.1, -0.1, 45.0)])
+def test_aspect_faces_downslope(east, north, expected):
+    result = aspect(plane(east, north), CELL)
+    assert np.allclose(result % 360.0, expected)
+
+
+def test_z_factor_scales_the_gradient():
+    assert np.allclose(slope(plane(0.1, 0.0), CELL, z_factor=2.0), np.degrees(np.arctan(0.2)))
+
+
+def test_flat_aspect_is_nan():
+    assert np.isnan(aspect(np.zeros((5, 5)), CELL)).all()
+
+
+def test_nodata_neighbours_take_the_centre_value():
+    padded = plane(0.1, 0.0)
+    padded[0, :] = np.nan
+    assert np.allclose(slope(padded, CELL)[1:], np.degrees(np.arctan(0.1)))
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+from erosion_flow.erosion_flow_routing import D8, DINF, MFD, build_flow_graph, accumulate
+from erosion_flow.erosion_flow_tiled import TiledAccumulation, solve_inflows
+
+CELL = 10.0
+
+
+class Grid(object):
+    """
+    The parts of RasterInfo tiled accumulation uses, for a projected array.
+    """
+
+    def __init__(self, dem):
+        self.ysize, self.xsize = dem.shape
+
+    def cell_sizes(self, row=0, rows=None):
+        return (CELL, CELL)
+
+    def cell_areas(self, row=0, rows=None):
+        return CELL * CELL
+
+
+def rough_valley(rows=23, cols=19):
+    """
+    A valley draining to the middle of its last row, with noise so flow crosses tile edges diagonally.
+    """
+    row, col = np.mgrid[0:rows, 0:cols]
+    noise = np.random.default_rng(2).random((rows, cols)) * 0.05
+    return np.abs(col - cols // 2) + 0.1 * (rows - 1 - row) + noise
+
+
+def tiled_array(dem, scratch, size, method, workers=1):
+    padded = np.pad(dem, 1, constant_values=np.nan)
+    result = np.full(dem.shape, -1.0)
+
+    def read(row, col, rows, cols):
+        return padded[row:row + rows + 2, col:col + cols + 2]
+
+    def write(row, col, acc):
+        result[row:row + acc.shape[0], col:col + acc.shape[1]] = acc
+
+    TiledAccumulation(Grid(dem), read, write, str(scratch), size, method, workers=workers).run()
+    return result
+
+
+@pytest.mark.parametrize('method', [D8, DINF, MFD])
+@pytest.mark.parametrize('size, workers', [(7, 1), (5, 3), (4, 2), (64, 1)])
+def test_tiles_match_the_whole_dem(tmp_path, method, size, workers):
+    dem = rough_valley()
+    dem[3, 4] = np.nan
+    acc = tiled_array(dem, tmp_path / 'scratch', size, method, workers)
+    expected = accumulate(build_flow_graph(dem, (CELL, CELL), method), CELL * CELL)
+    expected[np.isnan(dem)] = np.nan
+    assert np.allclose(acc, expected, rtol=1e-9, equal_nan=True)
+    assert not (tmp_path / 'scratch').exists()
+
+
+@pytest.mark.parametrize('method', [D8, MFD])
+def test_a_channel_zigzagging_across_tile_edges(tmp_path, method):
+    # a ramp down and to the right whose channel keeps crossing the edges of 3 x 3 tiles
+    row, col = np.mgrid[0:12, 0:12]
+    dem = 50.0 - row - 0.5 * col + 0.2 * ((row + col) % 3)
+    acc = tiled_array(dem, tmp_path / 'scratch', 3, method)
+    expected = accumulate(build_flow_graph(dem, (CELL, CELL), method), CELL * CELL)
+    assert np.allclose(acc, expected, rtol=1e-9)
+
+
+def test_inflows_are_solved_in_topological_order():
+    # 1 -> 2 -> 3 and 1 -> 3, given out of order
+    nodes, inflow = solve_inflows(np.array([2, 1, 1]), np.array([3, 2, 3]), np.array([1.0, 0.5, 0.5]),
+                                  np.array([1, 3]), np.array([4.0, 1.0]))
+    assert nodes.tolist() == [1, 2, 3]
+    assert inflow.tolist() == [4.0, 2.0, 5.0]
+
+
+def test_cycles_between_tiles_are_rejected():
+    with pytest.raises(ValueError):
+        solve_inflows(np.array([1, 2]), np.array([2, 1]), np.ones(2), np.array([1]), np.ones(1))
+
+
+def test_raster_output_matches_the_whole_dem(tmp_path):
+    gdal = pytest.importorskip('osgeo.gdal')
+    from erosion_flow.erosion_flow_raster import read_raster
+    from erosion_flow.erosion_flow_stages import tiled_flow_accumulation
+
+    dem = rough_valley()
+    source = str(tmp_path / 'dem.tif')
+    dataset = gdal.GetDriverByName('GTiff').Create(source, dem.shape[1], dem.shape[0], 1, gdal.GDT_Float64)
+    dataset.SetGeoTransform((500000.0, CELL, 0, 4000000.0, 0, -CELL))
+    dataset.GetRasterBand(1).WriteArray(dem)
+    dataset.FlushCache()
+    dataset = None
+    output = tiled_flow_accumulation(source, str(tmp_path / 'acc.tif'), str(tmp_path / 'scratch'), 5, MFD, workers=2)
+    expected = accumulate(build_flow_graph(dem, (CELL, CELL), MFD), CELL * CELL)
+    # the output is Float32
+    assert np.allclose(read_raster(output)[0], expected, rtol=1e-6)
+    assert not (tmp_path / 'scratch').exists()